@@ -21,3 +21,13 @@ loglevel  = "info"
 
 # App
 wsgi_app = "rum_marketplace_project.wsgi:application"
+
+# Realtime endpoints (conversation SSE stream and WebSocket) need the ASGI
+# app; with GUNICORN_ASGI=1 the same workers serve
+# rum_marketplace_project.asgi through uvicorn. Under WSGI those endpoints
+# tell clients to poll instead.
+import os
+
+if os.environ.get("GUNICORN_ASGI", "").strip().lower() in {"1", "true", "yes", "on"}:
+    worker_class = "uvicorn_worker.UvicornWorker"
+    wsgi_app = "rum_marketplace_project.asgi:application"
@@ -2,6 +2,7 @@
 ASGI config for rum_marketplace_project project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+WebSocket connections go to store_app.websocket; HTTP goes to Django.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/5.0/howto/deployment/asgi/
@@ -13,4 +14,14 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'rum_marketplace_project.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Imported after setup: it loads models
+from store_app.websocket import websocket_application  # noqa: E402
+
+
+async def application(scope, receive, send):
+    """Route WebSocket connections to the chat endpoint, everything else to Django"""
+    if scope["type"] == "websocket":
+        return await websocket_application(scope, receive, send)
+    return await django_application(scope, receive, send)
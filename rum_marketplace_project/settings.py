@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/5.0/ref/settings/
 
 from pathlib import Path
 import os
+import sys
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -183,6 +184,50 @@ LOGOUT_REDIRECT_URL = "/"
 
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
+# Cache shared by every worker process: the inbox and unread badge caches,
+# presence and typing indicators and the rate limit buckets are written by
+# one worker and read by the others, so a per-process cache would serve
+# stale state. REDIS_URL is required unless DEBUG is on (runserver is a
+# single process, where the local memory cache is enough).
+REDIS_URL = os.environ.get("REDIS_URL")
+if REDIS_URL:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": REDIS_URL,
+        }
+    }
+elif DEBUG:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        }
+    }
+elif "test" not in sys.argv:
+    raise ValueError("REDIS_URL environment variable is required (the cache must be shared by every worker)")
+
+# Realtime messaging pub/sub (conversation SSE stream, see store_app/pubsub.py).
+# InMemoryBackend only reaches streams served by the same process; with several
+# workers on one host use store_app.pubsub.FileBackend so they share events.
+MESSAGE_PUBSUB = {
+    "BACKEND": os.environ.get("MESSAGE_PUBSUB_BACKEND", "store_app.pubsub.InMemoryBackend"),
+    "OPTIONS": {
+        "path": os.environ.get("MESSAGE_PUBSUB_PATH", str(BASE_DIR / "tmp" / "pubsub")),
+    },
+}
+
+# Flood control for message sends, new conversations and reviews (see
+# store_app/ratelimit.py). RATE_LIMITS overrides the per-scope defaults;
+# RATE_LIMIT_PROXY_COUNT is the number of proxies (nginx) appending to
+# X-Forwarded-For in front of the app.
+RATE_LIMIT_ENABLED = env_bool("RATE_LIMIT_ENABLED", True)
+RATE_LIMITS = {}
+RATE_LIMIT_PROXY_COUNT = int(os.environ.get("RATE_LIMIT_PROXY_COUNT", "0"))
+
+# Largest image or PDF that can be sent in a conversation, in bytes (see
+# store_app/utils/attachment_utils.py); nginx's client_max_body_size must allow it.
+MESSAGE_ATTACHMENT_MAX_SIZE = int(os.environ.get("MESSAGE_ATTACHMENT_MAX_SIZE", str(10 * 1024 * 1024)))
+
 # Email (force SendGrid via Anymail; Gmail SMTP fallback removed)
 EMAIL_BACKEND = "anymail.backends.sendgrid.EmailBackend"
 DEFAULT_FROM_EMAIL = os.environ.get("DEFAULT_FROM_EMAIL", "rummarketplace@gmail.com")
@@ -207,11 +252,25 @@ SECURE_REFERRER_POLICY = "strict-origin-when-cross-origin"
 SECURE_PROXY_SSL_HEADER = ("HTTP_X_FORWARDED_PROTO", "https")
 
 # Use SQLite for testing (allows running tests without PostgreSQL)
-import sys
 if 'test' in sys.argv:
     DATABASES = {
         'default': {
             'ENGINE': 'django.db.backends.sqlite3',
             'NAME': ':memory:',
         }
-    }
\ No newline at end of file
+    }
+    # Every test client shares one IP; the rate limit tests turn it back on
+    RATE_LIMIT_ENABLED = False
+    # Tests run in one process
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+    # Uploads made by tests go to a throwaway directory, not the repo's media/
+    import atexit
+    import shutil
+    import tempfile
+
+    MEDIA_ROOT = Path(tempfile.mkdtemp(prefix="rum-marketplace-test-media-"))
+    atexit.register(shutil.rmtree, MEDIA_ROOT, ignore_errors=True)
\ No newline at end of file
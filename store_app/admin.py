@@ -1,4 +1,9 @@
 from django.contrib import admin
+from django.core.paginator import Paginator
+from django.db import connection
+from django.db.models import Count, Exists, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+from django.utils.functional import cached_property
 from .models import (
     UserProfile,
     ProductCategory,
@@ -17,9 +22,14 @@ from .models import (
     Cart,
     PurchaseHistory,
     Conversation,
+    ConversationParticipantState,
     Message,
+    MessageAttachment,
     SellerRating,
+    User,
 )
+from .utils.purge_utils import delete_messages_in_batches
+from .utils.search_utils import match_message_text
 
 
 # Register your models here.
@@ -40,9 +50,7 @@ class ServiceCategoryAdmin(admin.ModelAdmin):
 
 
 admin.site.register(UserProfile)
-admin.site.register(Product)
 admin.site.register(ProductImage)
-admin.site.register(Service)
 admin.site.register(ProductOrder)
 admin.site.register(ServiceRequest)
 admin.site.register(Business)
@@ -56,34 +64,196 @@ admin.site.register(PurchaseHistory)
 admin.site.register(SellerRating)
 
 
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator for the changelists of very large tables, which never run an
+    unbounded COUNT(*): an unfiltered list takes PostgreSQL's row estimate
+    once the table is big, and a filtered or searched one counts at most
+    ESTIMATED_COUNT_CAP rows (later pages are then out of reach; narrow the
+    filter instead).
+    """
+
+    # Below this many (estimated) rows an exact count is cheap enough
+    ESTIMATED_COUNT_THRESHOLD = 100_000
+    ESTIMATED_COUNT_CAP = 10_000
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list.order_by()
+        if not queryset.query.where:
+            estimate = estimate_row_count(queryset.model)
+            if estimate > self.ESTIMATED_COUNT_THRESHOLD:
+                return estimate
+            return queryset.count()
+        return queryset[: self.ESTIMATED_COUNT_CAP].count()
+
+
+def estimate_row_count(model):
+    """
+    The planner's row estimate for `model`'s table (summed over its
+    partitions if it is partitioned), from the statistics ANALYZE keeps;
+    0 when there is none, or off PostgreSQL
+    """
+    if connection.vendor != "postgresql":
+        return 0
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT COALESCE(SUM(GREATEST(reltuples, 0)), 0)::bigint FROM pg_class "
+            "WHERE (oid = %s::regclass AND relkind = 'r') "
+            "OR oid IN (SELECT inhrelid FROM pg_inherits WHERE inhparent = %s::regclass)",
+            [model._meta.db_table, model._meta.db_table],
+        )
+        return cursor.fetchone()[0]
+
+
+def _search_user_ids(term):
+    """Users with exactly this username (the unique index), as a subquery"""
+    return User.objects.filter(username=term).values("pk")
+
+
+@admin.register(Product)
+class ProductAdmin(admin.ModelAdmin):
+    list_display = ["name", "user_vendor", "price", "sold_out"]
+    list_select_related = ["user_vendor"]
+    search_fields = ["name"]
+    autocomplete_fields = ["user_vendor"]
+
+
+@admin.register(Service)
+class ServiceAdmin(admin.ModelAdmin):
+    list_display = ["name", "user_provider", "price", "sold_out"]
+    list_select_related = ["user_provider"]
+    search_fields = ["name"]
+    autocomplete_fields = ["user_provider"]
+
+
+# The messaging admins stay fast on millions of rows: every column comes
+# from the page query itself (joins or per-row subqueries on indexes), the
+# default order is the primary key, counts go through
+# EstimatedCountPaginator, and search only does indexed lookups.
+
+
 @admin.register(Conversation)
 class ConversationAdmin(admin.ModelAdmin):
-    list_display = ['id', 'get_participants', 'product', 'service', 'created_at', 'updated_at', 'message_count']
-    list_filter = ['created_at', 'updated_at', 'product', 'service']
-    search_fields = ['participants__username', 'participants__email', 'product__name', 'service__name']
-    readonly_fields = ['created_at', 'updated_at']
-    filter_horizontal = ['participants']
-    
+    list_display = ['id', 'get_participants', 'product', 'service', 'created_at', 'last_message_at', 'message_count']
+    list_select_related = ['product', 'service']
+    list_filter = [
+        'created_at',
+        ('product', admin.EmptyFieldListFilter),
+        ('service', admin.EmptyFieldListFilter),
+    ]
+    # Handled by get_search_results()
+    search_fields = ['=id']
+    search_help_text = 'Conversation id, or the exact username of a participant.'
+    ordering = ['-id']
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    readonly_fields = ['created_at', 'updated_at', 'last_message_id', 'last_message_at', 'last_message_preview']
+    autocomplete_fields = ['participants', 'product', 'service', 'user_low', 'user_high']
+
+    def get_queryset(self, request):
+        message_counts = (
+            Message.objects.filter(conversation=OuterRef('pk'))
+            .order_by()
+            .values('conversation')
+            .annotate(count=Count('id'))
+            .values('count')
+        )
+        # Participants (also in each row's str()) come in one query for the page
+        return (
+            super()
+            .get_queryset(request)
+            .annotate(_message_count=Coalesce(Subquery(message_counts), 0))
+            .prefetch_related('participants')
+        )
+
+    def get_search_results(self, request, queryset, search_term):
+        term = search_term.strip()
+        if not term:
+            return queryset, False
+        if term.isdigit():
+            return queryset.filter(pk=int(term)), False
+        user_ids = _search_user_ids(term)
+        return queryset.filter(Q(user_low_id__in=user_ids) | Q(user_high_id__in=user_ids)), False
+
+    @admin.display(description='Participants')
     def get_participants(self, obj):
-        return ', '.join([p.get_full_name() or p.username for p in obj.participants.all()])
-    get_participants.short_description = 'Participants'
-    
+        return ', '.join(p.get_full_name() or p.username for p in obj.participants.all())
+
+    @admin.display(description='Messages')
     def message_count(self, obj):
-        return obj.messages.count()
-    message_count.short_description = 'Messages'
+        return obj._message_count
+
+
+class MessageAttachmentInline(admin.TabularInline):
+    model = MessageAttachment
+    fk_name = 'message'
+    fields = ['original_name', 'kind', 'size', 'thumbnail_status', 'file']
+    readonly_fields = fields
+    extra = 0
+    can_delete = False
 
 
 @admin.register(Message)
 class MessageAdmin(admin.ModelAdmin):
-    list_display = ['id', 'conversation', 'sender', 'content_preview', 'product', 'service', 'is_read', 'created_at']
-    list_filter = ['is_read', 'created_at', 'read_at', 'product', 'service']
-    search_fields = ['content', 'sender__username', 'sender__email', 'conversation__participants__username']
-    readonly_fields = ['created_at', 'read_at']
-    date_hierarchy = 'created_at'
-    
+    list_display = ['id', 'conversation_id', 'sender', 'content_preview', 'product', 'service', 'read', 'created_at']
+    list_select_related = ['sender', 'conversation', 'product', 'service']
+    list_filter = ['created_at']
+    # Handled by get_search_results()
+    search_fields = ['=id']
+    search_help_text = (
+        'Message or conversation id, the exact username of the sender, or words in the content.'
+    )
+    ordering = ['-id']
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    readonly_fields = ['created_at', 'read_watermark_at']
+    autocomplete_fields = ['sender', 'product', 'service']
+    raw_id_fields = ['conversation']
+    inlines = [MessageAttachmentInline]
+
+    def get_queryset(self, request):
+        read = ConversationParticipantState.objects.filter(
+            conversation_id=OuterRef('conversation_id'), last_read_message_id__gte=OuterRef('pk')
+        ).exclude(user_id=OuterRef('sender_id'))
+        # Each row's str() names the conversation's participants
+        return (
+            super()
+            .get_queryset(request)
+            .annotate(_is_read=Exists(read))
+            .prefetch_related('conversation__participants')
+        )
+
+    def get_search_results(self, request, queryset, search_term):
+        term = search_term.strip()
+        if not term:
+            return queryset, False
+        if term.isdigit():
+            return queryset.filter(Q(pk=int(term)) | Q(conversation_id=int(term))), False
+        return (
+            match_message_text(queryset, term) | queryset.filter(sender_id__in=_search_user_ids(term)),
+            False,
+        )
+
+    # Deleted messages take their attachments with them and must come off
+    # the recipients' unread counters
+    def delete_model(self, request, obj):
+        delete_messages_in_batches(Message.objects.filter(pk=obj.pk))
+
+    def delete_queryset(self, request, queryset):
+        delete_messages_in_batches(queryset)
+
+    @admin.display(description='Conversation', ordering='conversation_id')
+    def conversation_id(self, obj):
+        return obj.conversation_id
+
+    @admin.display(description='Content')
     def content_preview(self, obj):
         return obj.content[:50] + '...' if len(obj.content) > 50 else obj.content
-    content_preview.short_description = 'Content'
+
+    @admin.display(description='Read', boolean=True)
+    def read(self, obj):
+        return obj._is_read
 
 
 admin.site.site_header = "Rum Marketplace Admin"
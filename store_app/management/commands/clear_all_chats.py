@@ -2,9 +2,25 @@
 Management command to delete all conversations and messages.
 Usage: python manage.py clear_all_chats
        python manage.py clear_all_chats --confirm (to skip confirmation)
+       python manage.py clear_all_chats --confirm --batch-size 10000 --sleep 0.1
+       python manage.py clear_all_chats --confirm --truncate (PostgreSQL only)
+
+Rows are deleted in bounded id-range batches, each in its own transaction,
+so the messaging tables are never locked for long. If the command is
+interrupted, run it again: it resumes with whatever is left.
 """
-from django.core.management.base import BaseCommand
+import time
+
+from django.core.management.base import BaseCommand, CommandError
 from store_app.models import Conversation, Message
+from store_app.utils.inbox_utils import invalidate_inbox_cache
+from store_app.utils.purge_utils import (
+    PURGE_BATCH_SIZE,
+    can_truncate,
+    delete_in_batches,
+    delete_messages_in_batches,
+    truncate_chat_tables,
+)
 
 
 class Command(BaseCommand):
@@ -16,8 +32,28 @@ class Command(BaseCommand):
             action='store_true',
             help='Skip confirmation prompt',
         )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=PURGE_BATCH_SIZE,
+            help=f'Rows deleted per transaction (default: {PURGE_BATCH_SIZE}).',
+        )
+        parser.add_argument(
+            '--sleep',
+            type=float,
+            default=0,
+            help='Seconds to pause between batches to spare replicas and autovacuum (default: 0).',
+        )
+        parser.add_argument(
+            '--truncate',
+            action='store_true',
+            help='Empty the messaging tables with a single TRUNCATE (PostgreSQL only).',
+        )
 
     def handle(self, *args, **options):
+        if options['truncate'] and not can_truncate():
+            raise CommandError('--truncate is only supported on PostgreSQL.')
+
         # Count existing data
         conversation_count = Conversation.objects.count()
         message_count = Message.objects.count()
@@ -43,24 +79,49 @@ class Command(BaseCommand):
             if confirm.lower() not in ['yes', 'y']:
                 self.stdout.write(self.style.ERROR('Operation cancelled.'))
                 return
-        
-        # Get actual counts before deletion
-        actual_message_count = Message.objects.count()
-        actual_conversation_count = Conversation.objects.count()
-        
-        # Delete messages first (due to foreign key constraint)
-        Message.objects.all().delete()
-        self.stdout.write(
-            self.style.SUCCESS(f'Successfully deleted {actual_message_count} message(s)')
-        )
-        
-        # Delete conversations
-        Conversation.objects.all().delete()
-        self.stdout.write(
-            self.style.SUCCESS(f'Successfully deleted {actual_conversation_count} conversation(s)')
+
+        # Cascaded deletes send no signals, so drop the cached inboxes ourselves
+        participant_ids = set(
+            Conversation.participants.through.objects.values_list('user_id', flat=True)
         )
-        
+
+        if options['truncate']:
+            started = time.monotonic()
+            truncate_chat_tables()
+            elapsed = time.monotonic() - started
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f'Truncated {message_count} message(s) and {conversation_count} conversation(s) in {elapsed:.1f}s'
+                )
+            )
+        else:
+            # Delete messages first so each conversation batch cascades only small tables
+            self.purge('message', delete_messages_in_batches, Message.objects.all(), options)
+            self.purge('conversation', delete_in_batches, Conversation.objects.all(), options)
+        invalidate_inbox_cache(participant_ids)
+
         self.stdout.write(
             self.style.SUCCESS('\n✓ All chats have been cleared successfully!')
         )
 
+    def purge(self, label, delete, queryset, options):
+        started = time.monotonic()
+
+        def report(deleted):
+            if options['verbosity'] > 1:
+                rate = deleted / max(time.monotonic() - started, 1e-6)
+                self.stdout.write(f'  {deleted} {label}(s) deleted ({rate:.0f}/s)')
+
+        deleted = delete(
+            queryset,
+            batch_size=options['batch_size'],
+            pause=options['sleep'],
+            on_batch=report,
+        )
+        elapsed = time.monotonic() - started
+        rate = deleted / elapsed if elapsed else deleted
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'Successfully deleted {deleted} {label}(s) in {elapsed:.1f}s ({rate:.0f}/s)'
+            )
+        )
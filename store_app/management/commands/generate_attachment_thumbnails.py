@@ -0,0 +1,74 @@
+"""
+Management command (the background worker) that makes the thumbnails of
+image attachments sent in conversations.
+Usage: python manage.py generate_attachment_thumbnails
+       python manage.py generate_attachment_thumbnails --watch
+       python manage.py generate_attachment_thumbnails --watch --interval 2 --batch-size 20
+
+Upload requests only store the file and queue the attachment; this command
+works through the queue. Without --watch it drains it once (e.g., every
+minute via cron); with --watch it keeps running and checks for new uploads
+every --interval seconds. Several workers may run at once on PostgreSQL.
+"""
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from store_app.utils.attachment_utils import THUMBNAIL_BATCH_SIZE, generate_pending_thumbnails
+
+
+class Command(BaseCommand):
+    help = 'Make the thumbnails of newly uploaded image attachments'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--watch',
+            action='store_true',
+            help='Keep running and pick up new uploads as they arrive.',
+        )
+        parser.add_argument(
+            '--interval',
+            type=float,
+            default=5,
+            help='Seconds to wait between checks once the queue is empty, with --watch (default: 5).',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=THUMBNAIL_BATCH_SIZE,
+            help=f'Attachments rendered per transaction (default: {THUMBNAIL_BATCH_SIZE}).',
+        )
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1.')
+        if options['interval'] <= 0:
+            raise CommandError('--interval must be positive.')
+
+        if not options['watch']:
+            started = time.monotonic()
+            ready, failed = self.drain(options['batch_size'])
+            elapsed = time.monotonic() - started
+            self.stdout.write(self.style.SUCCESS(f'Made {ready} thumbnail(s) in {elapsed:.1f}s'))
+            if failed:
+                self.stdout.write(self.style.WARNING(f'{failed} attachment(s) could not be thumbnailed.'))
+            return
+
+        self.stdout.write(f'Watching for new attachments every {options["interval"]:g}s')
+        try:
+            while True:
+                ready, failed = self.drain(options['batch_size'])
+                if ready or failed:
+                    self.stdout.write(f'  {ready} thumbnail(s) made, {failed} failed')
+                time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            self.stdout.write('Stopped.')
+
+    def drain(self, batch_size):
+        ready = failed = 0
+        while True:
+            batch_ready, batch_failed = generate_pending_thumbnails(batch_size)
+            ready += batch_ready
+            failed += batch_failed
+            if batch_ready + batch_failed < batch_size:
+                return ready, failed
@@ -0,0 +1,97 @@
+"""
+Management command to manage the monthly partitions of the messages table
+(PostgreSQL only; see store_app.utils.partition_utils).
+Usage: python manage.py partition_messages --convert
+       python manage.py partition_messages --months-ahead 3
+       python manage.py partition_messages --drop-before-days 365
+       python manage.py partition_messages --drop-before-days 365 --detach-only
+
+--convert is run once, in a maintenance window: it briefly locks the table
+while the existing rows are attached as the legacy partition. After that,
+run the command periodically (e.g., daily via cron) so next months'
+partitions always exist; messages outside every monthly range land in the
+default partition.
+"""
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from store_app.utils.partition_utils import (
+    can_partition,
+    convert_to_partitioned,
+    count_default_partition_rows,
+    drop_partitions_before,
+    ensure_partitions,
+    is_partitioned,
+)
+
+
+class Command(BaseCommand):
+    help = 'Create upcoming monthly partitions of the messages table and drop expired ones (PostgreSQL only)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--convert',
+            action='store_true',
+            help='Turn the messages table into a partitioned table first (one-time).',
+        )
+        parser.add_argument(
+            '--months-ahead',
+            type=int,
+            default=3,
+            help='Monthly partitions to keep ready after the current month (default: 3).',
+        )
+        parser.add_argument(
+            '--drop-before-days',
+            type=int,
+            help='Drop the monthly partitions holding only messages older than this many days.',
+        )
+        parser.add_argument(
+            '--detach-only',
+            action='store_true',
+            help='Detach expired partitions but keep them as standalone tables (e.g., to archive).',
+        )
+
+    def handle(self, *args, **options):
+        if not can_partition():
+            raise CommandError('Partitioning is only supported on PostgreSQL.')
+        if options['months_ahead'] < 0:
+            raise CommandError('--months-ahead cannot be negative.')
+        if options['drop_before_days'] is not None and options['drop_before_days'] < 1:
+            raise CommandError('--drop-before-days must be at least 1.')
+
+        if options['convert']:
+            if is_partitioned():
+                self.stdout.write('The messages table is already partitioned.')
+            else:
+                boundary = convert_to_partitioned()
+                self.stdout.write(
+                    self.style.SUCCESS(f'Converted the messages table; monthly partitions start {boundary:%Y-%m}.')
+                )
+        elif not is_partitioned():
+            raise CommandError('The messages table is not partitioned; run with --convert first.')
+
+        created = ensure_partitions(options['months_ahead'])
+        for name in created:
+            self.stdout.write(f'  created {name}')
+        self.stdout.write(self.style.SUCCESS(f'Created {len(created)} partition(s).'))
+
+        if options['drop_before_days'] is not None:
+            cutoff = timezone.now() - timedelta(days=options['drop_before_days'])
+            removed = drop_partitions_before(cutoff, detach_only=options['detach_only'])
+            for name, conversations in removed:
+                self.stdout.write(f'  removed {name} ({conversations} conversation(s) refreshed)')
+            action = 'Detached' if options['detach_only'] else 'Dropped'
+            self.stdout.write(
+                self.style.SUCCESS(f'{action} {len(removed)} partition(s) older than {cutoff:%Y-%m-%d}.')
+            )
+
+        stray = count_default_partition_rows()
+        if stray:
+            self.stdout.write(
+                self.style.WARNING(
+                    f'{stray} message(s) are in the default partition; '
+                    'move them out before creating partitions for their months.'
+                )
+            )
@@ -0,0 +1,87 @@
+"""
+Management command to delete messages older than a retention period.
+Usage: python manage.py purge_old_messages --days 365
+       python manage.py purge_old_messages --days 365 --dry-run
+       python manage.py purge_old_messages --days 365 --batch-size 10000 --sleep 0.1
+
+Messages are deleted in bounded id-range batches, each in its own
+transaction, and unread counters are adjusted as they go. If the command
+is interrupted, run it again: it resumes with whatever is left.
+Conversations themselves are kept. If the messages table is partitioned
+(see partition_messages), monthly partitions that are entirely past the
+cutoff are dropped whole first.
+"""
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from store_app.models import Message
+from store_app.utils.partition_utils import drop_partitions_before, is_partitioned
+from store_app.utils.purge_utils import PURGE_BATCH_SIZE, delete_messages_in_batches
+
+
+class Command(BaseCommand):
+    help = 'Delete messages older than the given number of days. Run periodically (e.g., daily via cron).'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days',
+            type=int,
+            required=True,
+            help='Delete messages created more than this many days ago.',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=PURGE_BATCH_SIZE,
+            help=f'Messages deleted per transaction (default: {PURGE_BATCH_SIZE}).',
+        )
+        parser.add_argument(
+            '--sleep',
+            type=float,
+            default=0,
+            help='Seconds to pause between batches to spare replicas and autovacuum (default: 0).',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Count the messages that would be deleted without deleting them.',
+        )
+
+    def handle(self, *args, **options):
+        if options['days'] < 1:
+            raise CommandError('--days must be at least 1.')
+
+        cutoff = timezone.now() - timedelta(days=options['days'])
+        old_messages = Message.objects.filter(created_at__lt=cutoff)
+
+        if options['dry_run']:
+            self.stdout.write(f'{old_messages.count()} message(s) older than {cutoff:%Y-%m-%d %H:%M} would be deleted.')
+            return
+
+        started = time.monotonic()
+
+        if is_partitioned():
+            for name, _ in drop_partitions_before(cutoff):
+                self.stdout.write(f'  dropped partition {name}')
+
+        def report(deleted):
+            if options['verbosity'] > 1:
+                rate = deleted / max(time.monotonic() - started, 1e-6)
+                self.stdout.write(f'  {deleted} message(s) deleted ({rate:.0f}/s)')
+
+        deleted = delete_messages_in_batches(
+            old_messages,
+            batch_size=options['batch_size'],
+            pause=options['sleep'],
+            on_batch=report,
+        )
+        elapsed = time.monotonic() - started
+        rate = deleted / elapsed if elapsed else deleted
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'Deleted {deleted} message(s) older than {cutoff:%Y-%m-%d %H:%M} in {elapsed:.1f}s ({rate:.0f}/s)'
+            )
+        )
@@ -0,0 +1,75 @@
+"""
+Management command to rebuild the "discussed listings" of conversations from Message.
+Usage: python manage.py rebuild_conversation_mentions
+       python manage.py rebuild_conversation_mentions --batch-size 1000
+"""
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Max, Min
+
+from store_app.models import Conversation, ConversationMention, Message
+
+
+class Command(BaseCommand):
+    help = 'Recompute the products and services mentioned in every conversation'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Number of conversations rebuilt per query batch (default: 500).',
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        started = time.monotonic()
+        conversations = 0
+        mentions = 0
+        last_id = 0
+
+        while True:
+            conversation_ids = list(
+                Conversation.objects.filter(id__gt=last_id)
+                .order_by('id')
+                .values_list('id', flat=True)[:batch_size]
+            )
+            if not conversation_ids:
+                break
+            mentions += self.rebuild_batch(conversation_ids)
+            conversations += len(conversation_ids)
+            last_id = conversation_ids[-1]
+
+        elapsed = time.monotonic() - started
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'Rebuilt {mentions} mention(s) for {conversations} conversation(s) in {elapsed:.1f}s'
+            )
+        )
+
+    def rebuild_batch(self, conversation_ids):
+        """Replace the mentions of a batch of conversations with two grouped reads"""
+        rows = []
+        for field in ('product', 'service'):
+            stats = (
+                Message.objects.filter(conversation_id__in=conversation_ids, **{f'{field}__isnull': False})
+                .order_by()
+                .values('conversation_id', f'{field}_id')
+                .annotate(first=Min('created_at'), last=Max('created_at'))
+            )
+            for row in stats:
+                rows.append(
+                    ConversationMention(
+                        conversation_id=row['conversation_id'],
+                        first_mentioned_at=row['first'],
+                        last_mentioned_at=row['last'],
+                        **{f'{field}_id': row[f'{field}_id']},
+                    )
+                )
+
+        with transaction.atomic():
+            ConversationMention.objects.filter(conversation_id__in=conversation_ids).delete()
+            ConversationMention.objects.bulk_create(rows)
+        return len(rows)
@@ -0,0 +1,76 @@
+"""
+Management command to rebuild the denormalized last-message pointer of every
+conversation (and the participants' copy of its timestamp) from the messages.
+Usage: python manage.py rebuild_last_messages
+       python manage.py rebuild_last_messages --batch-size 1000
+"""
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from store_app.models import Conversation, ConversationParticipantState
+
+
+class Command(BaseCommand):
+    help = 'Recompute the latest message pointer of every conversation from its messages'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Number of conversations rebuilt per query batch (default: 500).',
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        started = time.monotonic()
+        conversations = 0
+        last_id = 0
+
+        while True:
+            conversation_ids = list(
+                Conversation.objects.filter(id__gt=last_id)
+                .order_by('id')
+                .values_list('id', flat=True)[:batch_size]
+            )
+            if not conversation_ids:
+                break
+            conversations += self.rebuild_batch(conversation_ids)
+            last_id = conversation_ids[-1]
+
+        elapsed = time.monotonic() - started
+        self.stdout.write(
+            self.style.SUCCESS(f'Rebuilt {conversations} conversation pointer(s) in {elapsed:.1f}s')
+        )
+
+    def rebuild_batch(self, conversation_ids):
+        """
+        Create missing states for a batch of conversations (the inbox lists
+        conversations through them), then rebuild the pointers
+        """
+        participants = set(
+            Conversation.participants.through.objects.filter(
+                conversation_id__in=conversation_ids
+            ).values_list('conversation_id', 'user_id')
+        )
+        existing = set(
+            ConversationParticipantState.objects.filter(
+                conversation_id__in=conversation_ids
+            ).values_list('conversation_id', 'user_id')
+        )
+        missing = participants - existing
+
+        with transaction.atomic():
+            ConversationParticipantState.objects.bulk_create(
+                [
+                    ConversationParticipantState(user_id=user_id, conversation_id=conversation_id)
+                    for conversation_id, user_id in missing
+                ],
+                ignore_conflicts=True,
+            )
+            if missing:
+                # New states start with nothing read
+                ConversationParticipantState.recount(conversation_ids)
+            return Conversation.rebuild_last_messages(conversation_ids)
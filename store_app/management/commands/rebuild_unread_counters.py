@@ -0,0 +1,66 @@
+"""
+Management command to rebuild the per-participant unread counters from the
+last-read watermarks (messages from the others above a participant's watermark).
+Usage: python manage.py rebuild_unread_counters
+       python manage.py rebuild_unread_counters --batch-size 1000
+"""
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from store_app.models import Conversation, ConversationParticipantState
+
+
+class Command(BaseCommand):
+    help = 'Recompute the unread count of every conversation participant from their last-read watermark'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Number of conversations rebuilt per query batch (default: 500).',
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        started = time.monotonic()
+        conversations = 0
+        states = 0
+        last_id = 0
+
+        while True:
+            conversation_ids = list(
+                Conversation.objects.filter(id__gt=last_id)
+                .order_by('id')
+                .values_list('id', flat=True)[:batch_size]
+            )
+            if not conversation_ids:
+                break
+            states += self.rebuild_batch(conversation_ids)
+            conversations += len(conversation_ids)
+            last_id = conversation_ids[-1]
+
+        elapsed = time.monotonic() - started
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'Rebuilt {states} participant state(s) for {conversations} conversation(s) in {elapsed:.1f}s'
+            )
+        )
+
+    def rebuild_batch(self, conversation_ids):
+        """Create missing states for a batch of conversations, then recount them in one UPDATE"""
+        participants = Conversation.participants.through.objects.filter(
+            conversation_id__in=conversation_ids
+        ).values_list('conversation_id', 'user_id')
+
+        with transaction.atomic():
+            ConversationParticipantState.objects.bulk_create(
+                [
+                    ConversationParticipantState(user_id=user_id, conversation_id=conversation_id)
+                    for conversation_id, user_id in participants
+                ],
+                ignore_conflicts=True,
+            )
+            return ConversationParticipantState.recount(conversation_ids)
@@ -0,0 +1,88 @@
+"""
+Management command to email a digest of unread messages to users who have
+not opened them.
+Usage: python manage.py send_message_digests
+       python manage.py send_message_digests --minutes 120
+       python manage.py send_message_digests --dry-run
+       python manage.py send_message_digests --batch-size 500
+
+Recipients come from one aggregated query and are mailed in batches over a
+single open email connection. Each user's last digest time is recorded, so
+the command can run as often as wanted (e.g., every 15 minutes via cron):
+a user is only emailed again once one of their unread conversations has new
+activity.
+"""
+import time
+from datetime import timedelta
+
+from django.core.mail import get_connection
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from store_app.utils.digest_utils import DIGEST_BATCH_SIZE, get_digest_recipients, send_digest_batch
+
+
+class Command(BaseCommand):
+    help = 'Email users a digest of messages they have left unread'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--minutes',
+            type=int,
+            default=60,
+            help='Only include users with a message unread for at least this many minutes (default: 60).',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=DIGEST_BATCH_SIZE,
+            help=f'Digests sent per batch (default: {DIGEST_BATCH_SIZE}).',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Count the users who would get a digest without emailing them.',
+        )
+
+    def handle(self, *args, **options):
+        if options['minutes'] < 1:
+            raise CommandError('--minutes must be at least 1.')
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1.')
+
+        self.verbosity = options['verbosity']
+        started_at = timezone.now()
+        cutoff = started_at - timedelta(minutes=options['minutes'])
+        recipients = get_digest_recipients(cutoff)
+
+        if options['dry_run']:
+            self.stdout.write(f'{recipients.count()} user(s) would get a digest.')
+            return
+
+        started = time.monotonic()
+        sent = 0
+        failed = 0
+        batch = []
+        connection = get_connection()
+        connection.open()
+        try:
+            for recipient in recipients.iterator(chunk_size=options['batch_size']):
+                batch.append(recipient)
+                if len(batch) == options['batch_size']:
+                    sent, failed = self.send_batch(connection, batch, started_at, cutoff, sent, failed)
+                    batch = []
+            if batch:
+                sent, failed = self.send_batch(connection, batch, started_at, cutoff, sent, failed)
+        finally:
+            connection.close()
+
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(f'Sent {sent} digest(s) in {elapsed:.1f}s'))
+        if failed:
+            self.stdout.write(self.style.WARNING(f'{failed} digest(s) failed; they are retried on the next run.'))
+
+    def send_batch(self, connection, batch, sent_at, cutoff, sent, failed):
+        batch_sent = send_digest_batch(connection, batch, sent_at, cutoff)
+        if self.verbosity > 1:
+            self.stdout.write(f'  {sent + batch_sent} digest(s) sent')
+        return sent + batch_sent, failed + len(batch) - batch_sent
@@ -0,0 +1,66 @@
+# Generated by Django 5.0.14 on 2026-10-17 01:21
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Max, Q
+
+
+def backfill_participant_states(apps, schema_editor):
+    """Build the read state of every existing conversation participant from Message"""
+    Conversation = apps.get_model('store_app', 'Conversation')
+    Message = apps.get_model('store_app', 'Message')
+    ConversationParticipantState = apps.get_model('store_app', 'ConversationParticipantState')
+
+    received = {}
+    sender_stats = (
+        Message.objects.order_by()
+        .values('conversation_id', 'sender_id')
+        .annotate(
+            unread=Count('id', filter=Q(is_read=False)),
+            last_read=Max('id', filter=Q(is_read=True)),
+        )
+    )
+    for row in sender_stats:
+        received.setdefault(row['conversation_id'], []).append(row)
+
+    states = []
+    participants = Conversation.participants.through.objects.values_list('conversation_id', 'user_id')
+    for conversation_id, user_id in participants.iterator():
+        rows = [r for r in received.get(conversation_id, []) if r['sender_id'] != user_id]
+        states.append(
+            ConversationParticipantState(
+                user_id=user_id,
+                conversation_id=conversation_id,
+                unread_count=sum(r['unread'] for r in rows),
+                last_read_message_id=max((r['last_read'] or 0 for r in rows), default=0),
+            )
+        )
+    ConversationParticipantState.objects.bulk_create(states, batch_size=1000, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store_app', '0013_increase_discount_max_digits'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConversationParticipantState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('unread_count', models.PositiveIntegerField(default=0)),
+                ('last_read_message_id', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('conversation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='participant_states', to='store_app.conversation')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='conversation_states', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='conversationparticipantstate',
+            constraint=models.UniqueConstraint(fields=('user', 'conversation'), name='unique_participant_state'),
+        ),
+        migrations.RunPython(backfill_participant_states, migrations.RunPython.noop),
+    ]
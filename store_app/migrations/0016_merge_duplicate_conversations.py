@@ -0,0 +1,84 @@
+from collections import defaultdict
+
+from django.db import migrations
+from django.db.models import Count, Max, Q
+
+
+def merge_duplicate_conversations(apps, schema_editor):
+    """
+    Fill the canonical (user_low, user_high) pair of every two-party
+    conversation and fold duplicate conversations of the same pair into the
+    oldest one, so the unique pair constraint can be added.
+    """
+    Conversation = apps.get_model('store_app', 'Conversation')
+    Message = apps.get_model('store_app', 'Message')
+    ConversationParticipantState = apps.get_model('store_app', 'ConversationParticipantState')
+
+    participants = defaultdict(list)
+    rows = Conversation.participants.through.objects.order_by('conversation_id', 'user_id')
+    for conversation_id, user_id in rows.values_list('conversation_id', 'user_id').iterator():
+        participants[conversation_id].append(user_id)
+
+    pairs = defaultdict(list)
+    for conversation_id, user_ids in participants.items():
+        if len(user_ids) == 2:
+            pairs[tuple(user_ids)].append(conversation_id)
+
+    for (user_low_id, user_high_id), conversation_ids in pairs.items():
+        keeper_id, *duplicate_ids = sorted(conversation_ids)
+        if duplicate_ids:
+            merge_into(Conversation, Message, ConversationParticipantState, keeper_id, duplicate_ids)
+        Conversation.objects.filter(id=keeper_id).update(user_low_id=user_low_id, user_high_id=user_high_id)
+
+
+def merge_into(Conversation, Message, ConversationParticipantState, keeper_id, duplicate_ids):
+    group = Conversation.objects.filter(id__in=[keeper_id, *duplicate_ids])
+    keeper = Conversation.objects.get(id=keeper_id)
+
+    # Keep the listing the chat started from, falling back to a duplicate's
+    updates = {'updated_at': group.aggregate(latest=Max('updated_at'))['latest']}
+    if keeper.product_id is None and keeper.service_id is None:
+        listing = (
+            group.filter(Q(product__isnull=False) | Q(service__isnull=False))
+            .order_by('id')
+            .values('product_id', 'service_id')
+            .first()
+        )
+        if listing:
+            updates.update(listing)
+
+    Message.objects.filter(conversation_id__in=duplicate_ids).update(conversation_id=keeper_id)
+    Conversation.objects.filter(id=keeper_id).update(**updates)
+
+    # Participant states of the merged chat are recomputed from its messages
+    ConversationParticipantState.objects.filter(conversation_id__in=duplicate_ids).delete()
+    sender_stats = (
+        Message.objects.filter(conversation_id=keeper_id)
+        .order_by()
+        .values('sender_id')
+        .annotate(
+            unread=Count('id', filter=Q(is_read=False)),
+            last_read=Max('id', filter=Q(is_read=True)),
+        )
+    )
+    sender_stats = list(sender_stats)
+    for state in ConversationParticipantState.objects.filter(conversation_id=keeper_id):
+        received = [r for r in sender_stats if r['sender_id'] != state.user_id]
+        state.unread_count = sum(r['unread'] for r in received)
+        state.last_read_message_id = max((r['last_read'] or 0 for r in received), default=0)
+        state.save(update_fields=['unread_count', 'last_read_message_id'])
+
+    Conversation.objects.filter(id__in=duplicate_ids).delete()
+
+
+class Migration(migrations.Migration):
+    # Kept apart from the schema changes: PostgreSQL refuses to ALTER a table
+    # with pending deferred foreign key checks in the same transaction
+
+    dependencies = [
+        ('store_app', '0015_conversation_pair_key'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_conversations, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,40 @@
+from django.db import migrations
+
+# Kept outside the model: a generated tsvector column and a GIN index only
+# exist on PostgreSQL, and the SQLite test database searches with LIKE.
+# Adding a stored generated column rewrites store_app_message once.
+CREATE_SEARCH_VECTOR = [
+    """
+    ALTER TABLE store_app_message
+    ADD COLUMN IF NOT EXISTS search_vector tsvector
+    GENERATED ALWAYS AS (to_tsvector('simple', coalesce(content, ''))) STORED
+    """,
+    "CREATE INDEX IF NOT EXISTS message_search_vector_idx ON store_app_message USING GIN (search_vector)",
+]
+DROP_SEARCH_VECTOR = [
+    "DROP INDEX IF EXISTS message_search_vector_idx",
+    "ALTER TABLE store_app_message DROP COLUMN IF EXISTS search_vector",
+]
+
+
+def run_on_postgresql(statements):
+    def run(apps, schema_editor):
+        if schema_editor.connection.vendor != 'postgresql':
+            return
+        for statement in statements:
+            schema_editor.execute(statement)
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store_app', '0018_message_history_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            run_on_postgresql(CREATE_SEARCH_VECTOR),
+            run_on_postgresql(DROP_SEARCH_VECTOR),
+        ),
+    ]
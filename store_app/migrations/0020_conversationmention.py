@@ -0,0 +1,67 @@
+# Generated by Django 5.0.14 on 2026-10-17 01:33
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Max, Min
+
+
+def backfill_conversation_mentions(apps, schema_editor):
+    """Build the mention list of every existing conversation from Message"""
+    Message = apps.get_model('store_app', 'Message')
+    ConversationMention = apps.get_model('store_app', 'ConversationMention')
+
+    mentions = []
+    for field in ('product', 'service'):
+        rows = (
+            Message.objects.filter(**{f'{field}__isnull': False})
+            .order_by()
+            .values('conversation_id', f'{field}_id')
+            .annotate(first=Min('created_at'), last=Max('created_at'))
+        )
+        for row in rows.iterator():
+            mentions.append(
+                ConversationMention(
+                    conversation_id=row['conversation_id'],
+                    first_mentioned_at=row['first'],
+                    last_mentioned_at=row['last'],
+                    **{f'{field}_id': row[f'{field}_id']},
+                )
+            )
+    ConversationMention.objects.bulk_create(mentions, batch_size=1000, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store_app', '0019_message_search_vector'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConversationMention',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('first_mentioned_at', models.DateTimeField()),
+                ('last_mentioned_at', models.DateTimeField()),
+                ('conversation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='mentions', to='store_app.conversation')),
+                ('product', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='conversation_mentions', to='store_app.product')),
+                ('service', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='conversation_mentions', to='store_app.service')),
+            ],
+            options={
+                'ordering': ['first_mentioned_at', 'id'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='conversationmention',
+            constraint=models.UniqueConstraint(fields=('conversation', 'product'), name='unique_conversation_product_mention'),
+        ),
+        migrations.AddConstraint(
+            model_name='conversationmention',
+            constraint=models.UniqueConstraint(fields=('conversation', 'service'), name='unique_conversation_service_mention'),
+        ),
+        migrations.AddConstraint(
+            model_name='conversationmention',
+            constraint=models.CheckConstraint(check=models.Q(models.Q(('product__isnull', False), ('service__isnull', True)), models.Q(('product__isnull', True), ('service__isnull', False)), _connector='OR'), name='mention_is_product_or_service'),
+        ),
+        migrations.RunPython(backfill_conversation_mentions, migrations.RunPython.noop),
+    ]
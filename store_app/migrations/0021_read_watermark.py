@@ -0,0 +1,59 @@
+# Generated by Django 5.0.14 on 2026-10-17 01:39
+
+from django.db import migrations, models
+from django.db.models import Count, Max, OuterRef, Subquery
+from django.db.models.functions import Coalesce, Greatest
+
+
+def move_read_state_to_watermarks(apps, schema_editor):
+    """
+    Fold Message.is_read/read_at into each participant's watermark: it moves
+    up to the last message they had read, and the unread counter becomes the
+    number of messages from the others above it.
+    """
+    Message = apps.get_model('store_app', 'Message')
+    ConversationParticipantState = apps.get_model('store_app', 'ConversationParticipantState')
+
+    received = Message.objects.filter(conversation_id=OuterRef('conversation_id')).exclude(
+        sender_id=OuterRef('user_id')
+    )
+    read = received.filter(is_read=True).order_by().values('conversation_id')
+    ConversationParticipantState.objects.update(
+        last_read_message_id=Greatest(
+            'last_read_message_id',
+            Coalesce(Subquery(read.annotate(last=Max('id')).values('last')), 0),
+        ),
+        last_read_at=Subquery(read.annotate(last=Max('read_at')).values('last')),
+    )
+    unread = (
+        received.filter(id__gt=OuterRef('last_read_message_id'))
+        .order_by()
+        .values('conversation_id')
+        .annotate(count=Count('id'))
+        .values('count')
+    )
+    ConversationParticipantState.objects.update(unread_count=Coalesce(Subquery(unread), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store_app', '0020_conversationmention'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversationparticipantstate',
+            name='last_read_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(move_read_state_to_watermarks, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='message',
+            name='is_read',
+        ),
+        migrations.RemoveField(
+            model_name='message',
+            name='read_at',
+        ),
+    ]
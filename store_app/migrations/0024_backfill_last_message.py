@@ -0,0 +1,48 @@
+# Generated by Django 5.0.14 on 2026-10-17 02:09
+
+from django.db import migrations
+from django.db.models import OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce, Substr
+
+# Conversation.last_message_preview max_length at the time of this migration
+PREVIEW_LENGTH = 120
+
+
+def backfill_last_messages(apps, schema_editor):
+    """
+    Point every conversation at its latest message, then copy its time (or
+    the conversation's creation time) to the participants' state rows.
+    """
+    Conversation = apps.get_model('store_app', 'Conversation')
+    ConversationParticipantState = apps.get_model('store_app', 'ConversationParticipantState')
+    Message = apps.get_model('store_app', 'Message')
+
+    latest = Message.objects.filter(conversation_id=OuterRef('pk')).order_by('-id')
+    Conversation.objects.update(
+        last_message_id=Coalesce(Subquery(latest.values('id')[:1]), 0),
+        last_message_at=Subquery(latest.values('created_at')[:1]),
+        last_message_preview=Coalesce(
+            Subquery(
+                latest.annotate(preview=Substr('content', 1, PREVIEW_LENGTH)).values('preview')[:1]
+            ),
+            Value(''),
+        ),
+    )
+    ConversationParticipantState.objects.update(
+        last_message_at=Subquery(
+            Conversation.objects.filter(pk=OuterRef('conversation_id'))
+            .annotate(at=Coalesce('last_message_at', 'created_at'))
+            .values('at')[:1]
+        )
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store_app', '0023_conversation_last_message'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_last_messages, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.14 on 2026-10-17 02:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store_app', '0024_backfill_last_message'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userprofile',
+            name='message_digest_sent_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
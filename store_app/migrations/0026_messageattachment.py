@@ -0,0 +1,35 @@
+# Generated by Django 5.0.14 on 2026-10-17 02:37
+
+import django.db.models.deletion
+import store_app.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store_app', '0025_userprofile_message_digest_sent_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageAttachment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('file', models.FileField(max_length=255, upload_to=store_app.models.message_attachment_path)),
+                ('kind', models.CharField(choices=[('image', 'Image'), ('pdf', 'PDF')], max_length=10)),
+                ('content_type', models.CharField(max_length=100)),
+                ('size', models.PositiveBigIntegerField()),
+                ('original_name', models.CharField(max_length=255)),
+                ('thumbnail', models.ImageField(blank=True, max_length=255, null=True, upload_to=store_app.models.message_attachment_path)),
+                ('thumbnail_status', models.CharField(choices=[('pending', 'Pending'), ('ready', 'Ready'), ('failed', 'Failed'), ('none', 'None')], default='pending', max_length=10)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('conversation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='attachments', to='store_app.conversation')),
+                ('message', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='attachments', to='store_app.message')),
+            ],
+            options={
+                'ordering': ['id'],
+                'indexes': [models.Index(condition=models.Q(('thumbnail_status', 'pending')), fields=['id'], name='attachment_pending_thumb_idx')],
+            },
+        ),
+    ]
@@ -1,12 +1,16 @@
-from django.db import models
+from django.db import IntegrityError, models, transaction
 from decimal import Decimal
 from django.utils import timezone
 from django.contrib.auth.hashers import make_password
 from django.core.validators import RegexValidator
 from django.contrib.auth.models import User
-from django.db.models.signals import post_save
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
 from django.dispatch import receiver
+from django.db.models import Case, Count, OuterRef, Subquery, Value, When
+from django.db.models.functions import Coalesce, Greatest, Substr
 from django.core.validators import MinValueValidator, MaxValueValidator
+import os
+import uuid
 
 class UserProfile(models.Model):
     # Link to Django's built-in User (for authentication)
@@ -25,6 +29,9 @@ class UserProfile(models.Model):
     email_token_expires_at = models.DateTimeField(blank=True, null=True)
     verified_at = models.DateTimeField(blank=True, null=True)
 
+    # Last unread-message digest email (see the send_message_digests command)
+    message_digest_sent_at = models.DateTimeField(blank=True, null=True)
+
     # Timestamps
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -32,6 +39,14 @@ class UserProfile(models.Model):
     def __str__(self):
         return f"{self.user.email} Profile"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Lets saves tell whether the picture shown in inboxes changed
+        if 'profile_picture' in instance.__dict__:
+            instance._loaded_profile_picture = str(instance.profile_picture or '')
+        return instance
+
     def mark_verified(self):
         self.pending_email_verification = False
         self.verified_at = timezone.now()
@@ -368,6 +383,11 @@ class PurchaseHistory(models.Model):
         verbose_name_plural = "Purchase Histories"
 
 
+# Characters of the latest message kept on Conversation for the inbox, which
+# shows at most 100 of them
+LAST_MESSAGE_PREVIEW_LENGTH = 120
+
+
 class Conversation(models.Model):
     """Represents a conversation between two users"""
     participants = models.ManyToManyField(User, related_name='conversations')
@@ -378,8 +398,22 @@ class Conversation(models.Model):
     product = models.ForeignKey(Product, on_delete=models.SET_NULL, null=True, blank=True, related_name='conversations')
     service = models.ForeignKey(Service, on_delete=models.SET_NULL, null=True, blank=True, related_name='conversations')
     
+    # Canonical participant pair (lower user id first); unique, so one
+    # indexed lookup finds a chat and concurrent creates can't duplicate it
+    user_low = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    user_high = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+
+    # Latest message, denormalized so the inbox never reads Message. The id
+    # is a plain pointer (0 = no messages), like the read watermarks.
+    last_message_id = models.BigIntegerField(default=0)
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    last_message_preview = models.CharField(max_length=LAST_MESSAGE_PREVIEW_LENGTH, blank=True, default='')
+    
     class Meta:
         ordering = ['-updated_at']
+        constraints = [
+            models.UniqueConstraint(fields=['user_low', 'user_high'], name='unique_conversation_pair'),
+        ]
     
     def __str__(self):
         participant_names = [p.get_full_name() or p.username for p in self.participants.all()]
@@ -391,23 +425,90 @@ class Conversation(models.Model):
     
     def get_latest_message(self):
         """Get the latest message in this conversation"""
-        return self.messages.last()
+        if not self.last_message_id:
+            return None
+        return Message.objects.filter(id=self.last_message_id).first()
+
+    @classmethod
+    def record_new_message(cls, message):
+        """Point the conversation at a new message and bump it, in one UPDATE"""
+        pointer = {
+            'last_message_id': message.id,
+            'last_message_at': message.created_at,
+            'last_message_preview': message.content[:LAST_MESSAGE_PREVIEW_LENGTH],
+            'updated_at': timezone.now(),
+        }
+        # A message committed late must not move the pointer backwards
+        moved = cls.objects.filter(id=message.conversation_id, last_message_id__lt=message.id).update(
+            **pointer
+        )
+        # Keep the instance the message was created with in step
+        if moved and Message.conversation.is_cached(message):
+            for field, value in pointer.items():
+                setattr(message.conversation, field, value)
+
+    @classmethod
+    def rebuild_last_messages(cls, conversation_ids):
+        """
+        Recompute the last-message pointers of the given conversations, and
+        the participants' copy of last_message_at, from their messages
+        """
+        latest = Message.objects.filter(conversation_id=OuterRef('pk')).order_by('-id')
+        updated = cls.objects.filter(id__in=conversation_ids).update(
+            last_message_id=Coalesce(Subquery(latest.values('id')[:1]), 0),
+            last_message_at=Subquery(latest.values('created_at')[:1]),
+            last_message_preview=Coalesce(
+                Subquery(
+                    latest.annotate(
+                        preview=Substr('content', 1, LAST_MESSAGE_PREVIEW_LENGTH)
+                    ).values('preview')[:1]
+                ),
+                Value(''),
+            ),
+        )
+        from .utils.inbox_utils import invalidate_inbox_cache
+
+        states = ConversationParticipantState.objects.filter(conversation_id__in=conversation_ids)
+        invalidate_inbox_cache(states.values_list('user_id', flat=True))
+        states.update(
+            last_message_at=Subquery(
+                cls.objects.filter(pk=OuterRef('conversation_id'))
+                .annotate(at=Coalesce('last_message_at', 'created_at'))
+                .values('at')[:1]
+            )
+        )
+        return updated
     
     @classmethod
-    def get_or_create_conversation(cls, user1, user2):
-        """Get existing conversation between two users or create a new one"""
-        # Check if conversation already exists
-        existing = cls.objects.filter(participants=user1).filter(participants=user2).first()
+    def get_or_create_conversation(cls, user1, user2, before_create=None):
+        """
+        Get existing conversation between two users or create a new one.
+        `before_create()` runs only when a conversation is about to be
+        created, and may raise to prevent it.
+        """
+        user_low_id, user_high_id = sorted((user1.id, user2.id))
+
+        # Common case: one lookup on the unique pair index
+        existing = cls.objects.filter(user_low_id=user_low_id, user_high_id=user_high_id).first()
         if existing:
             return existing, False
-        
-        # Create new conversation
-        conversation = cls.objects.create()
-        conversation.participants.add(user1, user2)
-        # Explicitly save to ensure it's persisted
-        conversation.save()
-        # Refresh from DB to ensure participants are loaded
-        conversation.refresh_from_db()
+
+        if before_create:
+            before_create()
+        try:
+            with transaction.atomic():
+                conversation = cls.objects.create(user_low_id=user_low_id, user_high_id=user_high_id)
+                conversation.participants.add(user1, user2)
+                ConversationParticipantState.objects.bulk_create(
+                    [
+                        ConversationParticipantState(user=user1, conversation=conversation),
+                        ConversationParticipantState(user=user2, conversation=conversation),
+                    ],
+                    ignore_conflicts=True,
+                )
+        except IntegrityError:
+            # A concurrent request created the pair first; use theirs
+            return cls.objects.get(user_low_id=user_low_id, user_high_id=user_high_id), False
         return conversation, True
 
 
@@ -417,25 +518,422 @@ class Message(models.Model):
     sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='sent_messages')
     content = models.TextField()
     created_at = models.DateTimeField(auto_now_add=True)
-    is_read = models.BooleanField(default=False)
-    read_at = models.DateTimeField(null=True, blank=True)
     
     # Optional: Link to a product or service if the message is about a specific listing
     product = models.ForeignKey('Product', on_delete=models.SET_NULL, null=True, blank=True, related_name='messages')
     service = models.ForeignKey('Service', on_delete=models.SET_NULL, null=True, blank=True, related_name='messages')
+
+    # Idempotency key chosen by the sending client; a retried send with the
+    # same key returns the stored message instead of creating another one
+    client_key = models.CharField(max_length=64, null=True, blank=True, editable=False)
     
     class Meta:
         ordering = ['created_at']
+        indexes = [
+            # History pages seek on (created_at, id); polls and streams on id
+            models.Index(fields=['conversation', 'created_at', 'id'], name='message_conv_created_idx'),
+            models.Index(fields=['conversation', 'id'], name='message_conv_id_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=['conversation', 'sender', 'client_key'],
+                condition=models.Q(client_key__isnull=False),
+                name='unique_message_client_key',
+            ),
+        ]
     
     def __str__(self):
         return f"Message from {self.sender.get_full_name() or self.sender.username} in {self.conversation}"
     
+    # Read state is not stored per message: each participant has a last-read
+    # watermark (ConversationParticipantState.last_read_message_id) and a
+    # message is read once its recipient's watermark reaches it. is_read and
+    # read_watermark_at are derived, read-only views of that; when a single
+    # message was read is not recorded.
+
+    def _recipient_states(self):
+        return ConversationParticipantState.objects.filter(
+            conversation_id=self.conversation_id, last_read_message_id__gte=self.pk
+        ).exclude(user_id=self.sender_id)
+
+    @property
+    def is_read(self):
+        """Whether the recipient's last-read watermark has reached this message"""
+        if self.pk is None:
+            return False
+        return self._recipient_states().exists()
+
+    @is_read.setter
+    def is_read(self, value):
+        # Accepted so Message(is_read=False) keeps working; use mark_as_read()
+        if value:
+            raise ValueError("Read state is derived; use Message.mark_as_read()")
+
+    @property
+    def read_watermark_at(self):
+        """
+        When the recipient's last-read watermark last moved, if it has reached
+        this message (None otherwise). Reading a later message moves it again,
+        so this is not the time this message was read.
+        """
+        if self.pk is None:
+            return None
+        return (
+            self._recipient_states()
+            .order_by('last_read_at')
+            .values_list('last_read_at', flat=True)
+            .first()
+        )
+
     def mark_as_read(self):
-        """Mark the message as read"""
+        """Mark the message (and everything before it) as read for its recipients"""
         if not self.is_read:
-            self.is_read = True
-            self.read_at = timezone.now()
-            self.save()
+            recipient_ids = Conversation.participants.through.objects.filter(
+                conversation_id=self.conversation_id
+            ).exclude(user_id=self.sender_id).values_list('user_id', flat=True)
+            for user_id in recipient_ids:
+                ConversationParticipantState.mark_read(user_id, self.conversation_id, self.id)
+
+
+class ConversationParticipantState(models.Model):
+    """
+    Per-participant read state of a conversation.
+
+    The last-read watermark is the source of truth for read state: every
+    message of the conversation with an id up to last_read_message_id is
+    read by this user. unread_count denormalizes the number of messages
+    from the other participants above the watermark, so unread badges are
+    an indexed sum instead of a scan over the message history.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='conversation_states')
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='participant_states')
+    unread_count = models.PositiveIntegerField(default=0)
+    last_read_message_id = models.BigIntegerField(default=0)
+    last_read_at = models.DateTimeField(null=True, blank=True)
+    # Copy of Conversation.last_message_at (when the row was created, until
+    # there is a message), so a user's inbox is one ordered index range
+    last_message_at = models.DateTimeField(default=timezone.now)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'conversation'], name='unique_participant_state'),
+        ]
+        indexes = [
+            models.Index(fields=['user', '-last_message_at'], name='state_user_last_message_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.user} in conversation {self.conversation_id}: {self.unread_count} unread"
+
+    @classmethod
+    def ensure_for_conversation(cls, conversation_id):
+        """Create missing state rows for a conversation; new rows have read nothing yet"""
+        existing = set(
+            cls.objects.filter(conversation_id=conversation_id).values_list('user_id', flat=True)
+        )
+        participant_ids = Conversation.participants.through.objects.filter(
+            conversation_id=conversation_id
+        ).values_list('user_id', flat=True)
+        missing = [user_id for user_id in participant_ids if user_id not in existing]
+        if not missing:
+            return
+        conversation = Conversation.objects.only('created_at', 'last_message_at').get(id=conversation_id)
+        messages = Message.objects.filter(conversation_id=conversation_id)
+        cls.objects.bulk_create(
+            [
+                cls(
+                    user_id=user_id,
+                    conversation_id=conversation_id,
+                    unread_count=messages.exclude(sender_id=user_id).count(),
+                    last_message_at=conversation.last_message_at or conversation.created_at,
+                )
+                for user_id in missing
+            ],
+            ignore_conflicts=True,
+        )
+
+    @classmethod
+    def record_new_message(cls, message):
+        """
+        Count a new unread message for every participant except its sender,
+        and move everyone's last_message_at, in one UPDATE
+        """
+        with transaction.atomic():
+            states = cls.objects.filter(conversation_id=message.conversation_id)
+            # A watermark already past this id (a message committed late) has read it
+            counts_as_unread = ~models.Q(user_id=message.sender_id) & models.Q(
+                last_read_message_id__lt=message.id
+            )
+            updated = states.update(
+                unread_count=Case(
+                    When(counts_as_unread, then=models.F('unread_count') + 1),
+                    default=models.F('unread_count'),
+                    output_field=models.PositiveIntegerField(),
+                ),
+                last_message_at=Greatest('last_message_at', Value(message.created_at)),
+                updated_at=timezone.now(),
+            )
+            recipients = states.exclude(user_id=message.sender_id)
+            if updated < 2 and not recipients.exists():
+                # Conversation created outside get_or_create_conversation;
+                # the rows are created with this message already counted
+                cls.ensure_for_conversation(message.conversation_id)
+
+    @classmethod
+    def mark_read(cls, user, conversation_id, up_to_message_id=None):
+        """
+        Move `user`'s last-read watermark forward to `up_to_message_id`
+        (default: the latest message of the conversation).
+
+        This is a single-row UPDATE: the messages it passes are counted in a
+        correlated subquery and taken off the unread counter, and no Message
+        row is written. Returns True if the watermark moved.
+        """
+        messages = Message.objects.filter(conversation_id=conversation_id)
+        if up_to_message_id is None:
+            up_to_message_id = messages.order_by('-id').values_list('id', flat=True).first()
+            if up_to_message_id is None:
+                return False
+
+        passed = (
+            messages.filter(id__gt=OuterRef('last_read_message_id'), id__lte=up_to_message_id)
+            .exclude(sender_id=OuterRef('user_id'))
+            .order_by()
+            .values('conversation_id')
+            .annotate(count=Count('id'))
+            .values('count')
+        )
+        now = timezone.now()
+        states = cls.objects.filter(user=user, conversation_id=conversation_id)
+        updated = states.filter(last_read_message_id__lt=up_to_message_id).update(
+            unread_count=Greatest(
+                models.F('unread_count') - Coalesce(Subquery(passed), 0), 0
+            ),
+            last_read_message_id=up_to_message_id,
+            last_read_at=now,
+            updated_at=now,
+        )
+        if updated == 0 and not states.exists():
+            # Rows missing for a participant are created once; a user who is
+            # not a participant still has none, and has nothing to mark
+            cls.ensure_for_conversation(conversation_id)
+            if not states.exists():
+                return False
+            return cls.mark_read(user, conversation_id, up_to_message_id)
+        if updated:
+            from .utils.inbox_utils import invalidate_inbox_cache
+
+            invalidate_inbox_cache([getattr(user, 'pk', user)])
+        return updated > 0
+
+    @classmethod
+    def recount(cls, conversation_ids):
+        """Recompute the unread counters of the given conversations from their watermarks"""
+        unread = (
+            Message.objects.filter(
+                conversation_id=OuterRef('conversation_id'),
+                id__gt=OuterRef('last_read_message_id'),
+            )
+            .exclude(sender_id=OuterRef('user_id'))
+            .order_by()
+            .values('conversation_id')
+            .annotate(count=Count('id'))
+            .values('count')
+        )
+        from .utils.inbox_utils import invalidate_inbox_cache
+
+        states = cls.objects.filter(conversation_id__in=conversation_ids)
+        invalidate_inbox_cache(states.values_list('user_id', flat=True))
+        return states.update(unread_count=Coalesce(Subquery(unread), 0), updated_at=timezone.now())
+
+    @classmethod
+    def total_unread(cls, user):
+        """Unread messages across all of the user's conversations"""
+        total = cls.objects.filter(user=user, unread_count__gt=0).aggregate(
+            total=models.Sum('unread_count')
+        )['total']
+        return total or 0
+
+
+class ConversationMention(models.Model):
+    """
+    A product or service discussed in a conversation (the "Discussed" list).
+
+    One row per listing per conversation, kept up to date as messages are
+    sent, so listing what a chat is about never scans its messages.
+    """
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='mentions')
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, null=True, blank=True, related_name='conversation_mentions')
+    service = models.ForeignKey(Service, on_delete=models.CASCADE, null=True, blank=True, related_name='conversation_mentions')
+    first_mentioned_at = models.DateTimeField()
+    last_mentioned_at = models.DateTimeField()
+
+    class Meta:
+        ordering = ['first_mentioned_at', 'id']
+        constraints = [
+            # NULLs never collide, so product and service rows share the table
+            models.UniqueConstraint(fields=['conversation', 'product'], name='unique_conversation_product_mention'),
+            models.UniqueConstraint(fields=['conversation', 'service'], name='unique_conversation_service_mention'),
+            models.CheckConstraint(
+                check=(
+                    models.Q(product__isnull=False, service__isnull=True)
+                    | models.Q(product__isnull=True, service__isnull=False)
+                ),
+                name='mention_is_product_or_service',
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.product or self.service} in {self.conversation}"
+
+    @classmethod
+    def record_message(cls, message):
+        """Add or refresh the mentions of a newly sent message"""
+        for field in ('product', 'service'):
+            listing_id = getattr(message, f'{field}_id')
+            if listing_id is None:
+                continue
+            cls.objects.bulk_create(
+                [
+                    cls(
+                        conversation_id=message.conversation_id,
+                        first_mentioned_at=message.created_at,
+                        last_mentioned_at=message.created_at,
+                        **{f'{field}_id': listing_id},
+                    )
+                ],
+                update_conflicts=True,
+                unique_fields=['conversation', field],
+                update_fields=['last_mentioned_at'],
+            )
+
+
+def message_attachment_path(instance, filename):
+    """Random file name: attachments are only meant to be reached through their conversation"""
+    extension = os.path.splitext(filename)[1].lower()[:10]
+    return f"uploads/message_attachments/{timezone.now():%Y/%m}/{uuid.uuid4().hex}{extension}"
+
+
+class MessageAttachment(models.Model):
+    """
+    An image or PDF sent with a message.
+
+    The upload request only stores the file; thumbnails are made later by
+    the generate_attachment_thumbnails worker (thumbnail_status tracks
+    them). The message key has no database constraint and does not
+    cascade: a partitioned messages table (see utils/partition_utils.py)
+    cannot be referenced by id alone, and message purges remove their
+    attachments themselves (see utils/purge_utils.py). The conversation is
+    kept too, so access checks never read Message.
+    """
+    KIND_IMAGE = 'image'
+    KIND_PDF = 'pdf'
+    KIND_CHOICES = [(KIND_IMAGE, 'Image'), (KIND_PDF, 'PDF')]
+
+    THUMBNAIL_PENDING = 'pending'
+    THUMBNAIL_READY = 'ready'
+    THUMBNAIL_FAILED = 'failed'
+    # PDFs are shown with an icon instead
+    THUMBNAIL_NONE = 'none'
+    THUMBNAIL_STATUS_CHOICES = [
+        (THUMBNAIL_PENDING, 'Pending'),
+        (THUMBNAIL_READY, 'Ready'),
+        (THUMBNAIL_FAILED, 'Failed'),
+        (THUMBNAIL_NONE, 'None'),
+    ]
+
+    message = models.ForeignKey(
+        Message, on_delete=models.DO_NOTHING, db_constraint=False, related_name='attachments'
+    )
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='attachments')
+    file = models.FileField(upload_to=message_attachment_path, max_length=255)
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    content_type = models.CharField(max_length=100)
+    size = models.PositiveBigIntegerField()
+    original_name = models.CharField(max_length=255)
+    thumbnail = models.ImageField(upload_to=message_attachment_path, max_length=255, blank=True, null=True)
+    thumbnail_status = models.CharField(
+        max_length=10, choices=THUMBNAIL_STATUS_CHOICES, default=THUMBNAIL_PENDING
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['id']
+        indexes = [
+            # The thumbnail worker's queue
+            models.Index(
+                fields=['id'],
+                condition=models.Q(thumbnail_status='pending'),
+                name='attachment_pending_thumb_idx',
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.original_name} in {self.conversation}"
+
+
+@receiver(post_delete, sender=MessageAttachment)
+def delete_attachment_files(sender, instance, **kwargs):
+    """Remove the stored files once the row's deletion commits"""
+    files = [field for field in (instance.file, instance.thumbnail) if field]
+
+    def delete_files():
+        for field in files:
+            try:
+                field.storage.delete(field.name)
+            except OSError:
+                pass
+
+    transaction.on_commit(delete_files)
+
+
+@receiver(post_save, sender=Message)
+def publish_new_message(sender, instance, created, **kwargs):
+    """Push new messages to realtime subscribers once the transaction commits"""
+    if created:
+        from .utils.inbox_utils import get_conversation_participant_ids, invalidate_inbox_cache
+        from .utils.message_utils import publish_message
+
+        Conversation.record_new_message(instance)
+        ConversationParticipantState.record_new_message(instance)
+        if instance.product_id or instance.service_id:
+            ConversationMention.record_message(instance)
+        invalidate_inbox_cache(get_conversation_participant_ids([instance.conversation_id]))
+        transaction.on_commit(lambda: publish_message(instance))
+
+
+@receiver(post_save, sender=Conversation)
+def invalidate_conversation_inboxes(sender, instance, created, **kwargs):
+    # New conversations show up once participants are added (m2m_changed)
+    if not created:
+        from .utils.inbox_utils import get_conversation_participant_ids, invalidate_inbox_cache
+
+        invalidate_inbox_cache(get_conversation_participant_ids([instance.pk]))
+
+
+@receiver(m2m_changed, sender=Conversation.participants.through)
+def invalidate_participant_inboxes(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Conversations appear in (or leave) the inboxes of the users added (or
+    removed); added users get their participant state right away
+    """
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    from .utils.inbox_utils import get_conversation_participant_ids, invalidate_inbox_cache
+
+    conversation_ids = (pk_set or ()) if reverse else [instance.pk]
+    if action == 'post_add':
+        # The inbox lists conversations through their participant states
+        for conversation_id in conversation_ids:
+            ConversationParticipantState.ensure_for_conversation(conversation_id)
+
+    if reverse:
+        # user.conversations.add(...): the user, plus whoever is already in them
+        user_ids = {instance.pk} | get_conversation_participant_ids(conversation_ids)
+    else:
+        user_ids = set(pk_set or ()) | get_conversation_participant_ids(conversation_ids)
+    invalidate_inbox_cache(user_ids)
 
 
 # Signal to automatically create profile when User is created
@@ -451,6 +949,58 @@ def save_user_profile(sender, instance, **kwargs):
         instance.profile.save()
 
 
+@receiver(pre_delete, sender=User)
+def collect_sent_message_conversations(sender, instance, **kwargs):
+    """
+    A deleted user's messages cascade away; note the conversations they
+    were in so their counters can be fixed, and drop their attachments
+    (which do not cascade from Message)
+    """
+    sent = Message.objects.filter(sender=instance)
+    instance._sent_message_conversation_ids = list(sent.values_list('conversation_id', flat=True).distinct())
+    MessageAttachment.objects.filter(message_id__in=sent.values('pk')).delete()
+
+
+@receiver(post_delete, sender=User)
+def refresh_sent_message_conversations(sender, instance, **kwargs):
+    """
+    Take the deleted user's messages off the other participants' unread
+    counters and the conversations' last-message pointers
+    """
+    conversation_ids = getattr(instance, '_sent_message_conversation_ids', None)
+    if conversation_ids:
+        from .utils.purge_utils import refresh_conversations
+
+        refresh_conversations(conversation_ids)
+
+
+# User fields shown in other people's inboxes
+INBOX_USER_FIELDS = {'username', 'first_name', 'last_name'}
+
+
+@receiver(post_save, sender=User)
+def invalidate_user_inboxes(sender, instance, created, update_fields=None, **kwargs):
+    """Names appear in the inboxes of everyone the user talks to"""
+    from .utils.inbox_utils import get_conversation_partner_ids, invalidate_inbox_cache
+
+    if created:
+        # Never inherit a cached inbox from a deleted user with the same id
+        invalidate_inbox_cache([instance.pk])
+    elif update_fields is None or INBOX_USER_FIELDS.intersection(update_fields):
+        invalidate_inbox_cache(get_conversation_partner_ids(instance.pk))
+
+
+@receiver(post_save, sender=UserProfile)
+def invalidate_profile_picture_inboxes(sender, instance, created, **kwargs):
+    """Profile pictures appear in the inboxes of everyone the user talks to"""
+    picture = str(instance.profile_picture or '')
+    if not created and picture != getattr(instance, '_loaded_profile_picture', None):
+        from .utils.inbox_utils import get_conversation_partner_ids, invalidate_inbox_cache
+
+        invalidate_inbox_cache(get_conversation_partner_ids(instance.user_id))
+    instance._loaded_profile_picture = picture
+
+
 class SellerRating(models.Model):
     """
     Rating model that connects to UserProfile (for sellers only)
@@ -0,0 +1,230 @@
+"""
+Lightweight publish/subscribe for realtime messaging.
+
+Publishers are plain synchronous code (views, signal handlers); subscribers
+are async consumers such as the conversation SSE stream. The backend is
+chosen with the MESSAGE_PUBSUB setting:
+
+    MESSAGE_PUBSUB = {
+        "BACKEND": "store_app.pubsub.InMemoryBackend",
+        "OPTIONS": {},
+    }
+
+InMemoryBackend only reaches subscribers in the same process. FileBackend
+spools events to a shared directory so every worker on the host sees them;
+it is a local stand-in for a real broker, not a durable queue.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+
+class Subscription:
+    """Handle returned by Backend.subscribe(); read with `await get(timeout)`"""
+
+    async def get(self, timeout):
+        """Return the payloads received so far, waiting up to `timeout` seconds"""
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+
+class Backend:
+    def publish(self, channel, payload):
+        """Deliver `payload` (a JSON-serializable dict) to every subscriber of `channel`"""
+        raise NotImplementedError
+
+    def subscribe(self, channel):
+        """Return a Subscription for `channel`. Must be called from a running event loop."""
+        raise NotImplementedError
+
+
+class _QueueSubscription(Subscription):
+    def __init__(self, backend, channel, max_pending):
+        self.backend = backend
+        self.channel = channel
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=max_pending)
+
+    def deliver(self, payload):
+        # Runs on the subscriber's event loop
+        try:
+            self.queue.put_nowait(payload)
+        except asyncio.QueueFull:
+            logger.warning(f"Dropping pub/sub event for slow subscriber on {self.channel}")
+
+    async def get(self, timeout):
+        try:
+            payloads = [await asyncio.wait_for(self.queue.get(), timeout)]
+        except asyncio.TimeoutError:
+            return []
+        while not self.queue.empty():
+            payloads.append(self.queue.get_nowait())
+        return payloads
+
+    def close(self):
+        self.backend._unsubscribe(self)
+
+
+class InMemoryBackend(Backend):
+    """Fan out to subscribers living in this process"""
+
+    def __init__(self, max_pending=100, **options):
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._subscribers = defaultdict(set)
+
+    def publish(self, channel, payload):
+        with self._lock:
+            subscribers = list(self._subscribers.get(channel, ()))
+        for subscription in subscribers:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.deliver, payload)
+            except RuntimeError:
+                # Event loop already closed; the stream is gone
+                self._unsubscribe(subscription)
+
+    def subscribe(self, channel):
+        subscription = _QueueSubscription(self, channel, self.max_pending)
+        with self._lock:
+            self._subscribers[channel].add(subscription)
+        return subscription
+
+    def _unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.channel)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[subscription.channel]
+
+
+class _FileSubscription(Subscription):
+    def __init__(self, backend, path, poll_interval):
+        self.backend = backend
+        self.path = path
+        self.poll_interval = poll_interval
+        # Only events published after subscribing are delivered
+        self.offset = self._size()
+        self._partial = b""
+
+    def _size(self):
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+
+    def _read_new(self):
+        size = self._size()
+        if size < self.offset:
+            # The spool was rotated by a publisher; start over
+            self.offset, self._partial = 0, b""
+        if size == self.offset:
+            return []
+        with open(self.path, "rb") as spool:
+            spool.seek(self.offset)
+            data = spool.read(size - self.offset)
+        self.offset += len(data)
+        *lines, self._partial = (self._partial + data).split(b"\n")
+        payloads = []
+        for line in lines:
+            try:
+                payloads.append(json.loads(line))
+            except ValueError:
+                logger.warning(f"Skipping malformed pub/sub line in {self.path}")
+        return payloads
+
+    async def get(self, timeout):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            payloads = self._read_new()
+            if payloads or loop.time() >= deadline:
+                return payloads
+            await asyncio.sleep(min(self.poll_interval, max(deadline - loop.time(), 0)))
+
+    def close(self):
+        pass
+
+
+class FileBackend(Backend):
+    """
+    Share events between processes on one host through append-only spool
+    files (one per channel). Subscribers tail the file they care about.
+    """
+
+    def __init__(self, path=None, poll_interval=0.25, max_bytes=1024 * 1024, **options):
+        self.path = path or os.path.join(settings.BASE_DIR, "tmp", "pubsub")
+        self.poll_interval = poll_interval
+        self.max_bytes = max_bytes
+        os.makedirs(self.path, exist_ok=True)
+
+    def _channel_path(self, channel):
+        safe_name = "".join(c if c.isalnum() or c in "-_." else "_" for c in channel)
+        return os.path.join(self.path, f"{safe_name}.jsonl")
+
+    def publish(self, channel, payload):
+        path = self._channel_path(channel)
+        line = json.dumps(payload, separators=(",", ":")).encode() + b"\n"
+        try:
+            if os.path.getsize(path) > self.max_bytes:
+                # Subscribers notice the shrink and rewind
+                open(path, "wb").close()
+        except OSError:
+            pass
+        # O_APPEND keeps concurrent single-line writes from interleaving
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+    def subscribe(self, channel):
+        return _FileSubscription(self, self._channel_path(channel), self.poll_interval)
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    """Return the configured backend (created once per process)"""
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                config = getattr(settings, "MESSAGE_PUBSUB", {})
+                backend_class = import_string(
+                    config.get("BACKEND", "store_app.pubsub.InMemoryBackend")
+                )
+                _backend = backend_class(**config.get("OPTIONS", {}))
+    return _backend
+
+
+def reset_backend():
+    """Drop the cached backend so the next get_backend() re-reads settings (used by tests)"""
+    global _backend
+    with _backend_lock:
+        _backend = None
+
+
+def publish(channel, payload):
+    """Publish without ever breaking the caller: realtime delivery is best effort"""
+    try:
+        get_backend().publish(channel, payload)
+    except Exception as e:
+        logger.error(f"Error publishing to {channel}: {str(e)}", exc_info=True)
+
+
+def subscribe(channel):
+    return get_backend().subscribe(channel)
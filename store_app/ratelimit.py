@@ -0,0 +1,228 @@
+"""
+Token-bucket rate limiting for endpoints that write to the database.
+
+Every scope (e.g. "send_message") has one bucket per user and one per
+client IP. A bucket holds up to `burst` tokens and refills at `rate`; each
+request takes a token from all of its buckets, and is refused when any of
+them is empty. Limits come from DEFAULT_RATE_LIMITS, overridden per scope
+by the RATE_LIMITS setting (None disables a scope):
+
+    RATE_LIMITS = {
+        "send_message": {"user": ("30/m", 10), "ip": ("300/m", 100)},
+    }
+
+Buckets live in the default Django cache, which settings point at Redis
+(REDIS_URL) so every worker shares them; with a per-process cache (the
+local memory cache under DEBUG) each process would have buckets of its
+own and allow that many times the limit. The read-modify-write is not
+atomic, so concurrent requests may occasionally squeeze in a token more
+than allowed; that is fine for flood control. If the cache is
+unreachable, buckets fall back to this process's memory rather than
+letting the limit go; like cached ones, they are dropped once full again.
+"""
+
+import logging
+import math
+import threading
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse, JsonResponse
+
+logger = logging.getLogger(__name__)
+
+# Per scope: bucket kind -> (rate, burst). Rates are "<count>/<s|m|h|d>".
+# IP buckets are generous: a campus network puts many users behind one address.
+DEFAULT_RATE_LIMITS = {
+    "send_message": {"user": ("30/m", 10), "ip": ("300/m", 100)},
+    "start_conversation": {"user": ("30/h", 5), "ip": ("300/h", 50)},
+    "submit_review": {"user": ("10/h", 3), "ip": ("30/h", 10)},
+}
+
+_PERIODS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+# Fallback buckets when the cache fails: key -> ((tokens, updated), expires)
+_local_buckets = {}
+_local_lock = threading.Lock()
+
+
+def parse_rate(rate):
+    """Tokens per second of a "<count>/<s|m|h|d>" rate"""
+    count, period = rate.split("/")
+    return int(count) / _PERIODS[period.strip()[0].lower()]
+
+
+def get_limits(scope):
+    """{kind: (tokens per second, burst)} of `scope`, or None if it is not limited"""
+    if not getattr(settings, "RATE_LIMIT_ENABLED", True):
+        return None
+    limits = getattr(settings, "RATE_LIMITS", {}).get(scope, DEFAULT_RATE_LIMITS.get(scope))
+    if not limits:
+        return None
+    return {kind: (parse_rate(rate), burst) for kind, (rate, burst) in limits.items()}
+
+
+def resolve_client_ip(forwarded_for, remote_addr):
+    """
+    The client address, taken from X-Forwarded-For when RATE_LIMIT_PROXY_COUNT
+    proxies (e.g. nginx) sit in front of the app; each appends the address
+    it saw, so the entry that many places from the end is the client's
+    """
+    proxy_count = getattr(settings, "RATE_LIMIT_PROXY_COUNT", 0)
+    if proxy_count and forwarded_for:
+        addresses = [address.strip() for address in forwarded_for.split(",") if address.strip()]
+        if addresses:
+            return addresses[-min(proxy_count, len(addresses))]
+    return remote_addr or ""
+
+
+def get_client_ip(request):
+    return resolve_client_ip(request.META.get("HTTP_X_FORWARDED_FOR"), request.META.get("REMOTE_ADDR"))
+
+
+def _bucket_key(scope, kind, identity):
+    return f"ratelimit:{scope}:{kind}:{identity}"
+
+
+def _refill(state, rate, burst, now):
+    """Tokens in a bucket at `now`, given its stored (tokens, updated) state"""
+    if state is None:
+        return burst
+    tokens, updated = state
+    return min(burst, tokens + (now - updated) * rate)
+
+
+def _load(keys):
+    try:
+        return cache.get_many(keys), True
+    except Exception as e:
+        logger.warning(f"Rate limit cache unavailable, using in-process buckets: {str(e)}")
+        now = time.time()
+        with _local_lock:
+            return {
+                key: _local_buckets[key][0]
+                for key in keys
+                if key in _local_buckets and _local_buckets[key][1] > now
+            }, False
+
+
+def _store(states, timeout, shared):
+    if shared:
+        try:
+            cache.set_many(states, timeout)
+            return
+        except Exception as e:
+            logger.warning(f"Rate limit cache unavailable, using in-process buckets: {str(e)}")
+    now = time.time()
+    with _local_lock:
+        # Drop the buckets that are full again, as the cache would have
+        for key in [key for key, (_, expires) in _local_buckets.items() if expires <= now]:
+            del _local_buckets[key]
+        _local_buckets.update((key, (state, now + timeout)) for key, state in states.items())
+
+
+def take_token(scope, identities):
+    """
+    Take a token from each of the `identities` buckets of `scope`
+    ({kind: identity}, e.g. {"user": 3, "ip": "10.0.0.1"}; missing
+    identities are skipped). Returns 0 if the request may proceed, otherwise
+    the seconds until it may be retried; a refused request takes nothing.
+    """
+    limits = get_limits(scope)
+    if not limits:
+        return 0
+    buckets = {
+        _bucket_key(scope, kind, identity): limits[kind]
+        for kind, identity in identities.items()
+        if identity not in (None, "") and kind in limits
+    }
+    if not buckets:
+        return 0
+
+    now = time.time()
+    stored, shared = _load(list(buckets))
+    tokens = {key: _refill(stored.get(key), rate, burst, now) for key, (rate, burst) in buckets.items()}
+    waits = [(1 - tokens[key]) / rate for key, (rate, _) in buckets.items() if tokens[key] < 1]
+    if waits:
+        return max(1, math.ceil(max(waits)))
+
+    # Keep each bucket around until it would be full again anyway
+    timeout = max(math.ceil(burst / rate) for rate, burst in buckets.values())
+    _store({key: (tokens[key] - 1, now) for key in buckets}, timeout, shared)
+    return 0
+
+
+def check_request(scope, request):
+    """take_token() for the user and client IP of `request`"""
+    user = getattr(request, "user", None)
+    return take_token(
+        scope,
+        {
+            "user": user.pk if user is not None and user.is_authenticated else None,
+            "ip": get_client_ip(request),
+        },
+    )
+
+
+class RateLimited(Exception):
+    """Raised by require_token() when a request is over the limit"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Rate limited; retry in {retry_after}s")
+        self.retry_after = retry_after
+
+
+def _log_limited(scope, request, retry_after):
+    logger.warning(
+        f"Rate limited {scope} for user {getattr(request.user, 'pk', None)} "
+        f"from {get_client_ip(request)}; retry in {retry_after}s"
+    )
+
+
+def require_token(scope, request):
+    """
+    check_request() for views that only limit some of their requests (e.g.
+    only the ones creating something): raises RateLimited when refused
+    """
+    retry_after = check_request(scope, request)
+    if retry_after:
+        _log_limited(scope, request, retry_after)
+        raise RateLimited(retry_after)
+
+
+def rate_limited_response(request, retry_after):
+    """429 with Retry-After: JSON for API clients, plain text otherwise"""
+    error = "Too many requests. Please slow down and try again shortly."
+    wants_json = (
+        request.content_type == "application/json"
+        or "application/json" in request.headers.get("Accept", "")
+        or request.headers.get("X-Requested-With") == "XMLHttpRequest"
+    )
+    if wants_json:
+        response = JsonResponse(
+            {"success": False, "error": error, "retry_after": retry_after}, status=429
+        )
+    else:
+        response = HttpResponse(error, status=429, content_type="text/plain; charset=utf-8")
+    response["Retry-After"] = str(retry_after)
+    return response
+
+
+def ratelimit(scope, methods=("POST",)):
+    """View decorator applying the `scope` limits to requests with one of `methods`"""
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if request.method in methods:
+                retry_after = check_request(scope, request)
+                if retry_after:
+                    _log_limited(scope, request, retry_after)
+                    return rate_limited_response(request, retry_after)
+            return view(request, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -1,4 +1,4 @@
-from django.test import TestCase, Client
+from django.test import TestCase, TransactionTestCase, Client, override_settings
 from django.urls import reverse
 from django.contrib.auth.models import User
 from django.core.files.uploadedfile import SimpleUploadedFile
@@ -821,6 +821,2136 @@ class MessagingSystemTests(TestCase):
         self.assertEqual(data["unread_count"], 3)
 
 
+class InboxQueryTests(TestCase):
+    """Tests for the conversation inbox query engine"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username="trader", email="trader@upr.edu", password="pass123"
+        )
+        self.category = ProductCategory.objects.create(name="Books", slug="books")
+
+    def _add_conversations(self, count):
+        for i in range(count):
+            other = User.objects.create_user(
+                username=f"buyer{i}", email=f"buyer{i}@upr.edu", password="pass123"
+            )
+            product = Product.objects.create(
+                name=f"Book {i}", price=Decimal("5.00"), category=self.category, user_vendor=self.user
+            )
+            conversation, _ = Conversation.get_or_create_conversation(self.user, other)
+            Message.objects.create(conversation=conversation, sender=other, content="Hi", product=product)
+            Message.objects.create(conversation=conversation, sender=other, content=f"Still there? {i}")
+
+    def _count_inbox_queries(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from .utils.inbox_utils import build_inbox
+
+        with CaptureQueriesContext(connection) as ctx:
+            build_inbox(self.user)
+        return len(ctx.captured_queries)
+
+    def test_inbox_query_count_is_constant(self):
+        """Test that the inbox costs the same number of queries for 2 or 8 conversations"""
+        self._add_conversations(2)
+        small = self._count_inbox_queries()
+
+        Conversation.objects.all().delete()
+        User.objects.exclude(id=self.user.id).delete()
+        self._add_conversations(8)
+        large = self._count_inbox_queries()
+
+        self.assertEqual(small, large)
+
+    def test_inbox_entries_match_conversation_data(self):
+        """Test that latest message, unread count and mentions are computed per conversation"""
+        from .utils.inbox_utils import build_inbox
+
+        self._add_conversations(2)
+        inbox = build_inbox(self.user)
+
+        self.assertEqual(len(inbox), 2)
+        for entry in inbox:
+            self.assertNotEqual(entry["other_participant"], self.user)
+            self.assertTrue(entry["latest_message"].content.startswith("Still there?"))
+            self.assertEqual(entry["unread_count"], 2)
+            self.assertEqual(len(entry["mentioned_products"]), 1)
+            self.assertEqual(entry["mentioned_services"], [])
+
+    def test_conversations_update_api_uses_inbox(self):
+        """Test that the polling API returns one entry per conversation"""
+        self._add_conversations(3)
+        self.client.login(username="trader", password="pass123")
+
+        response = self.client.get(reverse("store_app:get_conversations_update"))
+
+        data = response.json()
+        self.assertTrue(data["success"])
+        self.assertEqual(len(data["conversations"]), 3)
+        self.assertEqual(data["conversations"][0]["unread_count"], 2)
+
+
+class ConversationsDeltaSyncTests(TestCase):
+    """Tests for delta sync on the get_conversations_update polling endpoint"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username="buyer", email="buyer@upr.edu", password="pass123"
+        )
+        self.seller1 = User.objects.create_user(
+            username="seller1", email="seller1@upr.edu", password="pass123"
+        )
+        self.seller2 = User.objects.create_user(
+            username="seller2", email="seller2@upr.edu", password="pass123"
+        )
+        self.conv1, _ = Conversation.get_or_create_conversation(self.user, self.seller1)
+        self.conv2, _ = Conversation.get_or_create_conversation(self.user, self.seller2)
+        Message.objects.create(conversation=self.conv1, sender=self.seller1, content="Hi")
+        self.client.login(username="buyer", password="pass123")
+        self.url = reverse("store_app:get_conversations_update")
+
+    def test_full_sync_returns_cursor_and_etag(self):
+        """Test that a poll without a cursor returns every conversation and a cursor"""
+        response = self.client.get(self.url)
+
+        data = response.json()
+        self.assertTrue(data["full"])
+        self.assertEqual(len(data["conversations"]), 2)
+        self.assertEqual(response["ETag"], f'"{data["cursor"]}"')
+
+    def test_unchanged_inbox_returns_304(self):
+        """Test that polling with the current cursor as ETag returns an empty 304"""
+        cursor = self.client.get(self.url).json()["cursor"]
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=f'"{cursor}"')
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b"")
+
+    def test_since_returns_only_changed_conversations(self):
+        """Test that only conversations with new messages are returned after a cursor"""
+        from datetime import timedelta
+        from django.utils import timezone
+
+        cursor = self.client.get(self.url).json()["cursor"]
+        # Age both conversations past the overlap window, then touch only conv2
+        Conversation.objects.update(updated_at=timezone.now() - timedelta(minutes=5))
+        Message.objects.create(conversation=self.conv2, sender=self.seller2, content="New")
+
+        response = self.client.get(self.url, {"since": cursor})
+
+        data = response.json()
+        self.assertFalse(data["full"])
+        self.assertEqual([c["id"] for c in data["conversations"]], [self.conv2.id])
+        self.assertNotEqual(data["cursor"], cursor)
+
+    def test_invalid_cursor_falls_back_to_full_sync(self):
+        """Test that a malformed cursor is ignored"""
+        response = self.client.get(self.url, {"since": "garbage"})
+
+        data = response.json()
+        self.assertTrue(data["full"])
+        self.assertEqual(len(data["conversations"]), 2)
+
+
+class PubSubBackendTests(TestCase):
+    """Tests for the realtime pub/sub backends"""
+
+    def test_in_memory_backend_delivers_to_subscribers(self):
+        """Test that a published payload reaches subscribers of that channel only"""
+        import asyncio
+        from .pubsub import InMemoryBackend
+
+        backend = InMemoryBackend()
+
+        async def scenario():
+            subscription = backend.subscribe("conversation.1")
+            other = backend.subscribe("conversation.2")
+            backend.publish("conversation.1", {"id": 7})
+            received = await subscription.get(timeout=1)
+            nothing = await other.get(timeout=0.05)
+            subscription.close()
+            other.close()
+            return received, nothing
+
+        received, nothing = asyncio.run(scenario())
+        self.assertEqual(received, [{"id": 7}])
+        self.assertEqual(nothing, [])
+
+    def test_file_backend_fans_out_between_instances(self):
+        """Test that two FileBackend instances (e.g. two workers) share events"""
+        import asyncio
+        import tempfile
+        from .pubsub import FileBackend
+
+        with tempfile.TemporaryDirectory() as spool:
+            publisher = FileBackend(path=spool)
+            reader = FileBackend(path=spool, poll_interval=0.01)
+
+            async def scenario():
+                subscription = reader.subscribe("conversation.1")
+                publisher.publish("conversation.1", {"id": 1})
+                publisher.publish("conversation.1", {"id": 2})
+                return await subscription.get(timeout=1)
+
+            self.assertEqual(asyncio.run(scenario()), [{"id": 1}, {"id": 2}])
+
+    def test_new_message_is_published_on_commit(self):
+        """Test that creating a message publishes it to the conversation channel"""
+        from unittest import mock
+
+        user1 = User.objects.create_user(username="pub1", email="pub1@upr.edu", password="pass123")
+        user2 = User.objects.create_user(username="pub2", email="pub2@upr.edu", password="pass123")
+        conversation, _ = Conversation.get_or_create_conversation(user1, user2)
+
+        with mock.patch("store_app.pubsub.publish") as publish:
+            with self.captureOnCommitCallbacks(execute=True):
+                message = Message.objects.create(conversation=conversation, sender=user1, content="Hey")
+
+        channel, payload = publish.call_args.args
+        self.assertEqual(channel, f"conversation.{conversation.id}")
+        self.assertEqual(payload["id"], message.id)
+        self.assertEqual(payload["content"], "Hey")
+
+
+class ConversationStreamTests(TestCase):
+    """Tests for the conversation Server-Sent Events stream"""
+
+    def setUp(self):
+        self.user1 = User.objects.create_user(
+            username="user1", email="user1@upr.edu", password="testpass123"
+        )
+        self.user2 = User.objects.create_user(
+            username="user2", email="user2@upr.edu", password="testpass123"
+        )
+        self.conversation, _ = Conversation.get_or_create_conversation(self.user1, self.user2)
+        self.url = reverse("store_app:conversation_stream", args=[self.conversation.id])
+
+    def test_wsgi_request_tells_client_to_poll(self):
+        """Test that WSGI workers answer 204 instead of holding a stream open"""
+        self.client.login(username="user1", password="testpass123")
+
+        response = self.client.get(self.url)
+
+        self.assertEqual(response.status_code, 204)
+
+    async def test_stream_requires_authentication(self):
+        """Test that anonymous users cannot open a stream"""
+        response = await self.async_client.get(self.url)
+
+        self.assertEqual(response.status_code, 401)
+
+    async def test_stream_sends_missed_messages_and_marks_them_read(self):
+        """Test that the stream catches up from last_message_id and marks received messages read"""
+        from asgiref.sync import sync_to_async
+
+        message = await Message.objects.acreate(
+            conversation=self.conversation, sender=self.user2, content="Are you there?"
+        )
+        await self.async_client.aforce_login(self.user1)
+
+        response = await self.async_client.get(self.url, {"last_message_id": 0})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        chunks = aiter(response.streaming_content)
+        self.assertIn(b"retry:", await anext(chunks))
+        event = (await anext(chunks)).decode()
+        await chunks.aclose()
+        self.assertIn(f"id: {message.id}", event)
+        self.assertIn("Are you there?", event)
+        self.assertTrue(await sync_to_async(lambda: message.is_read)())
+
+
+class MessageSendApiTests(TestCase):
+    """Tests for the idempotent JSON send endpoint"""
+
+    def setUp(self):
+        self.user1 = User.objects.create_user(
+            username="user1", email="user1@upr.edu", password="testpass123"
+        )
+        self.user2 = User.objects.create_user(
+            username="user2", email="user2@upr.edu", password="testpass123"
+        )
+        self.conversation, _ = Conversation.get_or_create_conversation(self.user1, self.user2)
+        self.url = reverse("store_app:send_message", args=[self.conversation.id])
+
+    def _send(self, payload, **headers):
+        import json
+
+        return self.client.post(
+            self.url, json.dumps(payload), content_type="application/json", headers=headers
+        )
+
+    def test_send_stores_message_and_bumps_conversation(self):
+        """Test that a send creates the message, counts it unread and bumps the conversation"""
+        from .models import ConversationParticipantState
+
+        before = self.conversation.updated_at
+        self.client.login(username="user1", password="testpass123")
+
+        response = self._send({"content": "Is it available?", "client_key": "k1"})
+
+        self.assertEqual(response.status_code, 201)
+        self.assertTrue(response.json()["created"])
+        message = Message.objects.get()
+        self.assertEqual(response.json()["message"]["id"], message.id)
+        self.assertEqual(message.client_key, "k1")
+        self.conversation.refresh_from_db()
+        self.assertGreater(self.conversation.updated_at, before)
+        state = ConversationParticipantState.objects.get(user=self.user2, conversation=self.conversation)
+        self.assertEqual(state.unread_count, 1)
+
+    def test_replayed_key_returns_the_stored_message(self):
+        """Test that retrying with the same key (body or header) does not create a duplicate"""
+        from .models import ConversationParticipantState
+
+        self.client.login(username="user1", password="testpass123")
+
+        first = self._send({"content": "Hello"}, **{"Idempotency-Key": "retry-1"})
+        replay = self._send({"content": "Hello"}, **{"Idempotency-Key": "retry-1"})
+        again = self._send({"content": "Hello", "client_key": "retry-1"})
+
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual(replay.status_code, 200)
+        self.assertFalse(replay.json()["created"])
+        self.assertEqual(replay.json()["message"]["id"], first.json()["message"]["id"])
+        self.assertEqual(again.json()["message"]["id"], first.json()["message"]["id"])
+        self.assertEqual(Message.objects.count(), 1)
+        state = ConversationParticipantState.objects.get(user=self.user2, conversation=self.conversation)
+        self.assertEqual(state.unread_count, 1)
+
+    def test_invalid_sends_are_rejected(self):
+        """Test that empty content, unknown listings and outsiders get errors and store nothing"""
+        User.objects.create_user(username="user3", email="user3@upr.edu", password="testpass123")
+
+        self.client.login(username="user1", password="testpass123")
+        self.assertEqual(self._send({"content": "  "}).status_code, 400)
+        self.assertEqual(self._send({"content": "Hi", "product_id": 999}).status_code, 400)
+        self.assertEqual(self.client.post(self.url, "not json", content_type="application/json").status_code, 400)
+
+        self.client.login(username="user3", password="testpass123")
+        self.assertEqual(self._send({"content": "Hi"}).status_code, 404)
+        self.assertEqual(Message.objects.count(), 0)
+
+
+@override_settings(
+    RATE_LIMIT_ENABLED=True,
+    RATE_LIMITS={
+        "send_message": {"user": ("2/m", 2), "ip": ("100/m", 100)},
+        "start_conversation": {"user": ("10/m", 10), "ip": ("1/h", 1)},
+        "submit_review": {"user": ("1/h", 1), "ip": ("1/h", 1)},
+    },
+    RATE_LIMIT_PROXY_COUNT=1,
+)
+class RateLimitTests(TestCase):
+    """Tests for the token-bucket flood control"""
+
+    def setUp(self):
+        from django.core.cache import cache
+
+        cache.clear()
+        self.user1 = User.objects.create_user(
+            username="user1", email="user1@upr.edu", password="testpass123"
+        )
+        self.user2 = User.objects.create_user(
+            username="user2", email="user2@upr.edu", password="testpass123"
+        )
+        self.conversation, _ = Conversation.get_or_create_conversation(self.user1, self.user2)
+        self.client.login(username="user1", password="testpass123")
+
+    def test_sends_over_the_burst_get_429(self):
+        """Test that sends beyond the bucket are refused with Retry-After and store nothing"""
+        import json
+
+        url = reverse("store_app:send_message", args=[self.conversation.id])
+        statuses = [
+            self.client.post(
+                url, data=json.dumps({"content": f"Hi {i}"}), content_type="application/json"
+            ).status_code
+            for i in range(2)
+        ]
+        response = self.client.post(url, data=json.dumps({"content": "Spam"}), content_type="application/json")
+
+        self.assertEqual(statuses, [201, 201])
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response["Retry-After"], "30")
+        self.assertEqual(response.json()["retry_after"], 30)
+        self.assertEqual(Message.objects.count(), 2)
+
+        # The form post shares the bucket; reading the conversation does not
+        conversation_url = reverse("store_app:conversation", args=[self.conversation.id])
+        self.assertEqual(self.client.post(conversation_url, {"content": "Form"}).status_code, 429)
+        self.assertEqual(self.client.get(conversation_url).status_code, 200)
+
+    def test_ip_bucket_is_shared_by_users(self):
+        """Test that the per-IP bucket (from X-Forwarded-For behind the proxy) spans users"""
+        other = User.objects.create_user(username="other", email="other@upr.edu", password="testpass123")
+        url = reverse("store_app:start_conversation", args=[other.id])
+
+        first = self.client.get(url, HTTP_X_FORWARDED_FOR="198.51.100.7")
+        self.client.login(username="user2", password="testpass123")
+        second = self.client.get(url, HTTP_X_FORWARDED_FOR="198.51.100.7")
+        third = self.client.get(url, HTTP_X_FORWARDED_FOR="203.0.113.9")
+
+        self.assertEqual(first.status_code, 302)
+        self.assertEqual(second.status_code, 429)
+        self.assertEqual(second["Content-Type"], "text/plain; charset=utf-8")
+        self.assertEqual(third.status_code, 302)
+
+    def test_opening_an_existing_chat_takes_no_token(self):
+        """Test that only creating a conversation uses the start_conversation bucket"""
+        category = ProductCategory.objects.create(name="Books", slug="books")
+        product = Product.objects.create(
+            name="Calculus book", price=Decimal("20.00"), category=category, user_vendor=self.user2
+        )
+        other = User.objects.create_user(username="other", email="other@upr.edu", password="testpass123")
+        listing_url = reverse("store_app:message_listing", args=["product", product.id])
+
+        reopened = [self.client.get(listing_url, HTTP_X_FORWARDED_FOR="198.51.100.7") for _ in range(3)]
+        created = self.client.get(
+            reverse("store_app:start_conversation", args=[other.id]), HTTP_X_FORWARDED_FOR="198.51.100.7"
+        )
+
+        self.assertEqual([response.status_code for response in reopened], [200, 200, 200])
+        self.assertEqual(created.status_code, 302)
+        self.client.login(username="user2", password="testpass123")
+        third = User.objects.create_user(username="third", email="third@upr.edu", password="testpass123")
+        limited = self.client.get(
+            reverse("store_app:start_conversation", args=[third.id]), HTTP_X_FORWARDED_FOR="198.51.100.7"
+        )
+        self.assertEqual(limited.status_code, 429)
+        self.assertFalse(Conversation.objects.filter(participants=third).exists())
+
+    def test_falls_back_to_process_memory_without_cache(self):
+        """Test that buckets keep limiting when the cache backend fails"""
+        from unittest import mock
+        from .ratelimit import take_token
+
+        with mock.patch("store_app.ratelimit.cache.get_many", side_effect=ConnectionError), \
+                mock.patch("store_app.ratelimit.cache.set_many", side_effect=ConnectionError):
+            self.assertEqual(take_token("submit_review", {"ip": "192.0.2.1"}), 0)
+            self.assertGreater(take_token("submit_review", {"ip": "192.0.2.1"}), 0)
+
+    def test_process_memory_buckets_expire(self):
+        """Test that fallback buckets are dropped once they would be full again"""
+        import time
+        from unittest import mock
+        from . import ratelimit
+
+        with mock.patch("store_app.ratelimit.cache.get_many", side_effect=ConnectionError), \
+                mock.patch("store_app.ratelimit.cache.set_many", side_effect=ConnectionError):
+            ratelimit.take_token("submit_review", {"ip": "192.0.2.2"})
+            key = ratelimit._bucket_key("submit_review", "ip", "192.0.2.2")
+            self.assertIn(key, ratelimit._local_buckets)
+
+            later = time.time() + 86400
+            with mock.patch("store_app.ratelimit.time.time", return_value=later):
+                ratelimit.take_token("submit_review", {"ip": "192.0.2.3"})
+
+        self.assertNotIn(key, ratelimit._local_buckets)
+
+
+class ConversationWebSocketTests(TestCase):
+    """Tests for the conversation WebSocket endpoint"""
+
+    def setUp(self):
+        self.user1 = User.objects.create_user(
+            username="user1", email="user1@upr.edu", password="testpass123"
+        )
+        self.user2 = User.objects.create_user(
+            username="user2", email="user2@upr.edu", password="testpass123"
+        )
+        self.conversation, _ = Conversation.get_or_create_conversation(self.user1, self.user2)
+        self.path = f"/ws/conversation/{self.conversation.id}/"
+
+    async def _connect(self, user=None, origin="http://testserver"):
+        """Start the ASGI app on a fresh socket; returns (frames in, frames out, task)"""
+        import asyncio
+        from django.conf import settings
+        from django.test import AsyncClient
+        from .websocket import websocket_application
+
+        headers = [(b"host", b"testserver"), (b"origin", origin.encode())]
+        if user is not None:
+            client = AsyncClient()
+            await client.aforce_login(user)
+            session_key = client.cookies[settings.SESSION_COOKIE_NAME].value
+            headers.append((b"cookie", f"{settings.SESSION_COOKIE_NAME}={session_key}".encode()))
+        scope = {"type": "websocket", "path": self.path, "query_string": b"", "headers": headers}
+
+        incoming, outgoing = asyncio.Queue(), asyncio.Queue()
+        await incoming.put({"type": "websocket.connect"})
+        task = asyncio.create_task(websocket_application(scope, incoming.get, outgoing.put))
+        return incoming, outgoing, task
+
+    async def _next_frame(self, outgoing):
+        import asyncio
+        import json
+
+        event = await asyncio.wait_for(outgoing.get(), 5)
+        self.assertEqual(event["type"], "websocket.send")
+        return json.loads(event["text"])
+
+    async def _disconnect(self, incoming, task):
+        await incoming.put({"type": "websocket.disconnect", "code": 1000})
+        await task
+
+    async def test_send_frame_is_stored_and_acknowledged(self):
+        """Test that a send frame creates the message and acks it with the client id"""
+        import json
+
+        incoming, outgoing, task = await self._connect(self.user1)
+        self.assertEqual((await outgoing.get())["type"], "websocket.accept")
+
+        await incoming.put(
+            {"type": "websocket.receive", "text": json.dumps({"type": "send", "content": "Hi!", "client_id": "c1"})}
+        )
+        frame = await self._next_frame(outgoing)
+        await self._disconnect(incoming, task)
+
+        self.assertEqual(frame["type"], "ack")
+        self.assertEqual(frame["client_id"], "c1")
+        self.assertEqual(frame["message"]["content"], "Hi!")
+        message = await Message.objects.aget(id=frame["message"]["id"])
+        self.assertEqual(message.sender_id, self.user1.id)
+        self.assertEqual(message.conversation_id, self.conversation.id)
+
+    async def test_typing_and_read_receipts_reach_the_other_participant(self):
+        """Test that typing notices and read receipts go to the other socket but not back to the sender"""
+        import json
+
+        message = await Message.objects.acreate(
+            conversation=self.conversation, sender=self.user1, content="Hello"
+        )
+        incoming1, outgoing1, task1 = await self._connect(self.user1)
+        incoming2, outgoing2, task2 = await self._connect(self.user2)
+        self.assertEqual((await outgoing1.get())["type"], "websocket.accept")
+        self.assertEqual((await outgoing2.get())["type"], "websocket.accept")
+
+        await incoming2.put({"type": "websocket.receive", "text": json.dumps({"type": "typing"})})
+        typing = await self._next_frame(outgoing1)
+        await incoming2.put(
+            {"type": "websocket.receive", "text": json.dumps({"type": "read", "message_id": message.id})}
+        )
+        receipt = await self._next_frame(outgoing1)
+        await self._disconnect(incoming1, task1)
+        await self._disconnect(incoming2, task2)
+
+        self.assertEqual(typing, {"type": "typing", "user_id": self.user2.id, "user": "user2"})
+        self.assertEqual(receipt["type"], "read")
+        self.assertEqual(receipt["message_id"], message.id)
+        self.assertTrue(outgoing2.empty())
+
+    async def test_handshake_is_rejected_without_session_or_from_foreign_origin(self):
+        """Test that anonymous and cross-origin connections are closed before being accepted"""
+        from .websocket import CLOSE_FORBIDDEN, CLOSE_UNAUTHORIZED
+
+        _, outgoing, task = await self._connect()
+        await task
+        self.assertEqual(await outgoing.get(), {"type": "websocket.close", "code": CLOSE_UNAUTHORIZED})
+
+        _, outgoing, task = await self._connect(self.user1, origin="https://evil.example")
+        await task
+        self.assertEqual(await outgoing.get(), {"type": "websocket.close", "code": CLOSE_FORBIDDEN})
+
+
+class ConversationWebSocketThreadTests(TransactionTestCase):
+    """Tests for where the WebSocket endpoint runs its database work"""
+
+    def setUp(self):
+        self.user1 = User.objects.create_user(
+            username="user1", email="user1@upr.edu", password="testpass123"
+        )
+        self.user2 = User.objects.create_user(
+            username="user2", email="user2@upr.edu", password="testpass123"
+        )
+        self.conversation, _ = Conversation.get_or_create_conversation(self.user1, self.user2)
+
+    def test_each_socket_gets_its_own_sync_thread(self):
+        """Test that two open sockets run their database calls on different threads, off the event loop"""
+        import asyncio
+        import threading
+        from unittest import mock
+        from django.conf import settings
+        from .utils.message_utils import get_latest_message_id
+        from .websocket import websocket_application
+
+        cookies = []
+        for user in (self.user1, self.user2):
+            client = Client()
+            client.force_login(user)
+            session_key = client.cookies[settings.SESSION_COOKIE_NAME].value
+            cookies.append(f"{settings.SESSION_COOKIE_NAME}={session_key}".encode())
+
+        threads = []
+
+        def latest_message_id(conversation_id):
+            threads.append(threading.get_ident())
+            return get_latest_message_id(conversation_id)
+
+        async def open_two_sockets():
+            sockets = []
+            for cookie in cookies:
+                scope = {
+                    "type": "websocket",
+                    "path": f"/ws/conversation/{self.conversation.id}/",
+                    "query_string": b"",
+                    "headers": [(b"host", b"testserver"), (b"cookie", cookie)],
+                }
+                incoming, outgoing = asyncio.Queue(), asyncio.Queue()
+                await incoming.put({"type": "websocket.connect"})
+                task = asyncio.create_task(websocket_application(scope, incoming.get, outgoing.put))
+                self.assertEqual((await asyncio.wait_for(outgoing.get(), 5))["type"], "websocket.accept")
+                sockets.append((incoming, task))
+            for _ in range(100):
+                if len(threads) == 2:
+                    break
+                await asyncio.sleep(0.05)
+            for incoming, task in sockets:
+                await incoming.put({"type": "websocket.disconnect", "code": 1000})
+                await asyncio.wait_for(task, 5)
+
+        # A loop of our own: under async_to_sync, sync calls would go back to the caller's thread
+        with mock.patch("store_app.websocket.get_latest_message_id", side_effect=latest_message_id):
+            asyncio.run(open_two_sockets())
+
+        self.assertEqual(len(threads), 2)
+        self.assertNotEqual(threads[0], threads[1])
+        self.assertNotIn(threading.get_ident(), threads)
+
+
+class UnreadCounterTests(TestCase):
+    """Tests for the denormalized per-participant unread counters"""
+
+    def setUp(self):
+        self.user1 = User.objects.create_user(
+            username="user1", email="user1@upr.edu", password="testpass123"
+        )
+        self.user2 = User.objects.create_user(
+            username="user2", email="user2@upr.edu", password="testpass123"
+        )
+        self.conversation, _ = Conversation.get_or_create_conversation(self.user1, self.user2)
+
+    def _state(self, user):
+        from .models import ConversationParticipantState
+
+        return ConversationParticipantState.objects.get(user=user, conversation=self.conversation)
+
+    def test_new_message_increments_recipient_counter_only(self):
+        """Test that a message counts as unread for the recipient but not the sender"""
+        Message.objects.create(conversation=self.conversation, sender=self.user2, content="Hi")
+        Message.objects.create(conversation=self.conversation, sender=self.user2, content="Hello?")
+
+        self.assertEqual(self._state(self.user1).unread_count, 2)
+        self.assertEqual(self._state(self.user2).unread_count, 0)
+
+    def test_viewing_conversation_resets_counter(self):
+        """Test that opening the conversation clears the counter and moves the last-read pointer"""
+        Message.objects.create(conversation=self.conversation, sender=self.user2, content="Hi")
+        last = Message.objects.create(conversation=self.conversation, sender=self.user2, content="Hey")
+
+        self.client.login(username="user1", password="testpass123")
+        self.client.get(reverse("store_app:conversation", args=[self.conversation.id]))
+
+        state = self._state(self.user1)
+        self.assertEqual(state.unread_count, 0)
+        self.assertEqual(state.last_read_message_id, last.id)
+
+    def test_badge_sums_counters_across_conversations(self):
+        """Test that the unread badge adds up every conversation"""
+        user3 = User.objects.create_user(username="user3", email="user3@upr.edu", password="pass123")
+        other, _ = Conversation.get_or_create_conversation(self.user1, user3)
+        Message.objects.create(conversation=self.conversation, sender=self.user2, content="One")
+        Message.objects.create(conversation=other, sender=user3, content="Two")
+        Message.objects.create(conversation=other, sender=self.user1, content="Mine")
+
+        self.client.login(username="user1", password="testpass123")
+        response = self.client.get(reverse("store_app:get_unread_messages_count"))
+
+        self.assertEqual(response.json()["unread_count"], 2)
+
+    def test_missing_state_rows_are_created_from_messages(self):
+        """Test that conversations created without states get accurate counters lazily"""
+        from .models import ConversationParticipantState
+
+        user3 = User.objects.create_user(username="user3", email="user3@upr.edu", password="pass123")
+        legacy = Conversation.objects.create()
+        legacy.participants.add(self.user1, user3)
+        Message.objects.create(conversation=legacy, sender=user3, content="First")
+        Message.objects.create(conversation=legacy, sender=user3, content="Second")
+
+        state = ConversationParticipantState.objects.get(user=self.user1, conversation=legacy)
+        self.assertEqual(state.unread_count, 2)
+
+    def test_mark_read_is_single_row_update(self):
+        """Test that marking a conversation read moves the watermark without touching messages"""
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from .models import ConversationParticipantState
+
+        first = Message.objects.create(conversation=self.conversation, sender=self.user2, content="One")
+        Message.objects.create(conversation=self.conversation, sender=self.user1, content="Mine")
+        last = Message.objects.create(conversation=self.conversation, sender=self.user2, content="Two")
+        Message.objects.create(conversation=self.conversation, sender=self.user2, content="Three")
+
+        with CaptureQueriesContext(connection) as queries:
+            moved = ConversationParticipantState.mark_read(self.user1, self.conversation.id, last.id)
+
+        self.assertTrue(moved)
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn("store_app_message\" SET", queries[0]["sql"])
+        state = self._state(self.user1)
+        self.assertEqual(state.last_read_message_id, last.id)
+        self.assertEqual(state.unread_count, 1)
+        self.assertIsNotNone(state.last_read_at)
+        self.assertTrue(first.is_read)
+        self.assertFalse(ConversationParticipantState.mark_read(self.user1, self.conversation.id, first.id))
+
+    def test_mark_read_by_outsider_returns_false(self):
+        """Test that marking a conversation read for a user outside it does nothing instead of looping"""
+        from .models import ConversationParticipantState
+
+        outsider = User.objects.create_user(username="user3", email="user3@upr.edu", password="pass123")
+        Message.objects.create(conversation=self.conversation, sender=self.user2, content="Hi")
+
+        self.assertFalse(ConversationParticipantState.mark_read(outsider, self.conversation.id))
+        self.assertFalse(ConversationParticipantState.objects.filter(user=outsider).exists())
+
+    def test_deleting_a_sender_takes_their_messages_off_unread_counters(self):
+        """Test that a deleted account's messages stop counting as unread for the people they wrote to"""
+        from .models import ConversationParticipantState
+
+        user3 = User.objects.create_user(username="user3", email="user3@upr.edu", password="pass123")
+        Message.objects.create(conversation=self.conversation, sender=self.user2, content="Hi")
+        other, _ = Conversation.get_or_create_conversation(self.user1, user3)
+        Message.objects.create(conversation=other, sender=user3, content="spam!!")
+        Message.objects.create(conversation=other, sender=self.user1, content="Who is this?")
+
+        user3.delete()
+
+        self.assertEqual(self._state(self.user1).unread_count, 1)
+        self.assertEqual(ConversationParticipantState.total_unread(self.user1), 1)
+
+    def test_deleted_messages_leave_the_last_message_pointer(self):
+        """Test that deleting the latest message, or its sender, moves the inbox preview back"""
+        user3 = User.objects.create_user(username="user3", email="user3@upr.edu", password="pass123")
+        other, _ = Conversation.get_or_create_conversation(self.user1, user3)
+        earlier = Message.objects.create(conversation=other, sender=self.user1, content="Still selling?")
+        Message.objects.create(conversation=other, sender=user3, content="spam!!")
+
+        user3.delete()
+
+        other.refresh_from_db()
+        self.assertEqual(other.last_message_id, earlier.id)
+        self.assertEqual(other.last_message_preview, "Still selling?")
+        self.assertEqual(other.last_message_at, earlier.created_at)
+
+    def test_is_read_is_derived_from_recipient_watermark(self):
+        """Test that Message.is_read follows the recipient's watermark"""
+        from .models import ConversationParticipantState
+
+        message = Message.objects.create(conversation=self.conversation, sender=self.user2, content="Hi")
+        self.assertFalse(message.is_read)
+
+        # The sender catching up does not make the message read
+        ConversationParticipantState.mark_read(self.user2, self.conversation.id)
+        self.assertFalse(message.is_read)
+
+        ConversationParticipantState.mark_read(self.user1, self.conversation.id)
+        self.assertTrue(message.is_read)
+        with self.assertRaises(ValueError):
+            message.is_read = True
+
+    def test_rebuild_command_recomputes_counters(self):
+        """Test that rebuild_unread_counters restores counters from the watermarks"""
+        from django.core.management import call_command
+        from io import StringIO
+        from .models import ConversationParticipantState
+
+        read = Message.objects.create(conversation=self.conversation, sender=self.user2, content="Old")
+        Message.objects.create(conversation=self.conversation, sender=self.user2, content="New")
+        ConversationParticipantState.objects.update(unread_count=42)
+        ConversationParticipantState.objects.filter(user=self.user1).update(last_read_message_id=read.id)
+
+        call_command("rebuild_unread_counters", stdout=StringIO())
+
+        state = self._state(self.user1)
+        self.assertEqual(state.unread_count, 1)
+        self.assertEqual(state.last_read_message_id, read.id)
+        self.assertEqual(self._state(self.user2).unread_count, 0)
+
+
+class MessageHistoryPaginationTests(TestCase):
+    """Tests for keyset-paginated message history"""
+
+    def setUp(self):
+        self.client = Client()
+        self.user1 = User.objects.create_user(
+            username="user1", email="user1@upr.edu", password="pass123"
+        )
+        self.user2 = User.objects.create_user(
+            username="user2", email="user2@upr.edu", password="pass123"
+        )
+        self.conversation, _ = Conversation.get_or_create_conversation(self.user1, self.user2)
+        self.messages = [
+            Message.objects.create(
+                conversation=self.conversation, sender=self.user2, content=f"Message {i}"
+            )
+            for i in range(7)
+        ]
+        # Identical timestamps make the id tie-breaker do the work
+        Message.objects.update(created_at=self.messages[0].created_at)
+
+    def test_conversation_view_renders_latest_page(self):
+        """Test that only the most recent page of messages is rendered"""
+        from unittest import mock
+
+        self.client.login(username="user1", password="pass123")
+        with mock.patch("store_app.utils.message_utils.MESSAGE_PAGE_SIZE", 3):
+            response = self.client.get(
+                reverse("store_app:conversation", args=[self.conversation.id])
+            )
+
+        self.assertEqual(
+            [m.id for m in response.context["messages"]],
+            [m.id for m in self.messages[-3:]],
+        )
+        self.assertIsNotNone(response.context["older_messages_cursor"])
+
+    def test_older_messages_walks_history_without_gaps(self):
+        """Test that following older cursors returns every message exactly once"""
+        from unittest import mock
+
+        self.client.login(username="user1", password="pass123")
+        with mock.patch("store_app.utils.message_utils.MESSAGE_PAGE_SIZE", 3):
+            response = self.client.get(
+                reverse("store_app:conversation", args=[self.conversation.id])
+            )
+            seen = [m.id for m in response.context["messages"]]
+            cursor = response.context["older_messages_cursor"]
+            while cursor:
+                data = self.client.get(
+                    reverse("store_app:get_older_messages", args=[self.conversation.id]),
+                    {"before": cursor},
+                ).json()
+                self.assertTrue(data["success"])
+                seen = [m["id"] for m in data["messages"]] + seen
+                cursor = data["older_cursor"]
+
+        self.assertEqual(seen, [m.id for m in self.messages])
+
+    def test_older_messages_rejects_invalid_cursor(self):
+        """Test that a malformed cursor is a 400"""
+        self.client.login(username="user1", password="pass123")
+        response = self.client.get(
+            reverse("store_app:get_older_messages", args=[self.conversation.id]),
+            {"before": "not-a-cursor"},
+        )
+        self.assertEqual(response.status_code, 400)
+
+    def test_older_messages_requires_participant(self):
+        """Test that non-participants cannot read the history"""
+        User.objects.create_user(username="outsider", email="outsider@upr.edu", password="pass123")
+        self.client.login(username="outsider", password="pass123")
+        response = self.client.get(
+            reverse("store_app:get_older_messages", args=[self.conversation.id]),
+            {"before": "0.0"},
+        )
+        self.assertEqual(response.status_code, 404)
+
+
+class MessageSerializationTests(TestCase):
+    """Tests for the batched message serializer used by the messaging endpoints"""
+
+    def setUp(self):
+        self.client = Client()
+        self.user1 = User.objects.create_user(
+            username="user1", email="user1@upr.edu", password="pass123"
+        )
+        self.user2 = User.objects.create_user(
+            username="user2", email="user2@upr.edu", password="pass123",
+            first_name="Second", last_name="User",
+        )
+        self.category = ProductCategory.objects.create(name="Books", slug="books")
+        self.product = Product.objects.create(
+            name="Calculus Book", description="Used", price=Decimal("20.00"),
+            category=self.category, user_vendor=self.user2,
+        )
+        self.conversation, _ = Conversation.get_or_create_conversation(self.user1, self.user2)
+
+    def _poll_query_count(self, batch_size):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        last_id = Message.objects.order_by("-id").values_list("id", flat=True).first() or 0
+        for i in range(batch_size):
+            Message.objects.create(
+                conversation=self.conversation, sender=self.user2,
+                content=f"Message {i}", product=self.product,
+            )
+        url = reverse("store_app:get_new_messages", args=[self.conversation.id])
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, {"last_message_id": last_id})
+        self.assertEqual(len(response.json()["messages"]), batch_size)
+        return len(queries)
+
+    def test_poll_is_constant_query(self):
+        """Test that polling costs the same number of queries for 1 or 20 messages"""
+        self.client.login(username="user1", password="pass123")
+        self._poll_query_count(1)  # warm up session/user lookups
+
+        self.assertEqual(self._poll_query_count(1), self._poll_query_count(20))
+
+    def test_serialized_payload(self):
+        """Test the payload keys conversation.html relies on"""
+        self.client.login(username="user1", password="pass123")
+        message = Message.objects.create(
+            conversation=self.conversation, sender=self.user2,
+            content="Still available?", product=self.product,
+        )
+
+        data = self.client.get(
+            reverse("store_app:get_new_messages", args=[self.conversation.id])
+        ).json()
+
+        self.assertEqual(
+            data["messages"],
+            [
+                {
+                    "id": message.id,
+                    "sender": "user2",
+                    "sender_name": "Second User",
+                    "content": "Still available?",
+                    "timestamp": message.created_at.strftime("%b %d, %Y %I:%M %p"),
+                    "product": {"id": self.product.id, "name": "Calculus Book"},
+                }
+            ],
+        )
+
+
+class MessageSearchTests(TestCase):
+    """Tests for searching message history"""
+
+    def setUp(self):
+        self.client = Client()
+        self.user1 = User.objects.create_user(
+            username="user1", email="user1@upr.edu", password="pass123"
+        )
+        self.user2 = User.objects.create_user(
+            username="user2", email="user2@upr.edu", password="pass123"
+        )
+        self.outsider = User.objects.create_user(
+            username="outsider", email="outsider@upr.edu", password="pass123"
+        )
+        self.conversation, _ = Conversation.get_or_create_conversation(self.user1, self.user2)
+        self.other_conversation, _ = Conversation.get_or_create_conversation(self.user2, self.outsider)
+        self.url = reverse("store_app:search_messages")
+
+    def test_search_is_scoped_to_users_conversations(self):
+        """Test that only messages from the user's own conversations are returned"""
+        hit = Message.objects.create(
+            conversation=self.conversation, sender=self.user2, content="Is the calculator still available?"
+        )
+        Message.objects.create(
+            conversation=self.other_conversation, sender=self.user2, content="Calculator sold"
+        )
+        Message.objects.create(conversation=self.conversation, sender=self.user1, content="Hello")
+
+        self.client.login(username="user1", password="pass123")
+        data = self.client.get(self.url, {"q": "calculator"}).json()
+
+        self.assertTrue(data["success"])
+        self.assertEqual([r["id"] for r in data["results"]], [hit.id])
+        self.assertEqual(data["results"][0]["conversation_id"], self.conversation.id)
+        self.assertIsNone(data["next_cursor"])
+
+    def test_search_paginates_with_cursor(self):
+        """Test that following next_cursor returns every hit exactly once"""
+        from unittest import mock
+
+        hits = [
+            Message.objects.create(conversation=self.conversation, sender=self.user2, content=f"book {i}")
+            for i in range(5)
+        ]
+        self.client.login(username="user1", password="pass123")
+
+        seen = []
+        params = {"q": "book"}
+        with mock.patch("store_app.utils.search_utils.MESSAGE_SEARCH_PAGE_SIZE", 2):
+            while True:
+                data = self.client.get(self.url, params).json()
+                seen += [r["id"] for r in data["results"]]
+                if not data["next_cursor"]:
+                    break
+                params["cursor"] = data["next_cursor"]
+
+        self.assertEqual(seen, [m.id for m in reversed(hits)])
+
+    def test_search_requires_query(self):
+        """Test that an empty query or a malformed cursor is a 400"""
+        self.client.login(username="user1", password="pass123")
+        self.assertEqual(self.client.get(self.url, {"q": " "}).status_code, 400)
+        self.assertEqual(
+            self.client.get(self.url, {"q": "book", "cursor": "bogus"}).status_code, 400
+        )
+        self.assertEqual(
+            self.client.get(self.url, {"q": "book", "cursor": "NaN_5"}).status_code, 400
+        )
+
+    def test_search_cursor_keeps_the_exact_rank(self):
+        """Test that a cursor carries the rounded rank exactly, so ties resume where the page ended"""
+        from decimal import Decimal
+        from .utils.search_utils import encode_search_cursor, parse_search_cursor
+
+        message = Message(id=42)
+        message.rank = Decimal("0.060793")
+        self.assertEqual(parse_search_cursor(encode_search_cursor(message)), (Decimal("0.060793"), 42))
+
+
+class ConversationMentionTests(TestCase):
+    """Tests for the materialized "discussed listings" of conversations"""
+
+    def setUp(self):
+        self.client = Client()
+        self.user1 = User.objects.create_user(
+            username="user1", email="user1@upr.edu", password="pass123"
+        )
+        self.user2 = User.objects.create_user(
+            username="user2", email="user2@upr.edu", password="pass123"
+        )
+        self.category = ProductCategory.objects.create(name="Books", slug="books")
+        self.product = Product.objects.create(
+            name="Calculus Book", description="Used", price=Decimal("20.00"),
+            category=self.category, user_vendor=self.user2,
+        )
+        self.conversation, _ = Conversation.get_or_create_conversation(self.user1, self.user2)
+
+    def test_sending_messages_maintains_mentions(self):
+        """Test that repeated mentions keep one row with first/last mention times"""
+        from .models import ConversationMention
+
+        first = Message.objects.create(
+            conversation=self.conversation, sender=self.user1, content="Hi", product=self.product
+        )
+        Message.objects.create(conversation=self.conversation, sender=self.user2, content="Yes")
+        last = Message.objects.create(
+            conversation=self.conversation, sender=self.user1, content="Deal", product=self.product
+        )
+
+        mention = ConversationMention.objects.get(conversation=self.conversation)
+        self.assertEqual(mention.product, self.product)
+        self.assertEqual(mention.first_mentioned_at, first.created_at)
+        self.assertEqual(mention.last_mentioned_at, last.created_at)
+
+    def test_conversation_view_reads_mentions(self):
+        """Test that the Discussed list comes from the mention table"""
+        Message.objects.create(
+            conversation=self.conversation, sender=self.user2, content="Hi", product=self.product
+        )
+        self.client.login(username="user1", password="pass123")
+
+        response = self.client.get(reverse("store_app:conversation", args=[self.conversation.id]))
+
+        self.assertEqual(
+            response.context["mentioned_products"],
+            [{"id": self.product.id, "name": "Calculus Book"}],
+        )
+        self.assertEqual(response.context["mentioned_services"], [])
+
+    def test_rebuild_conversation_mentions_command(self):
+        """Test that the backfill command rebuilds mentions from messages"""
+        from django.core.management import call_command
+        from io import StringIO
+        from .models import ConversationMention
+
+        Message.objects.create(
+            conversation=self.conversation, sender=self.user2, content="Hi", product=self.product
+        )
+        ConversationMention.objects.all().delete()
+
+        out = StringIO()
+        call_command("rebuild_conversation_mentions", "--batch-size", "1", stdout=out)
+
+        self.assertIn("Rebuilt 1 mention(s)", out.getvalue())
+        self.assertTrue(
+            ConversationMention.objects.filter(conversation=self.conversation, product=self.product).exists()
+        )
+
+
+class ChatPurgeCommandTests(TestCase):
+    """Tests for clear_all_chats and purge_old_messages"""
+
+    def setUp(self):
+        self.user1 = User.objects.create_user(
+            username="user1", email="user1@upr.edu", password="pass123"
+        )
+        self.user2 = User.objects.create_user(
+            username="user2", email="user2@upr.edu", password="pass123"
+        )
+        self.conversation, _ = Conversation.get_or_create_conversation(self.user1, self.user2)
+        self.messages = [
+            Message.objects.create(conversation=self.conversation, sender=self.user2, content=f"Message {i}")
+            for i in range(5)
+        ]
+
+    def test_clear_all_chats_deletes_in_batches(self):
+        """Test that clear_all_chats removes everything across several batches"""
+        from django.core.management import call_command
+        from io import StringIO
+        from .models import ConversationParticipantState
+
+        out = StringIO()
+        call_command("clear_all_chats", "--confirm", "--batch-size", "2", "--verbosity", "2", stdout=out)
+
+        self.assertFalse(Message.objects.exists())
+        self.assertFalse(Conversation.objects.exists())
+        self.assertFalse(ConversationParticipantState.objects.exists())
+        self.assertIn("Successfully deleted 5 message(s)", out.getvalue())
+        self.assertIn("  4 message(s) deleted", out.getvalue())
+
+    def test_clear_all_chats_truncate_requires_postgresql(self):
+        """Test that --truncate is refused on SQLite"""
+        from django.core.management import call_command
+        from django.core.management.base import CommandError
+
+        with self.assertRaises(CommandError):
+            call_command("clear_all_chats", "--confirm", "--truncate")
+
+    def test_purge_old_messages_respects_cutoff(self):
+        """Test that only messages older than the retention period are purged"""
+        from datetime import timedelta
+        from django.core.management import call_command
+        from django.utils import timezone
+        from io import StringIO
+        from .models import ConversationParticipantState
+
+        old_ids = [m.id for m in self.messages[:3]]
+        Message.objects.filter(id__in=old_ids).update(created_at=timezone.now() - timedelta(days=40))
+
+        call_command("purge_old_messages", "--days", "30", "--batch-size", "2", stdout=StringIO())
+
+        self.assertEqual(
+            list(Message.objects.values_list("id", flat=True)),
+            [m.id for m in self.messages[3:]],
+        )
+        # The purged messages were unread; the counter follows
+        state = ConversationParticipantState.objects.get(conversation=self.conversation, user=self.user1)
+        self.assertEqual(state.unread_count, 2)
+        # The pointer still names the latest message
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.last_message_id, self.messages[-1].id)
+
+    def test_purge_old_messages_dry_run(self):
+        """Test that --dry-run deletes nothing"""
+        from django.core.management import call_command
+        from io import StringIO
+
+        out = StringIO()
+        call_command("purge_old_messages", "--days", "1", "--dry-run", stdout=out)
+
+        self.assertEqual(Message.objects.count(), 5)
+        self.assertIn("0 message(s)", out.getvalue())
+
+
+class MessagePartitionTests(TestCase):
+    """Tests for the monthly partitioning of the message table"""
+
+    def setUp(self):
+        self.user1 = User.objects.create_user(
+            username="user1", email="user1@upr.edu", password="pass123"
+        )
+        self.user2 = User.objects.create_user(
+            username="user2", email="user2@upr.edu", password="pass123"
+        )
+        self.conversation, _ = Conversation.get_or_create_conversation(self.user1, self.user2)
+
+    def test_partition_messages_requires_postgresql(self):
+        """Test that partitioning is refused on SQLite, which keeps a plain table"""
+        from django.core.management import call_command
+        from django.core.management.base import CommandError
+        from .utils.partition_utils import is_partitioned
+
+        with self.assertRaises(CommandError):
+            call_command("partition_messages", "--convert")
+        self.assertFalse(is_partitioned())
+
+    def test_partitioned_table_keeps_full_text_search(self):
+        """Test that messages written after partitioning are still found by search (PostgreSQL only)"""
+        from django.db import connection
+        from .utils.partition_utils import SEARCH_VECTOR_INDEX, convert_to_partitioned, ensure_partitions
+        from .utils.search_utils import search_user_messages
+
+        if connection.vendor != "postgresql":
+            self.skipTest("Partitioning and full text search need PostgreSQL")
+
+        before = Message.objects.create(conversation=self.conversation, sender=self.user2, content="Old bicycle")
+        convert_to_partitioned()
+        ensure_partitions()
+        after = Message.objects.create(conversation=self.conversation, sender=self.user2, content="New bicycle")
+
+        results, _ = search_user_messages(self.user1, "bicycle")
+        self.assertEqual({message.id for message in results}, {before.id, after.id})
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT tablename FROM pg_indexes WHERE indexname = %s", [SEARCH_VECTOR_INDEX])
+            self.assertEqual(cursor.fetchone()[0], Message._meta.db_table)
+
+    def test_partition_months_roll_over_years(self):
+        """Test the month arithmetic behind the monthly partition names and bounds"""
+        from .utils.partition_utils import add_months, month_start, partition_name
+
+        self.assertEqual(add_months(2026, 11, 1), (2026, 12))
+        self.assertEqual(add_months(2026, 12, 1), (2027, 1))
+        self.assertEqual(add_months(2026, 10, 15), (2028, 1))
+        self.assertEqual(partition_name(2027, 1), "store_app_message_p2027_01")
+        self.assertEqual(month_start(2027, 1).isoformat(), "2027-01-01T00:00:00+00:00")
+
+
+class ConversationPairMigrationTests(TransactionTestCase):
+    """Tests for the data migration that merges duplicate conversations"""
+
+    migrate_from = [("store_app", "0015_conversation_pair_key")]
+    migrate_to = [("store_app", "0016_merge_duplicate_conversations")]
+
+    def setUp(self):
+        from django.db import connection
+        from django.db.migrations.executor import MigrationExecutor
+
+        self.executor = MigrationExecutor(connection)
+        self.executor.migrate(self.migrate_from)
+        self.apps = self.executor.loader.project_state(self.migrate_from).apps
+
+    def tearDown(self):
+        from django.db import connection
+        from django.db.migrations.executor import MigrationExecutor
+
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
+    def test_duplicate_pairs_are_merged_into_oldest_conversation(self):
+        """Test that duplicate pairs fold into the oldest conversation with their messages"""
+        from django.db import connection
+        from django.db.migrations.executor import MigrationExecutor
+
+        User_ = self.apps.get_model("auth", "User")
+        Conversation_ = self.apps.get_model("store_app", "Conversation")
+        Message_ = self.apps.get_model("store_app", "Message")
+        State_ = self.apps.get_model("store_app", "ConversationParticipantState")
+
+        user1 = User_.objects.create(username="user1", email="user1@upr.edu")
+        user2 = User_.objects.create(username="user2", email="user2@upr.edu")
+        keeper = Conversation_.objects.create()
+        duplicate = Conversation_.objects.create()
+        for conversation in (keeper, duplicate):
+            conversation.participants.add(user1, user2)
+            State_.objects.create(conversation=conversation, user=user1)
+            State_.objects.create(conversation=conversation, user=user2)
+        Message_.objects.create(conversation=keeper, sender=user1, content="First")
+        moved = Message_.objects.create(conversation=duplicate, sender=user1, content="Second")
+
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate(self.migrate_to)
+        apps = executor.loader.project_state(self.migrate_to).apps
+        Conversation_ = apps.get_model("store_app", "Conversation")
+        Message_ = apps.get_model("store_app", "Message")
+        State_ = apps.get_model("store_app", "ConversationParticipantState")
+
+        self.assertFalse(Conversation_.objects.filter(id=duplicate.id).exists())
+        self.assertEqual(Message_.objects.get(id=moved.id).conversation_id, keeper.id)
+        keeper = Conversation_.objects.get(id=keeper.id)
+        self.assertEqual(keeper.user_low_id, min(user1.id, user2.id))
+        self.assertEqual(State_.objects.get(conversation_id=keeper.id, user_id=user2.id).unread_count, 2)
+
+
+class LastMessagePointerTests(TestCase):
+    """Tests for the denormalized latest message of each conversation"""
+
+    def setUp(self):
+        self.buyer = User.objects.create_user(
+            username="buyer", email="buyer@upr.edu", password="pass123"
+        )
+        self.seller = User.objects.create_user(
+            username="seller", email="seller@upr.edu", password="pass123"
+        )
+        self.conversation, _ = Conversation.get_or_create_conversation(self.buyer, self.seller)
+
+    def test_pointer_follows_new_messages(self):
+        """Test that each new message moves the pointer and a late, older one does not"""
+        first = Message.objects.create(conversation=self.conversation, sender=self.seller, content="Hi")
+        second = Message.objects.create(conversation=self.conversation, sender=self.buyer, content="x" * 200)
+
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.last_message_id, second.id)
+        self.assertEqual(self.conversation.last_message_at, second.created_at)
+        self.assertEqual(self.conversation.last_message_preview, "x" * 120)
+
+        # A message whose post_save runs after a newer one's
+        Conversation.record_new_message(first)
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.last_message_id, second.id)
+
+    def test_inbox_reads_no_messages(self):
+        """Test that the inbox is built from the pointer without querying Message"""
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from .utils.inbox_utils import build_inbox
+
+        empty_partner = User.objects.create_user(
+            username="other", email="other@upr.edu", password="pass123"
+        )
+        empty, _ = Conversation.get_or_create_conversation(self.buyer, empty_partner)
+        message = Message.objects.create(conversation=self.conversation, sender=self.seller, content="Hi")
+
+        with CaptureQueriesContext(connection) as queries:
+            inbox = build_inbox(self.buyer)
+
+        self.assertFalse(
+            any(Message._meta.db_table in q["sql"].split("FROM", 1)[1].split("WHERE")[0] for q in queries)
+        )
+        self.assertEqual([entry["conversation"].id for entry in inbox], [self.conversation.id, empty.id])
+        self.assertEqual(inbox[0]["latest_message"].id, message.id)
+        self.assertEqual(inbox[0]["latest_message"].content, "Hi")
+        self.assertEqual(inbox[0]["unread_count"], 1)
+        self.assertIsNone(inbox[1]["latest_message"])
+
+    def test_rebuild_command_repairs_pointers(self):
+        """Test that rebuild_last_messages recomputes stale pointers and missing states"""
+        from django.core.management import call_command
+        from io import StringIO
+        from .models import ConversationParticipantState
+
+        message = Message.objects.create(conversation=self.conversation, sender=self.seller, content="Hi")
+        Conversation.objects.update(last_message_id=0, last_message_at=None, last_message_preview="")
+        ConversationParticipantState.objects.filter(user=self.buyer).delete()
+
+        out = StringIO()
+        call_command("rebuild_last_messages", "--batch-size", "1", stdout=out)
+
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.last_message_id, message.id)
+        self.assertEqual(self.conversation.last_message_preview, "Hi")
+        state = ConversationParticipantState.objects.get(conversation=self.conversation, user=self.buyer)
+        self.assertEqual(state.unread_count, 1)
+        self.assertEqual(state.last_message_at, message.created_at)
+        self.assertIn("Rebuilt 1 conversation pointer(s)", out.getvalue())
+
+    def test_deleting_messages_resets_pointer(self):
+        """Test that purging a conversation's messages clears its pointer"""
+        from .utils.purge_utils import delete_messages_in_batches
+
+        Message.objects.create(conversation=self.conversation, sender=self.seller, content="Hi")
+        delete_messages_in_batches(Message.objects.all())
+
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.last_message_id, 0)
+        self.assertEqual(self.conversation.last_message_preview, "")
+
+
+class InboxCacheTests(TestCase):
+    """Tests for the per-user cached inbox and its invalidation"""
+
+    def setUp(self):
+        self.buyer = User.objects.create_user(
+            username="buyer", email="buyer@upr.edu", password="pass123"
+        )
+        self.seller = User.objects.create_user(
+            username="seller", email="seller@upr.edu", password="pass123", first_name="Ana"
+        )
+        self.conversation, _ = Conversation.get_or_create_conversation(self.buyer, self.seller)
+        Message.objects.create(conversation=self.conversation, sender=self.seller, content="Hi")
+        self.client.login(username="buyer", password="pass123")
+        self.url = reverse("store_app:get_conversations_update")
+
+    def test_idle_poll_runs_no_inbox_sql(self):
+        """Test that repeated polls are served from the cache without touching the app's tables"""
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        count_url = reverse("store_app:get_unread_messages_count")
+        cursor = self.client.get(self.url).json()["cursor"]
+        self.client.get(count_url)
+
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=f'"{cursor}"')
+            self.client.get(count_url)
+
+        self.assertEqual(response.status_code, 304)
+        # Only the session and user lookups of the auth middleware remain
+        self.assertEqual([q["sql"] for q in ctx.captured_queries if "store_app_" in q["sql"]], [])
+
+    def test_new_message_invalidates_both_inboxes(self):
+        """Test that a new message changes the cached inbox of every participant"""
+        first = self.client.get(self.url).json()
+
+        Message.objects.create(conversation=self.conversation, sender=self.seller, content="Still there?")
+        second = self.client.get(self.url).json()
+
+        self.assertNotEqual(second["cursor"], first["cursor"])
+        self.assertEqual(second["conversations"][0]["latest_message"]["content"], "Still there?")
+        self.assertEqual(second["conversations"][0]["unread_count"], 2)
+
+    def test_reading_conversation_invalidates_badge(self):
+        """Test that the cached unread badge drops once the conversation is read"""
+        count_url = reverse("store_app:get_unread_messages_count")
+        self.assertEqual(self.client.get(count_url).json()["unread_count"], 1)
+
+        self.client.get(reverse("store_app:conversation", args=[self.conversation.id]))
+
+        self.assertEqual(self.client.get(count_url).json()["unread_count"], 0)
+
+    def test_partner_profile_changes_invalidate_inbox(self):
+        """Test that a new name or profile picture shows up in the other participant's cached inbox"""
+        self.client.get(self.url)
+
+        self.seller.first_name = "Beatriz"
+        self.seller.save()
+        self.assertEqual(
+            self.client.get(self.url).json()["conversations"][0]["other_participant_name"], "Beatriz"
+        )
+
+        profile = UserProfile.objects.get(user=self.seller)
+        profile.profile_picture = "uploads/profile_pictures/beatriz.png"
+        profile.save()
+        self.assertEqual(
+            self.client.get(self.url).json()["conversations"][0]["other_participant_profile_picture"],
+            "uploads/profile_pictures/beatriz.png",
+        )
+
+
+class MessageSyncTests(TestCase):
+    """Tests for the combined badge/inbox/conversation sync endpoint"""
+
+    def setUp(self):
+        self.buyer = User.objects.create_user(
+            username="buyer", email="buyer@upr.edu", password="pass123"
+        )
+        self.seller = User.objects.create_user(
+            username="seller", email="seller@upr.edu", password="pass123"
+        )
+        self.conversation, _ = Conversation.get_or_create_conversation(self.buyer, self.seller)
+        self.first = Message.objects.create(conversation=self.conversation, sender=self.seller, content="Hi")
+        self.client.login(username="buyer", password="pass123")
+        self.url = reverse("store_app:sync_messages")
+
+    def test_one_sync_returns_badge_inbox_and_thread(self):
+        """Test that a sync answers every section and marks the thread's new messages read"""
+        response = self.client.get(
+            self.url, {"inbox": "", "conversation": self.conversation.id, "last_message_id": 0}
+        )
+
+        data = response.json()
+        self.assertEqual([m["content"] for m in data["conversation"]["messages"]], ["Hi"])
+        self.assertEqual(data["unread_count"], 0)
+        self.assertTrue(data["inbox"]["full"])
+        self.assertEqual(data["inbox"]["conversations"][0]["unread_count"], 0)
+        self.assertEqual(data["next_poll_ms"], 3000)
+        self.assertEqual(data["idle"], 0)
+
+    def test_next_poll_backs_off_while_idle_and_tightens_on_activity(self):
+        """Test that empty syncs stretch next_poll_ms and new messages or user activity reset it"""
+        from .utils.sync_utils import SYNC_MAX_POLL_MS
+
+        params = {"conversation": self.conversation.id, "last_message_id": self.first.id}
+        idle = self.client.get(self.url, {**params, "idle": 0}).json()
+        self.assertEqual((idle["idle"], idle["next_poll_ms"]), (1, 4500))
+        idle = self.client.get(self.url, {**params, "idle": 20}).json()
+        self.assertEqual(idle["next_poll_ms"], SYNC_MAX_POLL_MS)
+        # A tab left open long enough must not overflow the backoff
+        idle = self.client.get(self.url, {**params, "idle": 5000}).json()
+        self.assertEqual(idle["next_poll_ms"], SYNC_MAX_POLL_MS)
+        self.assertLessEqual(idle["idle"], 20)
+
+        active = self.client.get(self.url, {**params, "idle": 20, "active": 1}).json()
+        self.assertEqual((active["idle"], active["next_poll_ms"]), (0, 3000))
+
+        Message.objects.create(conversation=self.conversation, sender=self.seller, content="Hello?")
+        fresh = self.client.get(self.url, {**params, "idle": 20}).json()
+        self.assertEqual(len(fresh["conversation"]["messages"]), 1)
+        self.assertEqual(fresh["next_poll_ms"], 3000)
+
+    def test_idle_sync_runs_no_app_sql(self):
+        """Test that a sync with nothing new is answered from the cached inbox"""
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        params = {"conversation": self.conversation.id, "last_message_id": self.first.id, "unread": 1}
+        cursor = self.client.get(self.url, {**params, "inbox": ""}).json()["inbox"]["cursor"]
+
+        with CaptureQueriesContext(connection) as ctx:
+            data = self.client.get(self.url, {**params, "inbox": cursor}).json()
+
+        self.assertEqual(data["inbox"]["conversations"], [])
+        self.assertEqual(data["conversation"]["messages"], [])
+        # Only the conversation's last_message_id, by primary key
+        app_queries = [q["sql"] for q in ctx.captured_queries if "store_app_" in q["sql"]]
+        self.assertEqual(len(app_queries), 1)
+        self.assertIn('"last_message_id"', app_queries[0])
+
+    def test_new_message_reaches_a_thread_with_a_stale_cached_inbox(self):
+        """Test that a message shows up even if the cached inbox has not caught up with it yet"""
+        from unittest import mock
+        from .utils.inbox_utils import get_inbox_snapshot
+
+        stale = get_inbox_snapshot(self.buyer)
+        Message.objects.create(conversation=self.conversation, sender=self.seller, content="Still there?")
+
+        params = {"conversation": self.conversation.id, "last_message_id": self.first.id}
+        with mock.patch("store_app.utils.sync_utils.get_inbox_snapshot", return_value=stale):
+            data = self.client.get(self.url, params).json()
+        self.assertEqual([m["content"] for m in data["conversation"]["messages"]], ["Still there?"])
+
+    def test_outsider_cannot_sync_conversation(self):
+        """Test that syncing a conversation the user is not part of returns 404"""
+        User.objects.create_user(username="other", email="other@upr.edu", password="pass123")
+        self.client.login(username="other", password="pass123")
+
+        response = self.client.get(self.url, {"conversation": self.conversation.id})
+
+        self.assertEqual(response.status_code, 404)
+
+
+class PresenceTests(TestCase):
+    """Tests for the cache-backed presence and typing indicators"""
+
+    def setUp(self):
+        from django.core.cache import cache
+
+        cache.clear()
+        self.buyer = User.objects.create_user(
+            username="buyer", email="buyer@upr.edu", password="pass123"
+        )
+        self.seller = User.objects.create_user(
+            username="seller", email="seller@upr.edu", password="pass123"
+        )
+        self.conversation, _ = Conversation.get_or_create_conversation(self.buyer, self.seller)
+        Message.objects.create(conversation=self.conversation, sender=self.seller, content="Hi")
+        self.url = reverse("store_app:sync_messages")
+        self.params = {"inbox": "", "conversation": self.conversation.id, "last_message_id": 0}
+
+    def test_sync_reports_the_other_participant_online_and_typing(self):
+        """Test that a sync is a heartbeat and carries its typing notice to the other participant"""
+        self.client.login(username="seller", password="pass123")
+        offline = self.client.get(self.url, self.params).json()
+        self.assertEqual(
+            offline["conversation"]["presence"], {"online": False, "last_seen": None, "typing": False}
+        )
+        self.assertEqual(offline["inbox"]["online"], [])
+        self.client.get(self.url, {**self.params, "typing": 1})
+
+        self.client.login(username="buyer", password="pass123")
+        data = self.client.get(self.url, self.params).json()
+
+        self.assertTrue(data["conversation"]["presence"]["online"])
+        self.assertTrue(data["conversation"]["presence"]["typing"])
+        self.assertIsNotNone(data["conversation"]["presence"]["last_seen"])
+        self.assertEqual(data["inbox"]["online"], [self.conversation.id])
+
+    def test_presence_expires_without_heartbeats(self):
+        """Test that a user goes offline, but keeps a last seen time, once heartbeats stop"""
+        from unittest import mock
+
+        from .utils.presence_utils import PRESENCE_ONLINE_SECONDS, get_conversation_presence, touch_presence
+
+        with mock.patch("store_app.utils.presence_utils.time.time", return_value=1000.0):
+            touch_presence(self.seller.id)
+        with mock.patch(
+            "store_app.utils.presence_utils.time.time", return_value=1000.0 + PRESENCE_ONLINE_SECONDS + 1
+        ):
+            presence = get_conversation_presence(self.conversation.id, self.seller.id)
+
+        self.assertFalse(presence["online"])
+        self.assertEqual(presence["last_seen"], "1970-01-01T00:16:40+00:00")
+
+    def test_heartbeats_and_typing_do_not_write_to_the_database(self):
+        """Test that presence and typing updates never INSERT or UPDATE a row"""
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        self.client.login(username="seller", password="pass123")
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.get(self.url, {"conversation": self.conversation.id, "last_message_id": 10**9, "typing": 1})
+
+        writes = [q["sql"] for q in ctx.captured_queries if q["sql"].startswith(("INSERT", "UPDATE"))]
+        self.assertEqual(writes, [])
+
+
+class MessageAttachmentTests(TestCase):
+    """Tests for streamed attachment uploads, background thumbnails and cached serving"""
+
+    def setUp(self):
+        import shutil
+        import tempfile
+
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        media = override_settings(MEDIA_ROOT=media_root)
+        media.enable()
+        self.addCleanup(media.disable)
+
+        self.buyer = User.objects.create_user(
+            username="buyer", email="buyer@upr.edu", password="pass123"
+        )
+        self.seller = User.objects.create_user(
+            username="seller", email="seller@upr.edu", password="pass123"
+        )
+        self.conversation, _ = Conversation.get_or_create_conversation(self.buyer, self.seller)
+        self.url = reverse("store_app:upload_message_attachment", args=[self.conversation.id])
+        self.client.login(username="buyer", password="pass123")
+
+    def test_image_upload_is_thumbnailed_by_the_worker(self):
+        """Test that an upload is stored without a thumbnail until the worker renders one"""
+        from .models import MessageAttachment
+        from .utils.attachment_utils import generate_pending_thumbnails
+
+        response = self.client.post(
+            self.url, {"file": create_test_image("photo.png", size=(1200, 800)), "content": "The bike"}
+        )
+
+        self.assertEqual(response.status_code, 201)
+        payload = response.json()["message"]
+        self.assertEqual(payload["content"], "The bike")
+        self.assertEqual(payload["attachments"][0]["kind"], "image")
+        self.assertIsNone(payload["attachments"][0]["thumbnail_url"])
+        attachment = MessageAttachment.objects.get()
+        self.assertEqual(attachment.thumbnail_status, MessageAttachment.THUMBNAIL_PENDING)
+        self.assertEqual(attachment.content_type, "image/png")
+
+        self.assertEqual(generate_pending_thumbnails(), (1, 0))
+
+        attachment.refresh_from_db()
+        self.assertEqual(attachment.thumbnail_status, MessageAttachment.THUMBNAIL_READY)
+        with attachment.thumbnail.open("rb") as thumbnail, Image.open(thumbnail) as image:
+            self.assertLessEqual(max(image.size), 320)
+        self.client.login(username="seller", password="pass123")
+        polled = self.client.get(
+            reverse("store_app:get_new_messages", args=[self.conversation.id]), {"last_message_id": 0}
+        ).json()["messages"][0]["attachments"][0]
+        self.assertEqual(
+            polled["thumbnail_url"],
+            reverse("store_app:message_attachment_thumbnail", args=[attachment.id]),
+        )
+
+    def test_upload_size_cap_and_type_check(self):
+        """Test that oversized files get a 413 and files that are neither images nor PDFs a 400"""
+        with override_settings(MESSAGE_ATTACHMENT_MAX_SIZE=1024):
+            response = self.client.post(
+                self.url, {"file": SimpleUploadedFile("big.pdf", b"%PDF-" + b"0" * 4096)}
+            )
+        self.assertEqual(response.status_code, 413)
+
+        response = self.client.post(
+            self.url, {"file": SimpleUploadedFile("notes.png", b"not really an image")}
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Message.objects.exists())
+
+        response = self.client.post(self.url, {"file": SimpleUploadedFile("offer.pdf", b"%PDF-1.4 offer")})
+        self.assertEqual(response.status_code, 201)
+        self.assertIsNone(response.json()["message"]["attachments"][0]["thumbnail_url"])
+
+    def test_files_are_served_to_participants_with_long_cache_headers(self):
+        """Test that attachments are immutable-cached for participants and hidden from others"""
+        from .models import MessageAttachment
+        from .utils.attachment_utils import generate_pending_thumbnails
+
+        self.client.post(self.url, {"file": create_test_image("photo.png")})
+        generate_pending_thumbnails()
+        attachment = MessageAttachment.objects.get()
+        url = reverse("store_app:message_attachment_thumbnail", args=[attachment.id])
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "image/webp")
+        self.assertIn("immutable", response["Cache-Control"])
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response["ETag"]).status_code, 304)
+        b"".join(response.streaming_content)
+
+        User.objects.create_user(username="outsider", email="outsider@upr.edu", password="pass123")
+        self.client.login(username="outsider", password="pass123")
+        self.assertEqual(
+            self.client.get(reverse("store_app:message_attachment", args=[attachment.id])).status_code, 404
+        )
+
+
+class MessagingAdminTests(TestCase):
+    """Tests for the Conversation and Message admin changelists"""
+
+    def setUp(self):
+        self.admin = User.objects.create_superuser(
+            username="admin", email="admin@upr.edu", password="pass123"
+        )
+        self.buyer = User.objects.create_user(
+            username="buyer", email="buyer@upr.edu", password="pass123"
+        )
+        self.client.login(username="admin", password="pass123")
+
+    def _add_conversations(self, count):
+        start = User.objects.count()
+        for i in range(start, start + count):
+            seller = User.objects.create_user(
+                username=f"seller{i}", email=f"seller{i}@upr.edu", password="pass123"
+            )
+            conversation, _ = Conversation.get_or_create_conversation(self.buyer, seller)
+            Message.objects.create(conversation=conversation, sender=seller, content=f"Hello {i}")
+
+    def _changelist_queries(self, model_name, params=None):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        url = reverse(f"admin:store_app_{model_name}_changelist")
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url, params or {})
+        self.assertEqual(response.status_code, 200)
+        return len(ctx.captured_queries)
+
+    def test_changelists_cost_the_same_for_any_number_of_rows(self):
+        """Test that counts, participants and read state come from the page query, not per row"""
+        self._add_conversations(1)
+        conversation_queries = self._changelist_queries("conversation")
+        message_queries = self._changelist_queries("message")
+
+        self._add_conversations(10)
+
+        self.assertEqual(self._changelist_queries("conversation"), conversation_queries)
+        self.assertEqual(self._changelist_queries("message"), message_queries)
+
+    def test_search_uses_exact_usernames_and_ids(self):
+        """Test that admin search matches ids and exact usernames rather than substrings"""
+        self._add_conversations(2)
+        url = reverse("admin:store_app_conversation_changelist")
+
+        response = self.client.get(url, {"q": "seller2"})
+        self.assertEqual(len(response.context["cl"].result_list), 1)
+        self.assertEqual(response.context["cl"].result_list[0]._message_count, 1)
+        response = self.client.get(url, {"q": "seller"})
+        self.assertEqual(len(response.context["cl"].result_list), 0)
+
+        message = Message.objects.get(content="Hello 2")
+        response = self.client.get(reverse("admin:store_app_message_changelist"), {"q": str(message.id)})
+        self.assertIn(message, response.context["cl"].result_list)
+        response = self.client.get(reverse("admin:store_app_message_changelist"), {"q": "Hello"})
+        self.assertEqual(len(response.context["cl"].result_list), 2)
+
+    def test_deleting_messages_takes_them_off_unread_counters(self):
+        """Test that messages deleted in the admin no longer count as unread"""
+        from .models import ConversationParticipantState
+
+        self._add_conversations(1)
+        conversation = Conversation.objects.get()
+        seller = conversation.get_other_participant(self.buyer)
+        hello = Message.objects.get(conversation=conversation)
+        spam = Message.objects.create(conversation=conversation, sender=seller, content="spam!!")
+        spam_again = Message.objects.create(conversation=conversation, sender=seller, content="spam!!")
+
+        url = reverse("admin:store_app_message_change", args=[spam.id]).replace("change/", "delete/")
+        self.client.post(url, {"post": "yes"})
+        self.client.post(
+            reverse("admin:store_app_message_changelist"),
+            {"action": "delete_selected", "_selected_action": [spam_again.id], "post": "yes"},
+        )
+
+        self.assertEqual(Message.objects.filter(content="spam!!").count(), 0)
+        state = ConversationParticipantState.objects.get(user=self.buyer, conversation=conversation)
+        self.assertEqual(state.unread_count, 1)
+        ConversationParticipantState.mark_read(self.buyer, conversation.id)
+        state.refresh_from_db()
+        self.assertEqual(state.unread_count, 0)
+        conversation.refresh_from_db()
+        self.assertEqual(conversation.last_message_id, hello.id)
+        self.assertEqual(conversation.last_message_preview, hello.content)
+
+
+class KeysetPaginationTests(TestCase):
+    """Tests for the keyset pagination of the catalog grids"""
+
+    def setUp(self):
+        self.seller = User.objects.create_user(
+            username="seller", email="seller@upr.edu", password="pass123"
+        )
+        self.category = ProductCategory.objects.create(name="Books", slug="books")
+        Product.objects.bulk_create(
+            Product(name=f"Book {i}", price=Decimal("5.00"), category=self.category, user_vendor=self.seller)
+            for i in range(30)
+        )
+
+    def _get(self, params=None):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse("store_app:all_products"), params or {})
+        self.assertEqual(response.status_code, 200)
+        return response.context["products_page_obj"], ctx.captured_queries
+
+    def test_pages_cover_the_listing_in_both_directions(self):
+        """Test that following next and then previous cursors visits every product once, newest first"""
+        expected = list(Product.objects.order_by("-id").values_list("id", flat=True))
+
+        pages = [self._get()[0]]
+        while pages[-1].has_next():
+            pages.append(self._get({"cursor": pages[-1].next_cursor})[0])
+        self.assertEqual([len(page) for page in pages], [12, 12, 6])
+        self.assertEqual([p.id for page in pages for p in page], expected)
+        self.assertFalse(pages[0].has_previous())
+
+        page = pages[-1]
+        back = []
+        while page.has_previous():
+            page = self._get({"cursor": page.previous_cursor})[0]
+            back.append([p.id for p in page])
+        self.assertEqual(back, [[p.id for p in pages[1]], [p.id for p in pages[0]]])
+        self.assertFalse(page.has_previous())
+
+    def test_deep_pages_cost_the_same_as_the_first(self):
+        """Test that a later page runs the same queries as the first, with no OFFSET and no COUNT"""
+        # Three full pages, so every page renders as many cards
+        Product.objects.bulk_create(
+            Product(name=f"Novel {i}", price=Decimal("5.00"), category=self.category, user_vendor=self.seller)
+            for i in range(6)
+        )
+        first, first_queries = self._get()
+        second, _ = self._get({"cursor": first.next_cursor})
+        last, last_queries = self._get({"cursor": second.next_cursor})
+
+        self.assertEqual(len(last_queries), len(first_queries))
+        product_queries = [q["sql"] for q in last_queries if 'FROM "store_app_product"' in q["sql"]]
+        # The listing itself, then the "About N products" estimate
+        self.assertEqual(len(product_queries), 2)
+        self.assertIn("LIMIT 13", product_queries[0])
+        self.assertNotIn("OFFSET", product_queries[0])
+        self.assertNotIn("COUNT", product_queries[0])
+
+    def test_invalid_cursor_shows_the_first_page(self):
+        """Test that a malformed or old page-number parameter falls back to the first page"""
+        first, _ = self._get()
+        for cursor in ("3", "x.1", "a.-1", "a.b", ""):
+            page, _ = self._get({"cursor": cursor})
+            self.assertEqual([p.id for p in page], [p.id for p in first])
+            self.assertFalse(page.has_previous())
+
+
+class TranscriptExportTests(TestCase):
+    """Tests for the streaming transcript export endpoint and command"""
+
+    def setUp(self):
+        self.buyer = User.objects.create_user(
+            username="buyer", email="buyer@upr.edu", password="pass123"
+        )
+        self.seller = User.objects.create_user(
+            username="seller", email="seller@upr.edu", password="pass123"
+        )
+        self.conversation, _ = Conversation.get_or_create_conversation(self.buyer, self.seller)
+        Message.objects.create(conversation=self.conversation, sender=self.seller, content="Hi")
+        Message.objects.create(conversation=self.conversation, sender=self.buyer, content='Is it "new",\nstill?')
+        self.url = reverse("store_app:export_conversation", args=[self.conversation.id])
+
+    def test_participant_streams_jsonl(self):
+        """Test that a participant gets the transcript as streamed JSON Lines, oldest first"""
+        import json
+
+        self.client.login(username="buyer", password="pass123")
+        response = self.client.get(self.url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response["Content-Type"], "application/x-ndjson; charset=utf-8")
+        self.assertIn('filename="conversation-', response["Content-Disposition"])
+        rows = [json.loads(line) for line in b"".join(response.streaming_content).decode().splitlines()]
+        self.assertEqual([row["sender"] for row in rows], ["seller", "buyer"])
+        self.assertEqual(rows[1]["content"], 'Is it "new",\nstill?')
+
+    def test_access_and_csv_format(self):
+        """Test that outsiders get a 404, staff may export, and CSV quotes awkward content"""
+        import csv
+        import io
+
+        User.objects.create_user(username="outsider", email="outsider@upr.edu", password="pass123")
+        self.client.login(username="outsider", password="pass123")
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+
+        User.objects.create_user(
+            username="moderator", email="moderator@upr.edu", password="pass123", is_staff=True
+        )
+        self.client.login(username="moderator", password="pass123")
+        self.assertEqual(self.client.get(self.url, {"format": "xml"}).status_code, 400)
+        response = self.client.get(self.url, {"format": "csv"})
+
+        self.assertEqual(response.status_code, 200)
+        rows = list(csv.DictReader(io.StringIO(b"".join(response.streaming_content).decode())))
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[1]["content"], 'Is it "new",\nstill?')
+        self.assertEqual(rows[0]["product"], "")
+
+    def test_csv_neutralizes_formulas(self):
+        """Test that CSV cells a spreadsheet would run as formulas are prefixed with a quote"""
+        import csv
+        import io
+
+        for content in ("=HYPERLINK(\"http://evil\")", "+1", "-2", "@SUM(A1)", "\tx", "\rx"):
+            Message.objects.create(conversation=self.conversation, sender=self.seller, content=content)
+        self.client.login(username="buyer", password="pass123")
+        response = self.client.get(self.url, {"format": "csv"})
+
+        rows = list(csv.DictReader(io.StringIO(b"".join(response.streaming_content).decode(), newline="")))
+        self.assertEqual(
+            [row["content"] for row in rows[2:]],
+            ["'=HYPERLINK(\"http://evil\")", "'+1", "'-2", "'@SUM(A1)", "'\tx", "'\rx"],
+        )
+        self.assertEqual(rows[0]["content"], "Hi")
+
+    async def test_asgi_streams_asynchronously(self):
+        """Test that under ASGI the transcript is streamed from an async iterator"""
+        import json
+        from django.test import AsyncClient
+
+        client = AsyncClient()
+        await client.aforce_login(self.buyer)
+        response = await client.get(self.url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.is_async)
+        content = b"".join([chunk async for chunk in response.streaming_content])
+        rows = [json.loads(line) for line in content.decode().splitlines()]
+        self.assertEqual([row["sender"] for row in rows], ["seller", "buyer"])
+
+    def test_export_command_writes_file(self):
+        """Test that export_transcripts exports a user's conversations to a file"""
+        import json
+        import os
+        import tempfile
+        from django.core.management import call_command
+        from io import StringIO
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "transcripts.jsonl")
+            err = StringIO()
+            call_command(
+                "export_transcripts", "--user", "seller", "--output", path, "--chunk-size", "1", stderr=err
+            )
+            with open(path, encoding="utf-8") as output:
+                rows = [json.loads(line) for line in output]
+
+        self.assertEqual(len(rows), 2)
+        self.assertEqual({row["conversation_id"] for row in rows}, {self.conversation.id})
+        self.assertIn("Exported 2 message(s)", err.getvalue())
+
+
+class MessageDigestTests(TestCase):
+    """Tests for the send_message_digests command"""
+
+    def setUp(self):
+        from datetime import timedelta
+        from django.utils import timezone
+
+        self.buyer = User.objects.create_user(
+            username="buyer", email="buyer@upr.edu", password="pass123", first_name="Luis"
+        )
+        self.seller = User.objects.create_user(
+            username="seller", email="seller@upr.edu", password="pass123", first_name="Ana"
+        )
+        self.conversation, _ = Conversation.get_or_create_conversation(self.buyer, self.seller)
+        message = Message.objects.create(conversation=self.conversation, sender=self.seller, content="Still there?")
+        Message.objects.filter(id=message.id).update(created_at=timezone.now() - timedelta(hours=2))
+
+    def test_digest_sent_once_per_activity(self):
+        """Test that unread users get one digest and reruns do not resend it"""
+        from django.core import mail
+        from django.core.management import call_command
+        from io import StringIO
+
+        out = StringIO()
+        call_command("send_message_digests", stdout=out)
+
+        self.assertEqual(len(mail.outbox), 1)
+        digest = mail.outbox[0]
+        self.assertEqual(digest.to, ["buyer@upr.edu"])
+        self.assertIn("1 unread message", digest.subject)
+        self.assertIn("Ana", digest.alternatives[0][0])
+        self.assertIn("Still there?", digest.alternatives[0][0])
+        self.assertIn("Sent 1 digest(s)", out.getvalue())
+
+        call_command("send_message_digests", stdout=StringIO())
+        self.assertEqual(len(mail.outbox), 1)
+
+        # New activity in the conversation makes the user owed a digest again
+        from datetime import timedelta
+        from .models import UserProfile
+
+        UserProfile.objects.filter(user=self.buyer).update(
+            message_digest_sent_at=self.conversation.last_message_at - timedelta(hours=1)
+        )
+        Message.objects.create(conversation=self.conversation, sender=self.seller, content="Hello?")
+        call_command("send_message_digests", stdout=StringIO())
+        self.assertEqual(len(mail.outbox), 2)
+
+    def test_recent_or_read_messages_are_skipped(self):
+        """Test that messages newer than the threshold or already read do not trigger a digest"""
+        from django.core import mail
+        from django.core.management import call_command
+        from io import StringIO
+        from .models import ConversationParticipantState
+
+        out = StringIO()
+        call_command("send_message_digests", "--minutes", "180", "--dry-run", stdout=out)
+        self.assertIn("0 user(s)", out.getvalue())
+
+        ConversationParticipantState.mark_read(self.buyer, self.conversation.id)
+        call_command("send_message_digests", stdout=StringIO())
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_totals_and_list_cover_the_same_conversations(self):
+        """Test that a conversation that does not qualify is neither counted nor listed"""
+        from django.core import mail
+        from django.core.management import call_command
+        from io import StringIO
+
+        neighbor = User.objects.create_user(
+            username="neighbor", email="neighbor@upr.edu", password="pass123", first_name="Marta"
+        )
+        conversation, _ = Conversation.get_or_create_conversation(self.buyer, neighbor)
+        # Unread, but too recent to be owed a digest
+        Message.objects.create(conversation=conversation, sender=neighbor, content="Just now")
+
+        call_command("send_message_digests", stdout=StringIO())
+
+        self.assertEqual(len(mail.outbox), 1)
+        digest = mail.outbox[0]
+        self.assertIn("1 unread message(s) in 1 conversation(s)", digest.body)
+        self.assertIn("Ana", digest.body)
+        self.assertNotIn("Marta", digest.body)
+        self.assertNotIn("more conversation", digest.alternatives[0][0])
+
+    def test_partly_sent_batch_is_not_recorded(self):
+        """Test that a batch the backend did not fully send is left to be retried"""
+        from datetime import timedelta
+        from django.utils import timezone
+        from .models import UserProfile
+        from .utils.digest_utils import get_digest_recipients, send_digest_batch
+
+        other = User.objects.create_user(username="other", email="other@upr.edu", password="pass123")
+        conversation, _ = Conversation.get_or_create_conversation(other, self.seller)
+        Message.objects.create(conversation=conversation, sender=self.seller, content="Hi")
+        Message.objects.update(created_at=timezone.now() - timedelta(hours=2))
+
+        class PartialConnection:
+            def send_messages(self, emails):
+                return len(emails) - 1
+
+        cutoff = timezone.now() - timedelta(hours=1)
+        recipients = list(get_digest_recipients(cutoff))
+        self.assertEqual(len(recipients), 2)
+
+        sent = send_digest_batch(PartialConnection(), recipients, timezone.now(), cutoff)
+
+        self.assertEqual(sent, 1)
+        self.assertFalse(UserProfile.objects.filter(message_digest_sent_at__isnull=False).exists())
+        self.assertEqual(len(get_digest_recipients(cutoff)), 2)
+
+    def test_recipients_found_in_one_query(self):
+        """Test that a batch of digests costs a constant number of queries"""
+        from datetime import timedelta
+        from django.utils import timezone
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from django.core.management import call_command
+        from io import StringIO
+
+        for i in range(5):
+            user = User.objects.create_user(username=f"user{i}", email=f"user{i}@upr.edu", password="pass123")
+            conversation, _ = Conversation.get_or_create_conversation(user, self.seller)
+            Message.objects.create(conversation=conversation, sender=self.seller, content="Hi")
+        Message.objects.update(created_at=timezone.now() - timedelta(hours=2))
+
+        with CaptureQueriesContext(connection) as queries:
+            call_command("send_message_digests", stdout=StringIO())
+
+        from django.core import mail
+
+        self.assertEqual(len(mail.outbox), 6)
+        # Recipients, their conversations, and the throttling UPDATE
+        self.assertEqual(len(queries), 3)
+
+
+class ConversationBootstrapTests(TestCase):
+    """Tests for opening the conversation page directly or from a listing"""
+
+    def setUp(self):
+        self.buyer = User.objects.create_user(
+            username="buyer", email="buyer@upr.edu", password="pass123"
+        )
+        self.seller = User.objects.create_user(
+            username="seller", email="seller@upr.edu", password="pass123"
+        )
+        self.category = ProductCategory.objects.create(name="Books", slug="books")
+        self.product = self._add_product("Calculus book")
+        self.client.login(username="buyer", password="pass123")
+
+    def _add_product(self, name):
+        return Product.objects.create(
+            name=name, price=Decimal("20.00"), category=self.category, user_vendor=self.seller
+        )
+
+    def _open(self, url):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTemplateUsed(response, "conversation.html")
+        return response, len(ctx.captured_queries)
+
+    def test_listing_opens_the_conversation_in_one_response(self):
+        """Test that messaging a seller renders their conversation, linked to the listing, without a redirect"""
+        from .models import ConversationParticipantState
+
+        response, _ = self._open(reverse("store_app:message_listing", args=["product", self.product.id]))
+
+        conversation = Conversation.objects.get()
+        self.assertEqual(response.context["conversation"].id, conversation.id)
+        self.assertEqual(response.context["other_participant"], self.seller)
+        self.assertEqual(conversation.product_id, self.product.id)
+        self.assertEqual(ConversationParticipantState.objects.filter(conversation=conversation).count(), 2)
+
+        other = self._add_product("Physics book")
+        response, _ = self._open(reverse("store_app:message_listing", args=["product", other.id]))
+        conversation.refresh_from_db()
+        self.assertEqual(conversation.product_id, other.id)
+        self.assertEqual(Conversation.objects.count(), 1)
+
+    def test_page_queries_do_not_grow_with_messages_or_listings(self):
+        """Test that the conversation page costs a fixed number of queries, from a listing or directly"""
+        listing_url = reverse("store_app:message_listing", args=["product", self.product.id])
+        self._open(listing_url)
+        conversation = Conversation.objects.get()
+        conversation_url = reverse("store_app:conversation", args=[conversation.id])
+        Message.objects.create(conversation=conversation, sender=self.seller, content="Hi")
+        _, listing_queries = self._open(listing_url)
+        _, page_queries = self._open(conversation_url)
+
+        for i in range(10):
+            self._add_product(f"Book {i}")
+            Message.objects.create(conversation=conversation, sender=self.seller, content=f"Hi {i}", product=self.product)
+
+        self.assertEqual(self._open(listing_url)[1], listing_queries)
+        self.assertEqual(self._open(conversation_url)[1], page_queries)
+
+    def test_own_listing_and_outsiders_are_turned_away(self):
+        """Test that sellers cannot message themselves and outsiders cannot open the page"""
+        conversation, _ = Conversation.get_or_create_conversation(self.buyer, self.seller)
+
+        self.client.login(username="seller", password="pass123")
+        response = self.client.get(reverse("store_app:message_listing", args=["product", self.product.id]))
+        self.assertRedirects(response, reverse("store_app:home"), fetch_redirect_response=False)
+
+        User.objects.create_user(username="outsider", email="outsider@upr.edu", password="pass123")
+        self.client.login(username="outsider", password="pass123")
+        response = self.client.get(reverse("store_app:conversation", args=[conversation.id]))
+        self.assertRedirects(response, reverse("store_app:messages"), fetch_redirect_response=False)
+
+
 class ConversationModelTests(TestCase):
     """Tests for the Conversation model"""
 
@@ -849,6 +2979,35 @@ class ConversationModelTests(TestCase):
         self.assertFalse(created2)
         self.assertEqual(conv1.id, conv2.id)
 
+    def test_get_or_create_conversation_existing_is_single_query(self):
+        """Test that finding an existing pair is one lookup regardless of argument order"""
+        conv1, _ = Conversation.get_or_create_conversation(self.user1, self.user2)
+
+        with self.assertNumQueries(1):
+            conv2, created = Conversation.get_or_create_conversation(self.user2, self.user1)
+
+        self.assertFalse(created)
+        self.assertEqual(conv1.id, conv2.id)
+        self.assertEqual(
+            (conv2.user_low_id, conv2.user_high_id),
+            tuple(sorted((self.user1.id, self.user2.id))),
+        )
+
+    def test_get_or_create_conversation_handles_concurrent_create(self):
+        """Test that losing a create race returns the winner's conversation"""
+        from unittest import mock
+        from django.db.models.query import QuerySet
+
+        winner, _ = Conversation.get_or_create_conversation(self.user1, self.user2)
+
+        # Pretend the lookup ran before the other request committed
+        with mock.patch.object(QuerySet, "first", return_value=None):
+            conversation, created = Conversation.get_or_create_conversation(self.user1, self.user2)
+
+        self.assertFalse(created)
+        self.assertEqual(conversation.id, winner.id)
+        self.assertEqual(Conversation.objects.count(), 1)
+
     def test_get_other_participant(self):
         """Test getting the other participant in a conversation"""
         conversation, _ = Conversation.get_or_create_conversation(self.user1, self.user2)
@@ -895,7 +3054,7 @@ class MessageModelTests(TestCase):
         )
         
         self.assertFalse(message.is_read)
-        self.assertIsNone(message.read_at)
+        self.assertIsNone(message.read_watermark_at)
 
     def test_mark_as_read(self):
         """Test marking a message as read"""
@@ -908,10 +3067,10 @@ class MessageModelTests(TestCase):
         message.mark_as_read()
         
         self.assertTrue(message.is_read)
-        self.assertIsNotNone(message.read_at)
+        self.assertIsNotNone(message.read_watermark_at)
 
     def test_mark_as_read_only_once(self):
-        """Test that marking as read twice doesn't change read_at"""
+        """Test that marking as read twice doesn't move the read watermark"""
         message = Message.objects.create(
             conversation=self.conversation,
             sender=self.user1,
@@ -919,12 +3078,12 @@ class MessageModelTests(TestCase):
         )
         
         message.mark_as_read()
-        first_read_at = message.read_at
+        first_watermark_at = message.read_watermark_at
         
         message.mark_as_read()
         
-        # read_at should not change
-        self.assertEqual(message.read_at, first_read_at)
+        # The watermark time should not change
+        self.assertEqual(message.read_watermark_at, first_watermark_at)
 
 
 class AccountCreationTests(TestCase):
@@ -20,10 +20,19 @@ urlpatterns = [
     ),
     path("add-listing/", views.add_listing, name="add-listing"),
     path("messages/", views.messages_view, name="messages"),
+    path("messages/search/", views.search_messages, name="search_messages"),
     path("messages/update/", views.get_conversations_update, name="get_conversations_update"),
     path("messages/unread-count/", views.get_unread_messages_count, name="get_unread_messages_count"),
+    path("messages/sync/", views.sync_messages, name="sync_messages"),
     path("conversation/<int:conversation_id>/", views.conversation_view, name="conversation"),
+    path("conversation/<int:conversation_id>/send/", views.send_conversation_message, name="send_message"),
     path("conversation/<int:conversation_id>/new-messages/", views.get_new_messages, name="get_new_messages"),
+    path("conversation/<int:conversation_id>/older-messages/", views.get_older_messages, name="get_older_messages"),
+    path("conversation/<int:conversation_id>/stream/", views.conversation_stream, name="conversation_stream"),
+    path("conversation/<int:conversation_id>/export/", views.export_conversation, name="export_conversation"),
+    path("conversation/<int:conversation_id>/attachments/", views.upload_message_attachment, name="upload_message_attachment"),
+    path("messages/attachments/<int:attachment_id>/", views.message_attachment, name="message_attachment"),
+    path("messages/attachments/<int:attachment_id>/thumbnail/", views.message_attachment_thumbnail, name="message_attachment_thumbnail"),
     path("start-conversation/<int:user_id>/", views.start_conversation, name="start_conversation"),
     path("message-listing/<str:listing_type>/<int:listing_id>/", views.start_conversation_from_listing, name="message_listing"),
     path("add-product/", views.add_product, name="add-product"),
@@ -0,0 +1,179 @@
+# utils/attachment_utils.py
+"""
+Image and PDF attachments on messages.
+
+Uploads are streamed: AttachmentUploadHandler spools the request body to a
+temporary file chunk by chunk and stops reading as soon as a file passes
+MESSAGE_ATTACHMENT_MAX_SIZE, so a file is never held in memory whole. The
+upload request only stores the file; thumbnails are made afterwards by the
+generate_attachment_thumbnails worker.
+"""
+from io import BytesIO
+import logging
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.files.base import ContentFile
+from django.core.files.uploadhandler import StopUpload, TemporaryFileUploadHandler
+from django.db import transaction
+from PIL import Image, ImageOps
+from .. import pubsub
+from ..models import MessageAttachment
+from .message_utils import conversation_signal_channel, send_message, serialize_attachment
+
+logger = logging.getLogger(__name__)
+
+# Image formats accepted, by what Pillow detects in the file (not its name)
+ATTACHMENT_IMAGE_TYPES = {
+    "JPEG": "image/jpeg",
+    "PNG": "image/png",
+    "GIF": "image/gif",
+    "WEBP": "image/webp",
+}
+PDF_CONTENT_TYPE = "application/pdf"
+# Room for the multipart boundaries and form fields around the file itself
+ATTACHMENT_REQUEST_OVERHEAD = 64 * 1024
+
+THUMBNAIL_SIZE = (320, 320)
+# Attachments rendered per worker transaction
+THUMBNAIL_BATCH_SIZE = 50
+
+
+def get_attachment_max_size():
+    return getattr(settings, "MESSAGE_ATTACHMENT_MAX_SIZE", 10 * 1024 * 1024)
+
+
+class AttachmentUploadHandler(TemporaryFileUploadHandler):
+    """
+    Writes uploaded files straight to a temporary file, whatever their
+    size, and gives up on a file once it passes `max_size` (too_large is
+    then set and the file is dropped)
+    """
+
+    def __init__(self, request=None, max_size=None):
+        super().__init__(request)
+        self.max_size = max_size or get_attachment_max_size()
+        self.too_large = False
+
+    def receive_data_chunk(self, raw_data, start):
+        if start + len(raw_data) > self.max_size:
+            self.too_large = True
+            self.file.close()
+            # Discard (without buffering) whatever is left of the body
+            raise StopUpload(connection_reset=False)
+        return super().receive_data_chunk(raw_data, start)
+
+
+def inspect_attachment(upload):
+    """
+    (kind, content type) of an uploaded file, judged by its content rather
+    than its name or the type the client claims. Raises ValidationError for
+    anything but a supported image or a PDF.
+    """
+    upload.seek(0)
+    if upload.read(5) == b"%PDF-":
+        upload.seek(0)
+        return MessageAttachment.KIND_PDF, PDF_CONTENT_TYPE
+
+    upload.seek(0)
+    try:
+        # Reads the headers and checks the data without decoding the image
+        with Image.open(upload) as image:
+            image_format = image.format
+            image.verify()
+    except Exception:
+        image_format = None
+    upload.seek(0)
+    if image_format not in ATTACHMENT_IMAGE_TYPES:
+        raise ValidationError("Only images (JPEG, PNG, GIF or WebP) and PDFs can be attached.")
+    return MessageAttachment.KIND_IMAGE, ATTACHMENT_IMAGE_TYPES[image_format]
+
+
+def send_attachment(conversation_id, sender, upload, content="", client_key=None):
+    """
+    Send an uploaded file as a message, with an optional caption, in one
+    transaction. The file is moved into storage as it is (no re-encoding);
+    PDFs need no thumbnail, images are queued for the worker. A retried
+    send with the same `client_key` returns the message stored the first
+    time. Returns (message, created).
+    """
+    kind, content_type = inspect_attachment(upload)
+    original_name = (upload.name or "attachment")[:255]
+    with transaction.atomic():
+        message, created = send_message(
+            conversation_id,
+            sender,
+            # The caption, or the file name so previews and digests say something
+            content or f"Attachment: {original_name}",
+            client_key=client_key,
+        )
+        if created:
+            MessageAttachment.objects.create(
+                message=message,
+                conversation_id=conversation_id,
+                file=upload,
+                kind=kind,
+                content_type=content_type,
+                size=upload.size,
+                original_name=original_name,
+                thumbnail_status=(
+                    MessageAttachment.THUMBNAIL_PENDING
+                    if kind == MessageAttachment.KIND_IMAGE
+                    else MessageAttachment.THUMBNAIL_NONE
+                ),
+            )
+    return message, created
+
+
+def render_thumbnail(attachment):
+    """Store the thumbnail of an image attachment (WebP, at most THUMBNAIL_SIZE)"""
+    with attachment.file.open("rb") as source, Image.open(source) as image:
+        # JPEGs are decoded straight at a reduced scale
+        image.draft("RGB", THUMBNAIL_SIZE)
+        thumbnail = ImageOps.exif_transpose(image)
+        thumbnail.thumbnail(THUMBNAIL_SIZE)
+        if thumbnail.mode not in ("RGB", "RGBA"):
+            thumbnail = thumbnail.convert("RGBA")
+        output = BytesIO()
+        thumbnail.save(output, "WEBP", quality=80)
+    attachment.thumbnail.save("thumbnail.webp", ContentFile(output.getvalue()), save=False)
+
+
+def generate_pending_thumbnails(batch_size=None):
+    """
+    Render the thumbnails of up to `batch_size` pending image attachments.
+
+    Rows are claimed with SELECT ... FOR UPDATE SKIP LOCKED (where the
+    database supports it), so several workers can share the queue. Open
+    conversations are told over their signal channel once a thumbnail is
+    ready. Returns (ready, failed).
+    """
+    batch_size = batch_size or THUMBNAIL_BATCH_SIZE
+    ready = []
+    failed = []
+    with transaction.atomic():
+        pending = list(
+            MessageAttachment.objects.select_for_update(skip_locked=True)
+            .filter(thumbnail_status=MessageAttachment.THUMBNAIL_PENDING)
+            .order_by("id")[:batch_size]
+        )
+        for attachment in pending:
+            try:
+                render_thumbnail(attachment)
+                attachment.thumbnail_status = MessageAttachment.THUMBNAIL_READY
+                ready.append(attachment)
+            except Exception as e:
+                logger.warning(f"Could not make a thumbnail for attachment {attachment.id}: {str(e)}")
+                attachment.thumbnail_status = MessageAttachment.THUMBNAIL_FAILED
+                failed.append(attachment)
+        MessageAttachment.objects.bulk_update(pending, ["thumbnail", "thumbnail_status"])
+
+    for attachment in ready:
+        pubsub.publish(
+            conversation_signal_channel(attachment.conversation_id),
+            {
+                "type": "attachment",
+                "message_id": attachment.message_id,
+                "attachment": serialize_attachment(attachment),
+            },
+        )
+    return len(ready), len(failed)
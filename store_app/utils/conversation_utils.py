@@ -0,0 +1,120 @@
+# utils/conversation_utils.py
+"""
+Conversation bootstrap: the conversation page's state, loaded in a fixed
+number of queries whether the page is opened directly or straight from a
+listing's "Message seller" button, and never fetched twice.
+"""
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from django.http import Http404
+from django.utils import timezone
+from ..models import Conversation, Product, Service
+from .inbox_utils import get_mentions_by_conversation, invalidate_inbox_cache
+from .message_utils import get_message_page
+from .presence_utils import get_conversation_presence
+
+# Listing type -> (model, seller field); the type is also the Conversation field
+LISTING_SELLER_FIELDS = {
+    "product": (Product, "user_vendor"),
+    "service": (Service, "user_provider"),
+}
+
+
+def _other_participant(conversation, user):
+    """The participant who is not `user`, from the canonical pair when it is loaded"""
+    for participant in (conversation.user_low, conversation.user_high):
+        if participant is not None and participant.pk != user.pk:
+            return participant
+    # Conversations from before the pair columns
+    return conversation.get_other_participant(user)
+
+
+def get_page_conversation(user, conversation_id):
+    """
+    `user`'s conversation `conversation_id`, with its participant pair and
+    listing joined in one query; None if it does not exist or `user` is not
+    part of it. The other participant is set as `other_participant`.
+    """
+    conversation = (
+        Conversation.objects.select_related("user_low", "user_high", "product", "service")
+        .filter(id=conversation_id, participants=user)
+        .first()
+    )
+    if conversation is not None:
+        conversation.other_participant = _other_participant(conversation, user)
+    return conversation
+
+
+def get_listing_seller(listing_type, listing_id):
+    """
+    (listing, seller) of a product or service, in one query. Raises
+    ValidationError for an unknown listing type and Http404 for a missing listing.
+    """
+    if listing_type not in LISTING_SELLER_FIELDS:
+        raise ValidationError("Invalid listing type.")
+    model, seller_field = LISTING_SELLER_FIELDS[listing_type]
+    listing = model.objects.select_related(seller_field).filter(id=listing_id).first()
+    if listing is None:
+        raise Http404(f"{listing_type.title()} not found")
+    return listing, getattr(listing, seller_field)
+
+
+def start_listing_conversation(user, listing_type, listing_id, before_create=None):
+    """
+    Get or create `user`'s conversation with the seller of a listing, linked
+    to that listing, ready for build_conversation_page() as it is.
+
+    That is one query for the listing and its seller, one for the existing
+    conversation (or the inserts creating it) and, only when the listing
+    it is linked to changes, one UPDATE. Raises ValidationError when there is
+    no one to message and Http404 for a missing listing. `before_create`
+    is passed on to Conversation.get_or_create_conversation(). Returns
+    (conversation, created).
+    """
+    listing, seller = get_listing_seller(listing_type, listing_id)
+    if seller is None:
+        raise ValidationError("This listing has no seller.")
+    if seller.pk == user.pk:
+        raise ValidationError("You cannot message yourself about your own listing.")
+
+    conversation, created = Conversation.get_or_create_conversation(user, seller, before_create=before_create)
+    if getattr(conversation, f"{listing_type}_id") != listing.pk:
+        now = timezone.now()
+        Conversation.objects.filter(pk=conversation.pk).update(**{listing_type: listing, "updated_at": now})
+        conversation.updated_at = now
+        # The inbox shows the listing; update() sends no post_save
+        invalidate_inbox_cache([user.pk, seller.pk])
+    setattr(conversation, listing_type, listing)
+    conversation.other_participant = seller
+    return conversation, created
+
+
+def build_conversation_page(user, conversation):
+    """
+    The conversation.html context of a conversation from
+    get_page_conversation() or start_listing_conversation(): the latest
+    message page (with its attachments), the listings either participant
+    can tag a message with, the discussed listings and the other
+    participant's presence, in a fixed number of queries.
+    """
+    other_participant = conversation.other_participant
+    messages_list, older_messages_cursor = get_message_page(conversation.id)
+    mentioned_products, mentioned_services = get_mentions_by_conversation([conversation.id])[
+        conversation.id
+    ]
+    # Listings from both participants, so buyer and seller can both give context
+    return {
+        "conversation": conversation,
+        "messages": messages_list,
+        "older_messages_cursor": older_messages_cursor,
+        "other_participant": other_participant,
+        "other_presence": get_conversation_presence(conversation.id, other_participant.id),
+        "other_products": Product.objects.filter(
+            Q(user_vendor=user) | Q(user_vendor=other_participant)
+        ).order_by("name"),
+        "other_services": Service.objects.filter(
+            Q(user_provider=user) | Q(user_provider=other_participant)
+        ).order_by("name"),
+        "mentioned_products": mentioned_products,
+        "mentioned_services": mentioned_services,
+    }
@@ -0,0 +1,141 @@
+# utils/digest_utils.py
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives
+from django.db.models import Count, Exists, F, OuterRef, Q, Sum
+from django.template.loader import render_to_string
+from django.urls import reverse
+from ..models import ConversationParticipantState, Message, UserProfile
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Digests sent per SMTP/API round trip (and per UPDATE of the throttling state)
+DIGEST_BATCH_SIZE = 200
+# Conversations listed in one digest; the totals count every conversation
+# the digest is about, listed or not
+DIGEST_MAX_CONVERSATIONS = 5
+
+
+def get_digest_states(cutoff):
+    """
+    The participant states a digest is about: conversations where a message
+    from someone else has been waiting unread since before `cutoff` and
+    that have had activity since the user's previous digest, so reruns and
+    users who keep ignoring the same thread are not emailed again
+    """
+    waiting = Message.objects.filter(
+        conversation_id=OuterRef("conversation_id"),
+        id__gt=OuterRef("last_read_message_id"),
+        created_at__lt=cutoff,
+    ).exclude(sender_id=OuterRef("user_id"))
+    return ConversationParticipantState.objects.filter(
+        Q(user__profile__message_digest_sent_at__isnull=True)
+        | Q(last_message_at__gt=F("user__profile__message_digest_sent_at")),
+        Exists(waiting),
+        unread_count__gt=0,
+        user__is_active=True,
+    ).exclude(user__email="")
+
+
+def get_digest_recipients(cutoff):
+    """
+    One row per user owed a digest (see get_digest_states()), found with a
+    single aggregated query. Rows carry user_id, email, username,
+    first_name, unread (total) and conversations.
+    """
+    return (
+        get_digest_states(cutoff)
+        .values("user_id", "user__email", "user__username", "user__first_name")
+        .annotate(unread=Sum("unread_count"), conversations=Count("id"))
+        .order_by("user_id")
+    )
+
+
+def get_digest_conversations(user_ids, cutoff):
+    """
+    The conversations the digests of a batch of users are about, in one
+    query: {user_id: [(other participant, state), ...]}, most recent first
+    """
+    states = (
+        get_digest_states(cutoff)
+        .filter(user_id__in=user_ids)
+        .select_related("conversation__user_low", "conversation__user_high")
+        .order_by("user_id", "-last_message_at")
+    )
+    conversations = {}
+    for state in states:
+        listed = conversations.setdefault(state.user_id, [])
+        if len(listed) >= DIGEST_MAX_CONVERSATIONS:
+            continue
+        conversation = state.conversation
+        other = conversation.user_high if conversation.user_low_id == state.user_id else conversation.user_low
+        listed.append((other, state))
+    return conversations
+
+
+def build_digest_email(recipient, conversations):
+    """The digest EmailMultiAlternatives for one get_digest_recipients() row"""
+    messages_url = settings.BASE_URL.rstrip("/") + reverse("store_app:messages")
+    entries = [
+        {
+            "name": (other.get_full_name() or other.username) if other else "Someone",
+            "unread_count": state.unread_count,
+            "preview": state.conversation.last_message_preview,
+            "url": settings.BASE_URL.rstrip("/")
+            + reverse("store_app:conversation", args=[state.conversation_id]),
+        }
+        for other, state in conversations
+    ]
+    name = recipient["user__first_name"] or recipient["user__username"]
+    ctx = {
+        "name": name,
+        "unread_count": recipient["unread"],
+        "conversation_count": recipient["conversations"],
+        "conversations": entries,
+        "more_conversations": max(recipient["conversations"] - len(entries), 0),
+        "messages_url": messages_url,
+    }
+
+    text_body = (
+        f"Hi {name},\n\n"
+        f"You have {recipient['unread']} unread message(s) in "
+        f"{recipient['conversations']} conversation(s) on the RUM Marketplace Website:\n\n"
+        + "".join(f"- {entry['name']} ({entry['unread_count']}): {entry['url']}\n" for entry in entries)
+        + f"\nRead them all at {messages_url}"
+    )
+    email = EmailMultiAlternatives(
+        subject=f"You have {recipient['unread']} unread message(s) on RUM Marketplace",
+        body=text_body,
+        from_email=settings.DEFAULT_FROM_EMAIL,
+        to=[recipient["user__email"]],
+    )
+    email.attach_alternative(render_to_string("emails/message_digest.html", ctx), "text/html")
+    return email
+
+
+def send_digest_batch(connection, recipients, sent_at, cutoff):
+    """
+    Send the digests of a batch of recipients (get_digest_recipients(cutoff)
+    rows) over an open mail `connection`, then record them as sent in one
+    UPDATE. Returns the number sent.
+
+    Backends only report how many messages went out, not which, so a batch
+    is recorded only when all of it was sent; otherwise nothing is, and a
+    rerun retries the whole batch.
+    """
+    user_ids = [recipient["user_id"] for recipient in recipients]
+    conversations = get_digest_conversations(user_ids, cutoff)
+    emails = [
+        build_digest_email(recipient, conversations.get(recipient["user_id"], []))
+        for recipient in recipients
+    ]
+    try:
+        sent = connection.send_messages(emails) or 0
+    except Exception as e:
+        logger.error(f"Error sending a batch of {len(emails)} message digest(s): {str(e)}", exc_info=True)
+        return 0
+    if sent < len(emails):
+        logger.warning(f"Only {sent} of a batch of {len(emails)} message digest(s) were sent; none recorded")
+        return sent
+    UserProfile.objects.filter(user_id__in=user_ids).update(message_digest_sent_at=sent_at)
+    return sent
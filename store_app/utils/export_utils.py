@@ -0,0 +1,104 @@
+# utils/export_utils.py
+import csv
+import json
+from itertools import islice
+from asgiref.sync import sync_to_async
+from ..models import Message
+
+# Rows fetched per round trip; on PostgreSQL iterator() reads them through a
+# server-side cursor, so memory stays flat however long the thread is
+EXPORT_CHUNK_SIZE = 2000
+
+# Supported transcript formats and their content types
+EXPORT_FORMATS = {"jsonl": "application/x-ndjson", "csv": "text/csv"}
+
+# Leading characters that make spreadsheets read a CSV cell as a formula
+CSV_FORMULA_PREFIXES = ("=", "+", "-", "@", "\t", "\r")
+
+TRANSCRIPT_COLUMNS = (
+    "conversation_id",
+    "message_id",
+    "created_at",
+    "sender",
+    "content",
+    "product",
+    "service",
+)
+
+
+def get_transcript_rows(conversation_ids, chunk_size=None):
+    """
+    Messages of the given conversations as flat dicts (TRANSCRIPT_COLUMNS),
+    conversation by conversation, oldest first, streamed from the database
+    """
+    messages = (
+        Message.objects.filter(conversation_id__in=conversation_ids)
+        .order_by("conversation_id", "id")
+        .values_list(
+            "conversation_id",
+            "id",
+            "created_at",
+            "sender__username",
+            "content",
+            "product__name",
+            "service__name",
+        )
+    )
+    for row in messages.iterator(chunk_size=chunk_size or EXPORT_CHUNK_SIZE):
+        transcript_row = dict(zip(TRANSCRIPT_COLUMNS, row))
+        transcript_row["created_at"] = transcript_row["created_at"].isoformat()
+        yield transcript_row
+
+
+class _Echo:
+    """File-like object whose write() hands the line back to the csv writer's caller"""
+
+    def write(self, value):
+        return value
+
+
+def stream_jsonl(rows):
+    for row in rows:
+        yield json.dumps(row, ensure_ascii=False) + "\n"
+
+
+def csv_cell(value):
+    """
+    `value` as a CSV cell: None becomes empty, and text a spreadsheet would
+    evaluate as a formula is prefixed with a quote so it shows as typed
+    """
+    if value is None:
+        return ""
+    if isinstance(value, str) and value.startswith(CSV_FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+
+def stream_csv(rows):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(TRANSCRIPT_COLUMNS)
+    for row in rows:
+        yield writer.writerow([csv_cell(row[column]) for column in TRANSCRIPT_COLUMNS])
+
+
+def stream_transcript(conversation_ids, export_format, chunk_size=None):
+    """Lines of the transcript of the given conversations in `export_format` (see EXPORT_FORMATS)"""
+    rows = get_transcript_rows(conversation_ids, chunk_size=chunk_size)
+    if export_format == "csv":
+        return stream_csv(rows)
+    return stream_jsonl(rows)
+
+
+async def astream_transcript(conversation_ids, export_format, chunk_size=None):
+    """
+    stream_transcript() for ASGI. Given a sync iterator, Django's
+    StreamingHttpResponse reads all of it in one sync_to_async(list) call
+    before sending anything; here each chunk of lines is fetched by its own
+    sync_to_async() call, so only one chunk is held in memory at a time.
+    """
+    chunk_size = chunk_size or EXPORT_CHUNK_SIZE
+    lines = stream_transcript(conversation_ids, export_format, chunk_size=chunk_size)
+    next_chunk = sync_to_async(lambda: list(islice(lines, chunk_size)))
+    while chunk := await next_chunk():
+        for line in chunk:
+            yield line
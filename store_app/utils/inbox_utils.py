@@ -0,0 +1,364 @@
+# utils/inbox_utils.py
+from datetime import datetime, timedelta, timezone as dt_timezone
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Exists, F, Max, OuterRef, Prefetch, Q
+from django.utils import timezone
+from django.utils.timesince import timesince
+from ..models import Conversation, ConversationMention, ConversationParticipantState, Message
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# Cursors are compared with a small overlap so that rows committed slightly
+# out of order are re-sent instead of missed. Re-sending a conversation is
+# harmless: the client simply re-renders the same card.
+INBOX_CURSOR_VERSION = "v1"
+INBOX_CURSOR_OVERLAP = timedelta(seconds=5)
+
+
+def get_inbox_queryset(user):
+    """
+    Conversations of `user` annotated with everything the inbox needs,
+    most recent message first.
+
+    The conversations are reached through the user's
+    ConversationParticipantState rows, so ordering is a range of the
+    (user, last_message_at) index and the unread count comes from the same
+    join. The latest message is denormalized on Conversation and the other
+    participant (with profile) is prefetched into `other_participants`, so
+    the whole list costs two queries and never reads Message.
+    """
+    other_participants = User.objects.exclude(id=user.id).select_related("profile")
+
+    return (
+        Conversation.objects.filter(participant_states__user=user)
+        .select_related("product", "service")
+        .annotate(
+            unread_count=F("participant_states__unread_count"),
+            last_activity_at=F("participant_states__last_message_at"),
+        )
+        .order_by("-last_activity_at", "-id")
+        .prefetch_related(
+            Prefetch(
+                "participants",
+                queryset=other_participants,
+                to_attr="other_participants",
+            )
+        )
+    )
+
+
+def get_mentions_by_conversation(conversation_ids):
+    """
+    Products and services mentioned in the given conversations, in one
+    indexed read of ConversationMention.
+
+    Returns {conversation_id: (products, services)} where each list holds
+    {"id", "name"} dicts in the order they were first mentioned.
+    """
+    mentions = {conversation_id: ([], []) for conversation_id in conversation_ids}
+    if not mentions:
+        return {}
+
+    rows = ConversationMention.objects.filter(conversation_id__in=mentions.keys()).values_list(
+        "conversation_id", "product_id", "product__name", "service_id", "service__name"
+    )
+    for conversation_id, product_id, product_name, service_id, service_name in rows:
+        products, services = mentions[conversation_id]
+        if product_id is not None:
+            products.append({"id": product_id, "name": product_name})
+        if service_id is not None:
+            services.append({"id": service_id, "name": service_name})
+    return mentions
+
+
+def get_latest_message_preview(conversation):
+    """
+    The conversation's latest message rebuilt from its denormalized pointer
+    (unsaved; `content` holds the preview only), or None
+    """
+    if not conversation.last_message_id:
+        return None
+    return Message(
+        id=conversation.last_message_id,
+        conversation_id=conversation.id,
+        content=conversation.last_message_preview,
+        created_at=conversation.last_message_at,
+    )
+
+
+def build_inbox(user, conversations=None):
+    """
+    Build the conversation list for `user` in a constant number of queries.
+
+    Each entry is a dict with the keys messages.html has always used:
+    conversation, other_participant, latest_message, unread_count,
+    mentioned_products and mentioned_services.
+    """
+    if conversations is None:
+        conversations = get_inbox_queryset(user)
+    conversations = list(conversations)
+    mentions = get_mentions_by_conversation([c.id for c in conversations])
+
+    inbox = []
+    for conv in conversations:
+        other_participant = conv.other_participants[0] if conv.other_participants else None
+        # Skip conversations where other_participant is None (shouldn't happen, but handle gracefully)
+        if other_participant is None:
+            logger.warning(
+                f"Conversation {conv.id} has no other participant for user {user.id}"
+            )
+            continue
+
+        mentioned_products, mentioned_services = mentions.get(conv.id, ([], []))
+        inbox.append(
+            {
+                "conversation": conv,
+                "other_participant": other_participant,
+                "latest_message": get_latest_message_preview(conv),
+                "unread_count": conv.unread_count,
+                "mentioned_products": mentioned_products,
+                "mentioned_services": mentioned_services,
+            }
+        )
+    return inbox
+
+
+def snapshot_inbox_entry(entry):
+    """
+    Serialize one build_inbox() entry without the parts that depend on the
+    current time, so the result can be cached (see get_inbox_snapshot())
+    """
+    conv = entry["conversation"]
+    other_participant = entry["other_participant"]
+    latest_message = entry["latest_message"]
+
+    # Get profile picture for other participant
+    other_participant_profile_picture = None
+    try:
+        if hasattr(other_participant, "profile") and other_participant.profile.profile_picture:
+            other_participant_profile_picture = str(other_participant.profile.profile_picture)
+    except Exception as e:
+        logger.warning(f"Error accessing profile picture for user {other_participant.id}: {str(e)}")
+
+    return {
+        "id": conv.id,
+        "other_participant_id": other_participant.id,
+        "other_participant_name": other_participant.get_full_name(),
+        "other_participant_username": other_participant.username,
+        "other_participant_profile_picture": other_participant_profile_picture,
+        "latest_message": (
+            {
+                "id": latest_message.id,
+                "content": latest_message.content,
+                "timestamp": latest_message.created_at.strftime("%b %d, %Y %I:%M %p"),
+                "created_at": latest_message.created_at.isoformat(),
+            }
+            if latest_message
+            else None
+        ),
+        "created_at": conv.created_at.isoformat(),
+        "unread_count": entry["unread_count"],
+        "updated_at": conv.updated_at.isoformat(),
+        "has_product": conv.product is not None,
+        "has_service": conv.service is not None,
+        "product_name": conv.product.name if conv.product else None,
+        "service_name": conv.service.name if conv.service else None,
+        "mentioned_products": entry["mentioned_products"],
+        "mentioned_services": entry["mentioned_services"],
+    }
+
+
+def add_inbox_timesince(entry_data, now=None):
+    """Copy of a snapshot_inbox_entry() dict with the "... ago" texts filled in for `now`"""
+    now = now or timezone.now()
+    entry_data = dict(entry_data)
+    latest_message = entry_data["latest_message"]
+    if latest_message:
+        entry_data["latest_message"] = {
+            **latest_message,
+            "timesince": timesince(datetime.fromisoformat(latest_message["created_at"]), now),
+        }
+    # For conversations with no messages
+    entry_data["conversation_timesince"] = timesince(
+        datetime.fromisoformat(entry_data["created_at"]), now
+    )
+    return entry_data
+
+
+def serialize_inbox_entry(entry, now=None):
+    """Serialize one build_inbox() entry for the get_conversations_update API"""
+    return add_inbox_timesince(snapshot_inbox_entry(entry), now)
+
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+
+def _to_micros(value):
+    return (value - _EPOCH) // timedelta(microseconds=1) if value else 0
+
+
+def _from_micros(value):
+    return _EPOCH + timedelta(microseconds=value)
+
+
+def get_inbox_cursor(user):
+    """
+    Opaque sync cursor describing the current state of `user`'s inbox.
+
+    It is derived only from data (latest conversation update, highest message
+    id and latest read watermark move), so it stays identical while nothing
+    changes and can double as the ETag of the polling endpoint.
+    """
+    conversations = Conversation.objects.filter(participants=user)
+    conversation_state = conversations.order_by().aggregate(updated=Max("updated_at"))
+    message_state = conversations.order_by().aggregate(last_id=Max("last_message_id"))
+    read_state = (
+        ConversationParticipantState.objects.filter(conversation__in=conversations)
+        .order_by()
+        .aggregate(last_read=Max("last_read_at"))
+    )
+    return ".".join(
+        [
+            INBOX_CURSOR_VERSION,
+            str(_to_micros(conversation_state["updated"])),
+            str(message_state["last_id"] or 0),
+            str(_to_micros(read_state["last_read"])),
+        ]
+    )
+
+
+def parse_inbox_cursor(raw):
+    """Parse a get_inbox_cursor() value; returns None if it is missing or invalid"""
+    if not raw:
+        return None
+    parts = raw.strip().strip('"').split(".")
+    if len(parts) != 4 or parts[0] != INBOX_CURSOR_VERSION:
+        return None
+    try:
+        updated, last_id, last_read = (int(part) for part in parts[1:])
+    except ValueError:
+        return None
+    return {
+        "updated_at": _from_micros(updated),
+        "message_id": last_id,
+        "read_at": _from_micros(last_read),
+    }
+
+
+def get_changed_inbox_queryset(user, cursor):
+    """
+    get_inbox_queryset() narrowed to conversations that changed since `cursor`:
+    bumped, received a new message, or had a participant's watermark move.
+    """
+    updated_since = cursor["updated_at"] - INBOX_CURSOR_OVERLAP
+    read_since = cursor["read_at"] - INBOX_CURSOR_OVERLAP
+    new_reads = ConversationParticipantState.objects.filter(
+        conversation=OuterRef("pk"), last_read_at__gt=read_since
+    )
+    return get_inbox_queryset(user).filter(
+        Q(updated_at__gt=updated_since)
+        | Q(last_message_id__gt=cursor["message_id"])
+        | Exists(new_reads)
+    )
+
+
+# Serialized inboxes are cached per user under a version number. Anything
+# that changes what a user's inbox shows bumps their version (see
+# invalidate_inbox_cache() and its callers in models.py), which orphans the
+# cached copy instead of deleting it. A reader that built its copy from data
+# read just before the change stores it under the old version, where nobody
+# looks any more. Listing names shown in the inbox are not tracked and may
+# lag by up to INBOX_CACHE_TIMEOUT. The versions only reach every worker
+# through a shared cache (Redis, see CACHES in settings).
+INBOX_CACHE_TIMEOUT = 10 * 60
+
+
+def _inbox_version_key(user_id):
+    return f"inbox:{user_id}:version"
+
+
+def _get_inbox_version(user_id):
+    key = _inbox_version_key(user_id)
+    version = cache.get(key)
+    if version is None:
+        # Start from a value never used before, so copies cached under a
+        # version that was evicted can't come back
+        cache.add(key, time.time_ns(), None)
+        version = cache.get(key, 0)
+    return version
+
+
+def _bump_inbox_versions(user_ids):
+    for user_id in user_ids:
+        try:
+            cache.incr(_inbox_version_key(user_id))
+        except ValueError:
+            # No version yet, so nothing is cached for this user
+            pass
+
+
+def invalidate_inbox_cache(user_ids):
+    """
+    Drop the cached inboxes of `user_ids`.
+
+    Versions are bumped right away, so the rest of this transaction reads
+    fresh data, and again once it commits, so a copy another request cached
+    from the pre-commit state in between is dropped too.
+    """
+    user_ids = {user_id for user_id in user_ids if user_id is not None}
+    if not user_ids:
+        return
+    _bump_inbox_versions(user_ids)
+    transaction.on_commit(lambda: _bump_inbox_versions(user_ids))
+
+
+def get_conversation_participant_ids(conversation_ids):
+    """Ids of the users taking part in any of `conversation_ids`"""
+    return set(
+        Conversation.participants.through.objects.filter(
+            conversation_id__in=conversation_ids
+        ).values_list("user_id", flat=True)
+    )
+
+
+def get_conversation_partner_ids(user_id):
+    """Ids of the users sharing a conversation with `user_id` (including that user)"""
+    through = Conversation.participants.through
+    return get_conversation_participant_ids(
+        through.objects.filter(user_id=user_id).values("conversation_id")
+    )
+
+
+def get_inbox_snapshot(user):
+    """
+    `user`'s inbox as {"cursor", "conversations"}, where the conversations
+    are snapshot_inbox_entry() dicts, served from the cache when possible.
+
+    A cache hit costs two cache reads and no SQL, which is what idle
+    pollers get. The cursor is taken before the inbox is read, like
+    messages_view does, so clients can't miss a change landing in between.
+    """
+    key = f"inbox:{user.id}:{_get_inbox_version(user.id)}"
+    snapshot = cache.get(key)
+    if snapshot is None:
+        cursor = get_inbox_cursor(user)
+        snapshot = {
+            "cursor": cursor,
+            "conversations": [snapshot_inbox_entry(entry) for entry in build_inbox(user)],
+        }
+        cache.set(key, snapshot, INBOX_CACHE_TIMEOUT)
+    return snapshot
+
+
+def get_cached_unread_count(user):
+    """ConversationParticipantState.total_unread() for `user`, cached with the inbox"""
+    key = f"inbox:{user.id}:{_get_inbox_version(user.id)}:unread"
+    unread_count = cache.get(key)
+    if unread_count is None:
+        unread_count = ConversationParticipantState.total_unread(user)
+        cache.set(key, unread_count, INBOX_CACHE_TIMEOUT)
+    return unread_count
@@ -0,0 +1,251 @@
+# utils/message_utils.py
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.urls import reverse
+from .. import pubsub
+from ..models import Conversation, ConversationParticipantState, Message, MessageAttachment
+from .inbox_utils import _from_micros, _to_micros
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Messages rendered by conversation_view and returned per "load older" request
+MESSAGE_PAGE_SIZE = 50
+
+
+def conversation_channel(conversation_id):
+    """Pub/sub channel carrying new messages of one conversation"""
+    return f"conversation.{conversation_id}"
+
+
+def conversation_signal_channel(conversation_id):
+    """Pub/sub channel carrying typing notices and read receipts of one conversation"""
+    return f"conversation.{conversation_id}.signals"
+
+
+# Everything a serialized message touches, loaded in the message query itself
+MESSAGE_RELATIONS = ("sender__profile", "product", "service")
+MESSAGE_FIELDS = (
+    "id",
+    "conversation_id",
+    "content",
+    "created_at",
+    "sender__username",
+    "sender__first_name",
+    "sender__last_name",
+    "sender__profile__user",
+    "sender__profile__profile_picture",
+    "product__name",
+    "service__name",
+)
+
+
+def with_message_relations(messages):
+    """
+    Narrow a Message queryset to what serialize_message() reads: joined in
+    one query, plus one for the attachments of the whole batch
+    """
+    return (
+        messages.select_related(*MESSAGE_RELATIONS)
+        .only(*MESSAGE_FIELDS)
+        .prefetch_related("attachments")
+    )
+
+
+def get_profile_picture(user):
+    """Profile picture path of `user`, or None"""
+    try:
+        if hasattr(user, "profile") and user.profile.profile_picture:
+            return str(user.profile.profile_picture)
+    except Exception as e:
+        logger.warning(f"Error accessing profile picture: {str(e)}")
+    return None
+
+
+def serialize_attachment(attachment):
+    """
+    Payload of a MessageAttachment. Only the thumbnail is meant to be shown
+    inline (thumbnail_url is None until the worker has made it, and for
+    PDFs); `url` downloads the file itself.
+    """
+    ready = attachment.thumbnail_status == MessageAttachment.THUMBNAIL_READY
+    return {
+        "id": attachment.id,
+        "kind": attachment.kind,
+        "name": attachment.original_name,
+        "size": attachment.size,
+        "url": reverse("store_app:message_attachment", args=[attachment.id]),
+        "thumbnail_url": (
+            reverse("store_app:message_attachment_thumbnail", args=[attachment.id]) if ready else None
+        ),
+    }
+
+
+def serialize_message(message):
+    """
+    Serialize a Message into the payload conversation.html renders.
+
+    The payload does not depend on who is looking at it, so it can be
+    published once and fanned out to every participant. Keys with no value
+    are left out.
+    """
+    sender = message.sender
+    message_data = {
+        "id": message.id,
+        "sender": sender.username,
+        "sender_name": sender.get_full_name() or sender.username,
+        "content": message.content,
+        "timestamp": message.created_at.strftime("%b %d, %Y %I:%M %p"),
+    }
+    sender_profile_picture = get_profile_picture(sender)
+    if sender_profile_picture:
+        message_data["sender_profile_picture"] = sender_profile_picture
+    if message.product_id and message.product:
+        message_data["product"] = {"id": message.product.id, "name": message.product.name}
+    if message.service_id and message.service:
+        message_data["service"] = {"id": message.service.id, "name": message.service.name}
+    attachments = [serialize_attachment(attachment) for attachment in message.attachments.all()]
+    if attachments:
+        message_data["attachments"] = attachments
+    return message_data
+
+
+def serialize_messages(messages, current_user=None):
+    """
+    Serialize a batch of messages for the JSON messaging endpoints.
+
+    Pass a with_message_relations() queryset (or messages loaded with the
+    same relations) so the batch costs one query however large it is. The
+    viewer's own avatar is looked up once and added to every payload as
+    `current_user_profile_picture`.
+    """
+    current_user_profile_picture = get_profile_picture(current_user) if current_user else None
+    messages_data = []
+    for message in messages:
+        message_data = serialize_message(message)
+        if current_user_profile_picture:
+            message_data["current_user_profile_picture"] = current_user_profile_picture
+        messages_data.append(message_data)
+    return messages_data
+
+
+def get_messages_after(conversation_id, last_message_id, limit=100):
+    """Serialized messages of a conversation after `last_message_id`, oldest first"""
+    new_messages = with_message_relations(
+        Message.objects.filter(conversation_id=conversation_id, id__gt=last_message_id)
+    ).order_by("id")[:limit]
+    return serialize_messages(new_messages)
+
+
+def receive_new_messages(user, conversation_id, last_message_id=None):
+    """
+    Serialized messages from the other participants after `last_message_id`
+    (all of them without one), oldest first. They count as read by `user`.
+    """
+    new_messages = Message.objects.filter(conversation_id=conversation_id).exclude(sender=user)
+    if last_message_id:
+        new_messages = new_messages.filter(id__gt=last_message_id)
+    new_messages = list(with_message_relations(new_messages).order_by("id"))
+
+    if new_messages:
+        ConversationParticipantState.mark_read(user, conversation_id, new_messages[-1].id)
+    return serialize_messages(new_messages, current_user=user)
+
+
+def get_latest_message_id(conversation_id):
+    latest = (
+        Conversation.objects.filter(id=conversation_id)
+        .values_list("last_message_id", flat=True)
+        .first()
+    )
+    return latest or 0
+
+
+def send_message(conversation_id, sender, content, product_id=None, service_id=None, client_key=None):
+    """
+    Store a message from `sender` and bump its conversation, in one transaction.
+
+    That transaction is one INSERT into the messages plus the post_save
+    bookkeeping: one UPDATE of the conversation (bump and last-message
+    pointer), one of the participants' unread counters, and one upsert of
+    the discussed listings when a product or service is attached. With a
+    `client_key`, a send that is retried (e.g. after a timeout) finds the
+    message stored the first time instead of creating a duplicate.
+    Returns (message, created).
+    """
+    if client_key:
+        existing = Message.objects.filter(
+            conversation_id=conversation_id, sender=sender, client_key=client_key
+        ).first()
+        if existing:
+            return existing, False
+
+    try:
+        with transaction.atomic():
+            message = Message.objects.create(
+                conversation_id=conversation_id,
+                sender=sender,
+                content=content,
+                product_id=product_id,
+                service_id=service_id,
+                client_key=client_key or None,
+            )
+    except IntegrityError:
+        if not client_key:
+            raise
+        # A concurrent retry with the same key got there first
+        return (
+            Message.objects.get(conversation_id=conversation_id, sender=sender, client_key=client_key),
+            False,
+        )
+    return message, True
+
+
+def publish_message(message):
+    """Push a newly created message to realtime subscribers of its conversation"""
+    try:
+        payload = serialize_message(message)
+    except Exception as e:
+        logger.error(f"Error serializing message {message.id} for pub/sub: {str(e)}", exc_info=True)
+        return
+    pubsub.publish(conversation_channel(message.conversation_id), payload)
+
+
+def encode_message_cursor(message):
+    """Keyset cursor pointing just before `message` in (created_at, id) order"""
+    return f"{_to_micros(message.created_at)}.{message.id}"
+
+
+def parse_message_cursor(raw):
+    """Parse an encode_message_cursor() value; returns None if it is missing or invalid"""
+    if not raw:
+        return None
+    try:
+        created_at, message_id = (int(part) for part in raw.split("."))
+    except ValueError:
+        return None
+    return _from_micros(created_at), message_id
+
+
+def get_message_page(conversation_id, before=None, limit=None):
+    """
+    One page of a conversation's history, oldest message first.
+
+    `before` is a parsed cursor; the page holds the `limit` (default
+    MESSAGE_PAGE_SIZE) messages right before it, or the latest ones.
+    Seeking on (created_at, id) instead of using OFFSET keeps every page an
+    index range scan however deep the history goes. Returns
+    (messages, older_cursor); older_cursor is None once the start of the
+    conversation is reached.
+    """
+    limit = limit or MESSAGE_PAGE_SIZE
+    history = with_message_relations(Message.objects.filter(conversation_id=conversation_id))
+    if before:
+        created_at, message_id = before
+        history = history.filter(
+            Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=message_id)
+        )
+    page = list(history.order_by("-created_at", "-id")[: limit + 1])
+    has_older = len(page) > limit
+    page = page[:limit][::-1]
+    return page, (encode_message_cursor(page[0]) if has_older else None)
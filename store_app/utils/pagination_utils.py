@@ -0,0 +1,142 @@
+# utils/pagination_utils.py
+"""
+Keyset (seek) pagination for listings shown newest first (`-id` order).
+
+Every page is an index range scan on the primary key, `id < last seen`
+(or `id > first seen` going back) with a LIMIT, so the hundredth page
+costs the same as the first; there is no COUNT(*) and no OFFSET. Pages are
+addressed by cursors that clients pass back as they are. A total, when a
+template wants one, is the planner's estimate rather than a count.
+"""
+import json
+from django.db import connection
+from django.utils.functional import cached_property
+
+# Products or services per catalog grid page
+CATALOG_PAGE_SIZE = 12
+
+# Cursor directions: the page after (older than) or before (newer than) an id
+_AFTER = "a"
+_BEFORE = "b"
+
+
+def encode_keyset_cursor(direction, pk):
+    return f"{direction}.{pk}"
+
+
+def parse_keyset_cursor(raw):
+    """Parse an encode_keyset_cursor() value; returns None if it is missing or invalid"""
+    if not raw:
+        return None
+    try:
+        direction, pk = raw.split(".")
+        pk = int(pk)
+    except ValueError:
+        return None
+    if direction not in (_AFTER, _BEFORE) or pk < 0:
+        return None
+    return direction, pk
+
+
+def estimate_count(queryset):
+    """
+    Roughly how many rows `queryset` holds, without counting them: the
+    planner's estimate on PostgreSQL (EXPLAIN plans the query but reads no
+    rows, and covers every partition of a partitioned table), an exact
+    COUNT(*) elsewhere
+    """
+    queryset = queryset.order_by()
+    if connection.vendor != "postgresql":
+        return queryset.count()
+    sql, params = queryset.values("pk").query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(f"EXPLAIN (FORMAT JSON) {sql}", params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+
+class KeysetPage:
+    """
+    One page of a KeysetPaginator. Iterates like Django's Page; instead of
+    page numbers it has `cursor` (the one it was loaded with, "" for the
+    first page) and next_cursor / previous_cursor (None at either end).
+    """
+
+    def __init__(self, object_list, cursor, next_cursor, previous_cursor, paginator):
+        self.object_list = object_list
+        self.cursor = cursor
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+        self.paginator = paginator
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+    @property
+    def approximate_count(self):
+        return self.paginator.approximate_count
+
+
+class KeysetPaginator:
+    """
+    Seek pagination of `queryset` in descending primary key order,
+    `per_page` rows at a time; any ordering the queryset has is replaced.
+
+    A page fetches one row more than it shows to learn whether the listing
+    goes on in that direction. The other direction is assumed to go on,
+    since the cursor came from there (rows deleted meanwhile can leave a
+    last page empty).
+    """
+
+    def __init__(self, queryset, per_page=CATALOG_PAGE_SIZE):
+        self.queryset = queryset
+        self.per_page = per_page
+
+    def get_page(self, raw_cursor):
+        """The page `raw_cursor` points to; the first page if it is missing or invalid"""
+        cursor = parse_keyset_cursor(raw_cursor)
+        if cursor is None:
+            direction, pk = _AFTER, None
+        else:
+            direction, pk = cursor
+
+        if direction == _BEFORE:
+            rows = list(self.queryset.filter(pk__gt=pk).order_by("pk")[: self.per_page + 1])
+            more = len(rows) > self.per_page
+            rows = rows[: self.per_page][::-1]
+            has_previous, has_next = more, True
+        else:
+            rows = self.queryset.order_by("-pk")
+            if pk is not None:
+                rows = rows.filter(pk__lt=pk)
+            rows = list(rows[: self.per_page + 1])
+            more = len(rows) > self.per_page
+            rows = rows[: self.per_page]
+            has_previous, has_next = pk is not None, more
+
+        next_cursor = previous_cursor = None
+        if has_next:
+            # A page left empty has nothing to seek on from, only back to
+            next_cursor = encode_keyset_cursor(_AFTER, rows[-1].pk) if rows else None
+        if has_previous:
+            previous_cursor = encode_keyset_cursor(_BEFORE, rows[0].pk if rows else pk - 1)
+        return KeysetPage(rows, raw_cursor if cursor else "", next_cursor, previous_cursor, self)
+
+    @cached_property
+    def approximate_count(self):
+        """Estimated rows in the whole listing (see estimate_count()), computed on first use"""
+        return estimate_count(self.queryset)
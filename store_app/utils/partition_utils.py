@@ -0,0 +1,261 @@
+# utils/partition_utils.py
+"""
+Optional PostgreSQL declarative partitioning of the messages table.
+
+Partitioning is opt-in (see the partition_messages command) and nothing
+else depends on it: the ORM keeps reading and writing `store_app_message`
+as before, and on any other database (SQLite in tests) the table simply
+stays a plain table.
+
+Layout once converted:
+
+    store_app_message              partitioned by RANGE (created_at)
+      store_app_message_legacy     the original table, up to the first monthly partition
+      store_app_message_p2026_11   one partition per calendar month (UTC)
+      ...
+      store_app_message_default    catches anything outside the monthly ranges
+
+A partitioned table's primary key must include the partition key, so it
+becomes (id, created_at); ids still come from one sequence and stay
+unique. The same goes for unique indexes, so the per-sender idempotency
+keys (unique_message_client_key) are enforced within each partition.
+"""
+from datetime import datetime, timezone as dt_timezone
+import re
+from django.db import connection, transaction
+from django.db.models.expressions import RawSQL
+from ..models import Message, MessageAttachment
+from .purge_utils import refresh_conversations
+import logging
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_TABLE = Message._meta.db_table
+LEGACY_PARTITION = f"{MESSAGE_TABLE}_legacy"
+DEFAULT_PARTITION = f"{MESSAGE_TABLE}_default"
+# GIN index of the generated search_vector column (see migration 0019)
+SEARCH_VECTOR_INDEX = "message_search_vector_idx"
+MONTHLY_PARTITION = re.compile(rf"^{MESSAGE_TABLE}_p(?P<year>\d{{4}})_(?P<month>\d{{2}})$")
+
+
+def can_partition():
+    return connection.vendor == "postgresql"
+
+
+def is_partitioned():
+    """Whether the messages table has been converted to a partitioned table"""
+    if not can_partition():
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s))",
+            [MESSAGE_TABLE],
+        )
+        return cursor.fetchone()[0]
+
+
+def add_months(year, month, count):
+    """(year, month) `count` months after the given one"""
+    index = year * 12 + month - 1 + count
+    return index // 12, index % 12 + 1
+
+
+def month_start(year, month):
+    return datetime(year, month, 1, tzinfo=dt_timezone.utc)
+
+
+def partition_name(year, month):
+    return f"{MESSAGE_TABLE}_p{year:04d}_{month:02d}"
+
+
+def get_monthly_partitions():
+    """
+    The monthly partitions attached to the messages table, oldest first, as
+    (name, start, end) with end exclusive
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT child.relname FROM pg_inherits "
+            "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+            "WHERE pg_inherits.inhparent = to_regclass(%s)",
+            [MESSAGE_TABLE],
+        )
+        names = [row[0] for row in cursor.fetchall()]
+
+    partitions = []
+    for name in names:
+        match = MONTHLY_PARTITION.match(name)
+        if match:
+            year, month = int(match["year"]), int(match["month"])
+            partitions.append((name, month_start(year, month), month_start(*add_months(year, month, 1))))
+    return sorted(partitions, key=lambda partition: partition[1])
+
+
+def _client_key_index_sql(table):
+    """unique_message_client_key, scoped to one partition"""
+    qn = connection.ops.quote_name
+    return (
+        f"CREATE UNIQUE INDEX IF NOT EXISTS {qn(table[:50] + '_client_key')} "
+        f"ON {qn(table)} (conversation_id, sender_id, client_key) WHERE client_key IS NOT NULL"
+    )
+
+
+def convert_to_partitioned(now=None):
+    """
+    Turn the messages table into a partitioned table, in one transaction.
+
+    The existing table is kept as is and attached as the legacy partition
+    covering everything before next month, so no rows are copied; attaching
+    it scans the table once to check the range, under an exclusive lock.
+    Monthly partitions start with next month (see ensure_partitions()).
+    Returns the start of the first monthly partition.
+    """
+    now = now or datetime.now(dt_timezone.utc)
+    first_year, first_month = add_months(now.year, now.month, 1)
+    boundary = month_start(first_year, first_month)
+    qn = connection.ops.quote_name
+    table, legacy = qn(MESSAGE_TABLE), qn(LEGACY_PARTITION)
+    sequence = qn(f"{MESSAGE_TABLE}_id_seq")
+
+    with transaction.atomic(), connection.schema_editor(atomic=False) as editor:
+        editor.execute(f"LOCK TABLE {table} IN ACCESS EXCLUSIVE MODE")
+        editor.execute(f"ALTER TABLE {table} RENAME TO {legacy}")
+
+        # Index names are per schema: free the original ones for the parent
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT indexname FROM pg_indexes WHERE tablename = %s", [LEGACY_PARTITION])
+            index_names = [row[0] for row in cursor.fetchall()]
+        for index_name in index_names:
+            constraint = index_name == f"{MESSAGE_TABLE}_pkey"
+            new_name = qn(f"{index_name[:50]}_legacy")
+            if constraint:
+                editor.execute(f"ALTER TABLE {legacy} RENAME CONSTRAINT {qn(index_name)} TO {new_name}")
+            else:
+                editor.execute(f"ALTER INDEX {qn(index_name)} RENAME TO {new_name}")
+
+        # Identity columns cannot be shared across partitions before
+        # PostgreSQL 17; ids come from a plain sequence owned by the parent.
+        # Tables created before Django 4.1 use serial: drop that one too
+        editor.execute(f"ALTER TABLE {legacy} ALTER COLUMN id DROP IDENTITY IF EXISTS")
+        editor.execute(f"ALTER TABLE {legacy} ALTER COLUMN id DROP DEFAULT")
+        editor.execute(f"DROP SEQUENCE IF EXISTS {sequence}")
+        editor.execute(f"CREATE SEQUENCE {sequence} AS bigint")
+        editor.execute(
+            f"SELECT setval('{sequence}', COALESCE((SELECT MAX(id) FROM {legacy}), 0) + 1, false)"
+        )
+
+        # INCLUDING GENERATED keeps search_vector a generated column; without
+        # it new rows get no vector and the legacy table cannot be attached
+        editor.execute(
+            f"CREATE TABLE {table} "
+            f"(LIKE {legacy} INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING GENERATED) "
+            f"PARTITION BY RANGE (created_at)"
+        )
+        editor.execute(f"ALTER TABLE {table} ALTER COLUMN id SET DEFAULT nextval('{sequence}')")
+        editor.execute(f"ALTER SEQUENCE {sequence} OWNED BY {table}.id")
+        editor.execute(f"ALTER TABLE {table} ADD CONSTRAINT {qn(MESSAGE_TABLE + '_pkey')} PRIMARY KEY (id, created_at)")
+
+        # Foreign keys and indexes go on the parent before the legacy table
+        # is attached, so its equivalent ones are adopted instead of rebuilt
+        for field in Message._meta.local_fields:
+            if field.remote_field and field.db_constraint:
+                editor.execute(editor._create_fk_sql(Message, field, "_fk_%(to_table)s_%(to_column)s"))
+        for statement in editor._model_indexes_sql(Message):
+            editor.execute(statement)
+        # The full text search index is kept outside the model, like its column
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT EXISTS (SELECT 1 FROM information_schema.columns "
+                "WHERE table_name = %s AND column_name = 'search_vector')",
+                [LEGACY_PARTITION],
+            )
+            has_search_vector = cursor.fetchone()[0]
+        if has_search_vector:
+            editor.execute(f"CREATE INDEX {qn(SEARCH_VECTOR_INDEX)} ON {table} USING GIN (search_vector)")
+
+        editor.execute(
+            f"ALTER TABLE {table} ATTACH PARTITION {legacy} "
+            f"FOR VALUES FROM (MINVALUE) TO ('{boundary.isoformat()}')"
+        )
+        editor.execute(f"CREATE TABLE {qn(DEFAULT_PARTITION)} PARTITION OF {table} DEFAULT")
+        editor.execute(_client_key_index_sql(DEFAULT_PARTITION))
+
+    logger.info(f"Converted {MESSAGE_TABLE} to a partitioned table; monthly partitions start {boundary:%Y-%m}")
+    return boundary
+
+
+def ensure_partitions(months_ahead=3, now=None):
+    """
+    Create the monthly partitions from the current month through
+    `months_ahead` months ahead that do not exist yet (months covered by
+    the legacy partition are skipped). Returns the names created.
+    """
+    now = now or datetime.now(dt_timezone.utc)
+    qn = connection.ops.quote_name
+    existing = {name for name, _, _ in get_monthly_partitions()}
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT pg_get_expr(relpartbound, oid) FROM pg_class WHERE oid = to_regclass(%s)",
+            [LEGACY_PARTITION],
+        )
+        row = cursor.fetchone()
+    # FOR VALUES FROM (MINVALUE) TO ('2026-11-01 00:00:00+00')
+    legacy_end = re.search(r"TO \('([^']+)'\)", row[0]) if row and row[0] else None
+    legacy_end = datetime.fromisoformat(legacy_end[1]) if legacy_end else None
+
+    created = []
+    for offset in range(months_ahead + 1):
+        year, month = add_months(now.year, now.month, offset)
+        name = partition_name(year, month)
+        start, end = month_start(year, month), month_start(*add_months(year, month, 1))
+        if name in existing or (legacy_end and start < legacy_end):
+            continue
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(
+                f"CREATE TABLE {qn(name)} PARTITION OF {qn(MESSAGE_TABLE)} "
+                f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+            )
+            cursor.execute(_client_key_index_sql(name))
+        created.append(name)
+        logger.info(f"Created message partition {name}")
+    return created
+
+
+def count_default_partition_rows():
+    """Messages that fell outside every monthly range (they block new partitions for their month)"""
+    qn = connection.ops.quote_name
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT COUNT(*) FROM {qn(DEFAULT_PARTITION)}")
+        return cursor.fetchone()[0]
+
+
+def drop_partitions_before(cutoff, detach_only=False):
+    """
+    Remove the monthly partitions holding only messages older than `cutoff`.
+
+    Each partition is detached (and dropped unless `detach_only`) in its
+    own transaction, which costs the same whatever its size; the
+    attachments of its messages are deleted with it (kept when only
+    detaching), and the unread counters and last-message pointers of its
+    conversations are brought back in line. Returns [(name, conversation count)].
+    """
+    qn = connection.ops.quote_name
+    removed = []
+    for name, _, end in get_monthly_partitions():
+        if end > cutoff:
+            break
+        with transaction.atomic():
+            if not detach_only:
+                MessageAttachment.objects.filter(
+                    message_id__in=RawSQL(f"SELECT id FROM {qn(name)}", [])
+                ).delete()
+            with connection.cursor() as cursor:
+                cursor.execute(f"SELECT DISTINCT conversation_id FROM {qn(name)}")
+                conversation_ids = [row[0] for row in cursor.fetchall()]
+                cursor.execute(f"ALTER TABLE {qn(MESSAGE_TABLE)} DETACH PARTITION {qn(name)}")
+                if not detach_only:
+                    cursor.execute(f"DROP TABLE {qn(name)}")
+            refresh_conversations(conversation_ids)
+        removed.append((name, len(conversation_ids)))
+        logger.info(f"{'Detached' if detach_only else 'Dropped'} message partition {name}")
+    return removed
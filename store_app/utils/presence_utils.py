@@ -0,0 +1,93 @@
+# utils/presence_utils.py
+"""
+Online presence and typing indicators, kept in the cache only.
+
+There is no request stream of its own: the requests clients already make
+(syncs and polls, the chat WebSocket and SSE stream keepalives) refresh
+the user's heartbeat, and typing notices ride on the sync request or the
+socket. Nothing here touches the database, so it relies on the cache
+being shared by every worker (Redis, see CACHES in settings): with a
+per-process cache a peer's heartbeat or typing notice is only seen by the
+worker that received it.
+"""
+from datetime import datetime, timezone as dt_timezone
+from django.core.cache import cache
+from .. import pubsub
+from .message_utils import conversation_signal_channel
+import time
+
+# A user is online while their last heartbeat is this recent. Idle clients
+# sync at most every SYNC_MAX_POLL_MS (60s), so this leaves some slack.
+PRESENCE_ONLINE_SECONDS = 90
+# How long a heartbeat is remembered for "last seen ..."
+PRESENCE_LAST_SEEN_TTL = 24 * 60 * 60
+# A typing notice shows for this long unless it is renewed
+TYPING_TTL = 6
+
+
+def _presence_key(user_id):
+    return f"presence:user:{user_id}"
+
+
+def _typing_key(conversation_id, user_id):
+    return f"presence:typing:{conversation_id}:{user_id}"
+
+
+def touch_presence(user_id):
+    """Record a heartbeat for `user_id` (one cache write)"""
+    cache.set(_presence_key(user_id), time.time(), PRESENCE_LAST_SEEN_TTL)
+
+
+def mark_typing(user, conversation_id):
+    """
+    `user` is typing in a conversation: remembered for TYPING_TTL seconds
+    for pollers, and pushed to the conversation's sockets right away
+    """
+    cache.set(_typing_key(conversation_id, user.id), True, TYPING_TTL)
+    pubsub.publish(
+        conversation_signal_channel(conversation_id),
+        {"type": "typing", "user_id": user.id, "user": user.username},
+    )
+
+
+def _describe(last_seen, now):
+    return {
+        "online": last_seen is not None and now - last_seen < PRESENCE_ONLINE_SECONDS,
+        "last_seen": (
+            datetime.fromtimestamp(last_seen, dt_timezone.utc).isoformat() if last_seen else None
+        ),
+    }
+
+
+def get_online_user_ids(user_ids):
+    """The subset of `user_ids` currently online (one cache read)"""
+    now = time.time()
+    last_seen = cache.get_many([_presence_key(user_id) for user_id in user_ids])
+    return {
+        user_id
+        for user_id in user_ids
+        if _describe(last_seen.get(_presence_key(user_id)), now)["online"]
+    }
+
+
+def get_conversation_presence(conversation_id, other_user_id):
+    """
+    What the other participant of a conversation is up to (one cache read):
+    {"online", "last_seen" (ISO timestamp or None), "typing"}
+    """
+    presence_key = _presence_key(other_user_id)
+    typing_key = _typing_key(conversation_id, other_user_id)
+    values = cache.get_many([presence_key, typing_key])
+    presence = _describe(values.get(presence_key), time.time())
+    presence["typing"] = bool(values.get(typing_key))
+    return presence
+
+
+def add_inbox_presence(entries):
+    """Set `other_participant_online` on inbox entry dicts (see snapshot_inbox_entry())"""
+    online = get_online_user_ids(
+        [entry["other_participant_id"] for entry in entries if entry.get("other_participant_id")]
+    )
+    for entry in entries:
+        entry["other_participant_online"] = entry.get("other_participant_id") in online
+    return entries
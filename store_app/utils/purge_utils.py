@@ -0,0 +1,102 @@
+# utils/purge_utils.py
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from ..models import Conversation, ConversationMention, ConversationParticipantState, Message, MessageAttachment
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Rows removed per DELETE; each batch is its own short transaction
+PURGE_BATCH_SIZE = 5000
+
+
+def delete_in_batches(queryset, batch_size=None, pause=0, before_delete=None, after_delete=None, on_batch=None):
+    """
+    Delete the rows of `queryset` in primary key order, `batch_size` at a time.
+
+    Every batch is one bounded id range deleted in its own transaction, so
+    locks are short and no transaction grows with the table. Work already
+    committed stays done: re-running after an interruption simply resumes
+    from the lowest id still matching. Inside each batch transaction,
+    `before_delete(batch)` runs first and its result is passed to
+    `after_delete()`; `on_batch(deleted_so_far)` reports progress.
+    Returns the number of rows deleted.
+    """
+    batch_size = batch_size or PURGE_BATCH_SIZE
+    queryset = queryset.order_by()
+    deleted = 0
+    last_id = 0
+
+    while True:
+        remaining = queryset.filter(pk__gt=last_id)
+        # Upper id of this batch; None once fewer than batch_size rows remain
+        upper_id = (
+            remaining.order_by("pk").values_list("pk", flat=True)[batch_size - 1:batch_size].first()
+        )
+        batch = remaining.filter(pk__lte=upper_id) if upper_id is not None else remaining
+
+        with transaction.atomic():
+            context = before_delete(batch) if before_delete else None
+            # Count the target model only, not cascaded rows
+            count = batch.delete()[1].get(queryset.model._meta.label, 0)
+            if after_delete:
+                after_delete(context)
+
+        deleted += count
+        if on_batch and count:
+            on_batch(deleted)
+        if upper_id is None:
+            return deleted
+        last_id = upper_id
+        if pause:
+            time.sleep(pause)
+
+
+def refresh_conversations(conversation_ids):
+    """Bring unread counters and last-message pointers back in line after a delete"""
+    ConversationParticipantState.recount(conversation_ids)
+    Conversation.rebuild_last_messages(conversation_ids)
+
+
+def _delete_message_attachments(batch):
+    """Drop the attachments of a batch of messages; returns the conversations it touches"""
+    # Attachments do not cascade from Message (see MessageAttachment)
+    MessageAttachment.objects.filter(message_id__in=batch.values("pk")).delete()
+    return list(batch.values_list("conversation_id", flat=True).distinct())
+
+
+def delete_messages_in_batches(messages, batch_size=None, pause=0, on_batch=None):
+    """
+    delete_in_batches() for messages and their attachments, recounting the
+    unread counters and rebuilding the last-message pointers of the
+    conversations they touched
+    """
+    return delete_in_batches(
+        messages,
+        batch_size=batch_size,
+        pause=pause,
+        before_delete=_delete_message_attachments,
+        after_delete=refresh_conversations,
+        on_batch=on_batch,
+    )
+
+
+def can_truncate():
+    return connection.vendor == "postgresql"
+
+
+def truncate_chat_tables():
+    """
+    Empty every messaging table with one TRUNCATE (PostgreSQL only).
+
+    Tables are listed explicitly and CASCADE is not used: if another table
+    ever references these, the TRUNCATE fails instead of wiping it too.
+    """
+    models = [MessageAttachment, Message, ConversationMention, ConversationParticipantState, Conversation]
+    tables = [model._meta.db_table for model in models]
+    tables.append(Conversation.participants.through._meta.db_table)
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            for sql in connection.ops.sql_flush(no_style(), tables, allow_cascade=False):
+                cursor.execute(sql)
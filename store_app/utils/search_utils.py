@@ -0,0 +1,108 @@
+# utils/search_utils.py
+from decimal import Decimal, InvalidOperation
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVectorField
+from django.db import connection
+from django.db.models import DecimalField, Q, Value
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Cast, Round
+from ..models import Conversation, Message
+from .message_utils import with_message_relations
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Text search configuration of Message.search_vector (see migration 0019).
+# "simple" does no stemming, which suits the English/Spanish mix on the site.
+MESSAGE_SEARCH_CONFIG = "simple"
+MESSAGE_SEARCH_PAGE_SIZE = 20
+# ts_rank is a float4, which no float parameter compares equal to once
+# promoted; ranks are rounded to an exact numeric so a cursor's rank
+# matches the rows it came from and ties can be paged by id
+MESSAGE_SEARCH_RANK_PLACES = 6
+
+
+def uses_full_text_search():
+    """Message.search_vector only exists on PostgreSQL"""
+    return connection.vendor == "postgresql"
+
+
+def encode_search_cursor(message):
+    """Keyset cursor pointing after `message` in (rank desc, id desc) order"""
+    return f"{message.rank}_{message.id}"
+
+
+def parse_search_cursor(raw):
+    """Parse an encode_search_cursor() value; returns None if it is missing or invalid"""
+    if not raw:
+        return None
+    try:
+        rank, message_id = raw.split("_")
+        rank = Decimal(rank)
+        message_id = int(message_id)
+    except (ValueError, InvalidOperation):
+        return None
+    if not rank.is_finite():
+        return None
+    return rank, message_id
+
+
+def _rank_field():
+    return DecimalField(max_digits=MESSAGE_SEARCH_RANK_PLACES + 6, decimal_places=MESSAGE_SEARCH_RANK_PLACES)
+
+
+def _search_vector():
+    return RawSQL(f'"{Message._meta.db_table}"."search_vector"', [], output_field=SearchVectorField())
+
+
+def match_message_text(messages, query):
+    """
+    Narrow a Message queryset to the messages whose content matches
+    `query`: the search_vector GIN index on PostgreSQL, LIKE elsewhere
+    """
+    if uses_full_text_search():
+        search_query = SearchQuery(query, config=MESSAGE_SEARCH_CONFIG, search_type="websearch")
+        return messages.alias(search_vector=_search_vector()).filter(search_vector=search_query)
+    return messages.filter(content__icontains=query)
+
+
+def search_user_messages(user, query, after=None, limit=None):
+    """
+    Messages in `user`'s conversations matching `query`, best match first.
+
+    On PostgreSQL this is a websearch_to_tsquery() match on the generated
+    search_vector column, served by its GIN index (or, for users with few
+    conversations, by the (conversation, id) index with the stored vector
+    rechecked), and ranked with ts_rank. Elsewhere (the SQLite test
+    database) it falls back to a case-insensitive LIKE with every rank 0.
+    Ranks are Decimals rounded to MESSAGE_SEARCH_RANK_PLACES.
+
+    `after` is a parsed cursor; pages are keyset-paginated on
+    (rank desc, id desc). Returns (messages, next_cursor), where each
+    message carries a `rank` attribute and next_cursor is None on the last
+    page.
+    """
+    limit = limit or MESSAGE_SEARCH_PAGE_SIZE
+    conversation_ids = Conversation.participants.through.objects.filter(user=user).values(
+        "conversation_id"
+    )
+    results = Message.objects.filter(conversation_id__in=conversation_ids)
+
+    results = match_message_text(results, query)
+    if uses_full_text_search():
+        search_query = SearchQuery(query, config=MESSAGE_SEARCH_CONFIG, search_type="websearch")
+        # The same expression is ordered on and compared with the cursor
+        rank = SearchRank(_search_vector(), search_query)
+        results = results.annotate(
+            rank=Cast(Round(rank, MESSAGE_SEARCH_RANK_PLACES), output_field=_rank_field())
+        )
+    else:
+        results = results.annotate(rank=Value(Decimal(0), output_field=_rank_field()))
+
+    if after:
+        rank, message_id = after
+        results = results.filter(Q(rank__lt=rank) | Q(rank=rank, id__lt=message_id))
+
+    page = list(with_message_relations(results).order_by("-rank", "-id")[: limit + 1])
+    has_more = len(page) > limit
+    page = page[:limit]
+    return page, (encode_search_cursor(page[-1]) if has_more else None)
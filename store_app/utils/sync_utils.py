@@ -0,0 +1,166 @@
+# utils/sync_utils.py
+from django.utils import timezone
+from ..models import Conversation
+from .inbox_utils import (
+    add_inbox_timesince,
+    build_inbox,
+    get_cached_unread_count,
+    get_changed_inbox_queryset,
+    get_inbox_snapshot,
+    parse_inbox_cursor,
+    serialize_inbox_entry,
+)
+from .message_utils import receive_new_messages
+from .presence_utils import get_conversation_presence, get_online_user_ids, mark_typing, touch_presence
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Poll interval for the busiest thing a client is watching: an open
+# conversation, the inbox, or just the unread badge
+SYNC_POLL_MS = {"conversation": 3000, "inbox": 5000, "badge": 10000}
+# Every empty sync in a row stretches the interval by this factor, up to
+# SYNC_MAX_POLL_MS; anything new snaps it back to the base interval
+SYNC_BACKOFF = 1.5
+SYNC_MAX_POLL_MS = 60000
+# Idle syncs counted at most; past SYNC_MAX_POLL_MS it makes no difference,
+# and clients send the count back, so it must not grow without bound
+SYNC_MAX_IDLE = 20
+
+
+def get_next_poll_ms(scope, idle):
+    """Delay before the next sync after `idle` consecutive syncs without changes"""
+    idle = min(idle, SYNC_MAX_IDLE)
+    return int(min(SYNC_POLL_MS[scope] * SYNC_BACKOFF ** idle, SYNC_MAX_POLL_MS))
+
+
+def get_inbox_online(inbox):
+    """Ids of the inbox conversations whose other participant is online"""
+    partners = {
+        entry_data["id"]: entry_data.get("other_participant_id") for entry_data in inbox["conversations"]
+    }
+    online = get_online_user_ids([user_id for user_id in partners.values() if user_id])
+    return [conversation_id for conversation_id, user_id in partners.items() if user_id in online]
+
+
+def sync_inbox(user, inbox, since):
+    """
+    Inbox section of a sync: the conversations changed since the `since`
+    cursor (all of them if it is missing or invalid), none if it is current,
+    and which conversations have their other participant online
+    """
+    cursor = inbox["cursor"]
+    online = get_inbox_online(inbox)
+    if since == cursor:
+        return {"cursor": cursor, "full": False, "conversations": [], "online": online}
+
+    now = timezone.now()
+    parsed = parse_inbox_cursor(since)
+    if parsed is None:
+        conversations = [add_inbox_timesince(entry_data, now) for entry_data in inbox["conversations"]]
+    else:
+        conversations = []
+        for entry in build_inbox(user, get_changed_inbox_queryset(user, parsed)):
+            try:
+                conversations.append(serialize_inbox_entry(entry, now))
+            except Exception as e:
+                logger.error(
+                    f"Error processing conversation {entry['conversation'].id} in sync: {str(e)}",
+                    exc_info=True,
+                )
+    return {"cursor": cursor, "full": parsed is None, "conversations": conversations, "online": online}
+
+
+def sync_conversation(user, inbox, conversation_id, last_message_id, typing=False):
+    """
+    Active-thread section of a sync: messages from the others after
+    `last_message_id`, which are marked read, and the other participant's
+    presence. `typing` says the user is typing in it. Returns None if
+    `user` is not a participant.
+
+    The cached inbox knows each conversation's other participant (and so
+    that `user` is one); whether there is anything new comes from the
+    conversation's last_message_id, a primary key lookup, since the cached
+    copy may not have caught up with a message sent a moment ago. A thread
+    with nothing new costs that one query.
+    """
+    entry_data = next((e for e in inbox["conversations"] if e["id"] == conversation_id), None)
+    if entry_data is None or "other_participant_id" not in entry_data:
+        row = (
+            Conversation.objects.filter(id=conversation_id, participants=user)
+            .values_list("user_low_id", "user_high_id", "last_message_id")
+            .first()
+        )
+        if row is None:
+            return None
+        other_user_id = row[1] if row[0] == user.id else row[0]
+        latest_message_id = row[2]
+    else:
+        other_user_id = entry_data["other_participant_id"]
+        latest_message_id = (
+            Conversation.objects.filter(id=conversation_id).values_list("last_message_id", flat=True).first()
+        )
+    has_new = latest_message_id is not None and latest_message_id > last_message_id
+
+    if typing:
+        mark_typing(user, conversation_id)
+    return {
+        "id": conversation_id,
+        "messages": receive_new_messages(user, conversation_id, last_message_id) if has_new else [],
+        "presence": get_conversation_presence(conversation_id, other_user_id) if other_user_id else None,
+    }
+
+
+def build_sync(
+    user,
+    inbox_since=None,
+    conversation_id=None,
+    last_message_id=0,
+    unread_count=None,
+    idle=0,
+    active=False,
+    typing=False,
+):
+    """
+    Combined delta for every messaging widget a client has open.
+
+    The unread badge is always included; the inbox section only when
+    `inbox_since` is not None (an empty string asks for the full list), and
+    the thread section only for a `conversation_id` (`typing` if the user is
+    typing in it). `unread_count` is the badge the client shows. `idle` is
+    the value the previous sync returned: it counts syncs in a row that
+    brought nothing new while the user was not interacting (`active`), and
+    stretches the `next_poll_ms` hint. Every sync doubles as the user's
+    presence heartbeat. Returns None if the user is not a participant of
+    `conversation_id`.
+    """
+    touch_presence(user.id)
+    inbox = get_inbox_snapshot(user)
+    payload = {"success": True}
+    changed = False
+
+    # The thread goes first: reading it changes the badge and the inbox
+    if conversation_id is not None:
+        thread = sync_conversation(user, inbox, conversation_id, last_message_id, typing=typing)
+        if thread is None:
+            return None
+        if thread["messages"]:
+            changed = True
+            inbox = get_inbox_snapshot(user)
+        payload["conversation"] = thread
+    if inbox_since is not None:
+        payload["inbox"] = sync_inbox(user, inbox, inbox_since)
+        changed = changed or bool(payload["inbox"]["conversations"])
+    payload["unread_count"] = get_cached_unread_count(user)
+    changed = changed or (unread_count is not None and unread_count != payload["unread_count"])
+
+    if conversation_id is not None:
+        scope = "conversation"
+    elif inbox_since is not None:
+        scope = "inbox"
+    else:
+        scope = "badge"
+    idle = 0 if changed or active else min(idle + 1, SYNC_MAX_IDLE)
+    payload["idle"] = idle
+    payload["next_poll_ms"] = get_next_poll_ms(scope, idle)
+    return payload
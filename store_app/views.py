@@ -1,7 +1,9 @@
 # store_app/views.py
 from django.contrib import messages
 from django.shortcuts import render, redirect, get_object_or_404
-from django.http import Http404
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.core.handlers.asgi import ASGIRequest
+from asgiref.sync import sync_to_async
 from django.template.loader import render_to_string
 from django.urls import reverse
 from django.views import View
@@ -13,13 +15,12 @@ from django.utils.text import slugify
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
 from decimal import Decimal
+import asyncio
 import logging
 import os
 from django.http import JsonResponse
 from datetime import timedelta
-from django.utils.timesince import timesince
 from django.core.mail import send_mail
-from django.core.paginator import Paginator
 import secrets  # only if you still want a fallback; see note below
 
 from .forms import PreSignupForm
@@ -32,11 +33,42 @@ from .models import (
     ServiceCategory,
     UserProfile,
     Conversation,
+    ConversationParticipantState,
     Message,
+    MessageAttachment,
 )
 from .tokens import new_email_token
+from . import pubsub
+from .ratelimit import RateLimited, rate_limited_response, ratelimit, require_token
+from .utils.attachment_utils import ATTACHMENT_REQUEST_OVERHEAD, AttachmentUploadHandler, send_attachment
+from .utils.conversation_utils import build_conversation_page, get_page_conversation, start_listing_conversation
+from .utils.pagination_utils import KeysetPaginator
+from .utils.export_utils import EXPORT_FORMATS, astream_transcript, stream_transcript
+from .utils.search_utils import parse_search_cursor, search_user_messages
+from .utils.presence_utils import add_inbox_presence, get_conversation_presence, touch_presence
+from .utils.sync_utils import build_sync
+from .utils.message_utils import (
+    conversation_channel,
+    get_latest_message_id,
+    get_message_page,
+    get_messages_after,
+    parse_message_cursor,
+    receive_new_messages,
+    send_message,
+    serialize_messages,
+)
+from .utils.inbox_utils import (
+    add_inbox_timesince,
+    build_inbox,
+    get_cached_unread_count,
+    get_changed_inbox_queryset,
+    get_inbox_snapshot,
+    parse_inbox_cursor,
+    serialize_inbox_entry,
+)
 
-from django.views.decorators.csrf import csrf_exempt
+from django.core.exceptions import ValidationError
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
 from django.views.decorators.http import require_POST, require_GET
 from .utils.review_utils import *
 from django.db.models import Avg, Count
@@ -49,11 +81,9 @@ def home(request):
     products_qs = Product.objects.all().order_by("-id")
     services_qs = Service.objects.all().order_by("-id")
 
-    product_page_number = request.GET.get("product_page")
-    service_page_number = request.GET.get("service_page")
-
-    products_page_obj = Paginator(products_qs, 12).get_page(product_page_number)
-    services_page_obj = Paginator(services_qs, 12).get_page(service_page_number)
+    # Keyset pages: a deep page costs the same as the first
+    products_page_obj = KeysetPaginator(products_qs).get_page(request.GET.get("product_cursor"))
+    services_page_obj = KeysetPaginator(services_qs).get_page(request.GET.get("service_cursor"))
 
     ads = []
     ads_dir = os.path.join(settings.MEDIA_ROOT, "ads")
@@ -70,14 +100,8 @@ def home(request):
     # Calculate total unread messages count for authenticated users
     unread_messages_count = 0
     if user.is_authenticated:
-        # Get all conversations where the user is a participant
-        user_conversations = Conversation.objects.filter(participants=user)
-        # Count all unread messages in these conversations (excluding messages sent by the user)
-        unread_messages_count = (
-            Message.objects.filter(conversation__in=user_conversations, is_read=False)
-            .exclude(sender=user)
-            .count()
-        )
+        # Sum of the denormalized per-conversation counters, cached per user
+        unread_messages_count = get_cached_unread_count(user)
 
     context = {
         "products_page_obj": products_page_obj,
@@ -100,120 +124,21 @@ def add_listing(request):
 def messages_view(request):
     """Display all conversations for the logged-in user"""
     try:
-        # Don't use prefetch_related if it might cause issues with missing fields
-        # Just get conversations and let Django lazy-load relationships
-        conversations = Conversation.objects.filter(participants=request.user)
+        # Cached per user and invalidated on every change (see
+        # utils/inbox_utils.py); the cursor is the one the inbox was read at
+        touch_presence(request.user.id)
+        inbox = get_inbox_snapshot(request.user)
+        now = timezone.now()
+        conversations_with_context = add_inbox_presence(
+            [add_inbox_timesince(entry_data, now) for entry_data in inbox["conversations"]]
+        )
         logger.info(
-            f"Found {conversations.count()} conversations for user {request.user.id}"
+            f"Found {len(conversations_with_context)} conversations for user {request.user.id}"
         )
 
-        # Add context for each conversation
-        conversations_with_context = []
-        for conv in conversations:
-            try:
-                other_participant = conv.get_other_participant(request.user)
-                # Skip conversations where other_participant is None (shouldn't happen, but handle gracefully)
-                if other_participant is None:
-                    logger.warning(
-                        f"Conversation {conv.id} has no other participant for user {request.user.id}"
-                    )
-                    continue
-
-                # Get latest message - handle errors gracefully
-                try:
-                    latest_message = conv.get_latest_message()
-                except Exception as e:
-                    logger.warning(
-                        f"Error getting latest message for conversation {conv.id}: {str(e)}"
-                    )
-                    latest_message = None
-
-                # Get unread count - handle errors gracefully
-                try:
-                    unread_count = (
-                        conv.messages.filter(is_read=False)
-                        .exclude(sender=request.user)
-                        .count()
-                    )
-                except Exception as e:
-                    logger.warning(
-                        f"Error getting unread count for conversation {conv.id}: {str(e)}"
-                    )
-                    unread_count = 0
-
-                # Get unique products and services mentioned in messages
-                # Use a set to ensure uniqueness across all databases
-                # Wrap in try-except in case fields don't exist yet (migration not run)
-                try:
-                    mentioned_products_raw = conv.messages.filter(
-                        product__isnull=False
-                    ).values_list("product", "product__name")
-                    mentioned_services_raw = conv.messages.filter(
-                        service__isnull=False
-                    ).values_list("service", "service__name")
-
-                    # Use dict to ensure uniqueness by ID (keeps last name if duplicates)
-                    products_dict = {
-                        pid: pname for pid, pname in mentioned_products_raw
-                    }
-                    services_dict = {
-                        sid: sname for sid, sname in mentioned_services_raw
-                    }
-
-                    # Convert to lists of dicts for easier template access
-                    products_list = [
-                        {"id": pid, "name": pname}
-                        for pid, pname in products_dict.items()
-                    ]
-                    services_list = [
-                        {"id": sid, "name": sname}
-                        for sid, sname in services_dict.items()
-                    ]
-                except Exception as e:
-                    # If fields don't exist yet (migration not run), return empty lists
-                    logger.warning(
-                        f"Error getting mentioned products/services for conversation {conv.id}: {str(e)}"
-                    )
-                    products_list = []
-                    services_list = []
-
-                conversations_with_context.append(
-                    {
-                        "conversation": conv,
-                        "other_participant": other_participant,
-                        "latest_message": latest_message,
-                        "unread_count": unread_count,
-                        "mentioned_products": products_list,
-                        "mentioned_services": services_list,
-                    }
-                )
-            except Exception as e:
-                # Log the error but still try to add the conversation with minimal data
-                logger.error(
-                    f"Error processing conversation {conv.id}: {str(e)}", exc_info=True
-                )
-                # Try to get at least basic info to show the conversation
-                try:
-                    other_participant = conv.get_other_participant(request.user)
-                    if other_participant:
-                        conversations_with_context.append(
-                            {
-                                "conversation": conv,
-                                "other_participant": other_participant,
-                                "latest_message": None,
-                                "unread_count": 0,
-                                "mentioned_products": [],
-                                "mentioned_services": [],
-                            }
-                        )
-                except Exception as e2:
-                    logger.error(
-                        f"Could not add conversation {conv.id} even with minimal data: {str(e2)}"
-                    )
-                    continue
-
         context = {
             "conversations": conversations_with_context,
+            "inbox_cursor": inbox["cursor"],
         }
         return render(request, "messages.html", context)
     except Exception as e:
@@ -399,11 +324,9 @@ def search(request):
         )
         return redirect("store_app:home")
 
-    product_page_number = request.GET.get("product_page")
-    service_page_number = request.GET.get("service_page")
-
-    products_page_obj = Paginator(products_qs, 12).get_page(product_page_number)
-    services_page_obj = Paginator(services_qs, 12).get_page(service_page_number)
+    # Keyset pages: a deep page costs the same as the first
+    products_page_obj = KeysetPaginator(products_qs).get_page(request.GET.get("product_cursor"))
+    services_page_obj = KeysetPaginator(services_qs).get_page(request.GET.get("service_cursor"))
 
     products_categories = ProductCategory.objects.all()
     services_categories = ServiceCategory.objects.all()
@@ -674,30 +597,13 @@ def _send_verification_email(request, user, profile):
     return token, expires
 
 @login_required
+@ratelimit("send_message")
 def conversation_view(request, conversation_id):
     """Display a specific conversation and handle sending messages"""
-    try:
-        # Get conversation and verify user is a participant
-        conversation = get_object_or_404(Conversation, id=conversation_id)
-        
-        # Verify user is a participant
-        if request.user not in conversation.participants.all():
-            logger.warning(
-                f"User {request.user.id} is not a participant in conversation {conversation_id}"
-            )
-            return redirect("store_app:messages")
-            
-        # Refresh to ensure all relationships are loaded
-        conversation.refresh_from_db()
-        
-    except Http404:
+    conversation = get_page_conversation(request.user, conversation_id)
+    if conversation is None:
         logger.warning(
-            f"Conversation {conversation_id} not found"
-        )
-        return redirect("store_app:messages")
-    except Exception as e:
-        logger.error(
-            f"Error accessing conversation {conversation_id}: {str(e)}", exc_info=True
+            f"Conversation {conversation_id} not found or user {request.user.id} is not a participant"
         )
         return redirect("store_app:messages")
 
@@ -707,48 +613,21 @@ def conversation_view(request, conversation_id):
         service_id = request.POST.get("service_id", "").strip()
 
         if content:
-            # Create new message
-            # Handle case where product/service fields might not exist yet (migration not run)
             try:
-                message_data = {
-                    "conversation": conversation,
-                    "sender": request.user,
-                    "content": content,
-                }
-                # Only add product/service if provided and fields exist
-                if product_id:
-                    try:
-                        message_data["product_id"] = int(product_id)
-                    except (ValueError, TypeError):
-                        pass  # Invalid product_id, skip it
-                if service_id:
-                    try:
-                        message_data["service_id"] = int(service_id)
-                    except (ValueError, TypeError):
-                        pass  # Invalid service_id, skip it
-
-                # Try to create message with product/service fields
-                try:
-                    message = Message.objects.create(**message_data)
-                except Exception as e:
-                    # If fields don't exist in DB, create without them
-                    logger.warning(
-                        f"Error creating message with product/service fields: {str(e)}"
-                    )
-                    # Remove product/service from message_data and try again
-                    message_data.pop("product_id", None)
-                    message_data.pop("service_id", None)
-                    message = Message.objects.create(**message_data)
-
-                # Ensure message is saved
-                message.save()
-
-                # Update conversation's updated_at timestamp
-                conversation.save()
-
-                logger.info(
-                    f"Message {message.id} created successfully in conversation {conversation.id}"
+                # One transaction: the message, the conversation bump and the
+                # recipients' unread counters (post_save)
+                message, created = send_message(
+                    conversation.id,
+                    request.user,
+                    content,
+                    product_id=_parse_message_id(product_id),
+                    service_id=_parse_message_id(service_id),
+                    client_key=request.POST.get("client_key", "").strip()[:64] or None,
                 )
+                if created:
+                    logger.info(
+                        f"Message {message.id} created successfully in conversation {conversation.id}"
+                    )
             except Exception as e:
                 logger.error(f"Error creating message: {str(e)}", exc_info=True)
                 if (
@@ -778,41 +657,7 @@ def conversation_view(request, conversation_id):
             ):
                 from django.http import JsonResponse
 
-                message_data = {
-                    "id": message.id,
-                    "sender": message.sender.username,
-                    "sender_name": message.sender.get_full_name()
-                    or message.sender.username,
-                    "content": message.content,
-                    "timestamp": message.created_at.strftime("%b %d, %Y %I:%M %p"),
-                }
-                # Add profile picture info
-                try:
-                    if hasattr(message.sender, "profile") and message.sender.profile.profile_picture:
-                        message_data["sender_profile_picture"] = str(message.sender.profile.profile_picture)
-                    if hasattr(request.user, "profile") and request.user.profile.profile_picture:
-                        message_data["current_user_profile_picture"] = str(request.user.profile.profile_picture)
-                except Exception as e:
-                    logger.warning(f"Error accessing profile picture: {str(e)}")
-                    pass
-                # Add product/service info if present (handle case where fields might not exist)
-                try:
-                    if hasattr(message, "product") and message.product:
-                        message_data["product"] = {
-                            "id": message.product.id,
-                            "name": message.product.name,
-                        }
-                    if hasattr(message, "service") and message.service:
-                        message_data["service"] = {
-                            "id": message.service.id,
-                            "name": message.service.name,
-                        }
-                except Exception as e:
-                    # Fields don't exist yet, skip adding product/service info
-                    logger.warning(
-                        f"Error accessing product/service fields on message: {str(e)}"
-                    )
-                    pass
+                message_data = serialize_messages([message], current_user=request.user)[0]
                 return JsonResponse({"success": True, "message": message_data})
             else:
                 messages.success(request, "Message sent!")
@@ -833,119 +678,37 @@ def conversation_view(request, conversation_id):
             else:
                 messages.error(request, "Message cannot be empty.", extra_tags="danger")
 
-    # Mark all messages in this conversation as read (except those sent by current user)
-    try:
-        conversation.messages.filter(is_read=False).exclude(sender=request.user).update(
-            is_read=True, read_at=timezone.now()
-        )
-    except Exception as e:
-        logger.warning(f"Error marking messages as read: {str(e)}")
-        # Continue anyway - this is not critical
+    return _render_conversation_page(request, conversation)
 
-    # Get all messages in this conversation
-    try:
-        # Refresh conversation to ensure all relationships are loaded
-        conversation.refresh_from_db()
-        
-        messages_list = conversation.messages.all()
-        other_participant = conversation.get_other_participant(request.user)
 
-        if not other_participant:
-            logger.error(
-                f"Conversation {conversation_id} has no other participant for user {request.user.id}"
-            )
-            logger.error(f"Conversation participants: {[p.id for p in conversation.participants.all()]}")
-            logger.error(f"Current user ID: {request.user.id}")
-            # Don't show error message - just redirect silently
-            return redirect("store_app:messages")
+def _render_conversation_page(request, conversation):
+    """Render conversation.html for a get_page_conversation() / start_listing_conversation() result"""
+    if not conversation.other_participant:
+        logger.error(
+            f"Conversation {conversation.id} has no other participant for user {request.user.id}"
+        )
+        return redirect("store_app:messages")
 
-        # Get all products and services from both participants
-        # This allows both buyer and seller to select context for their messages
-        available_products = []
-        available_services = []
+    touch_presence(request.user.id)
 
-        try:
-            if other_participant:
-                # Get products/services from both current user and other participant
-                try:
-                    available_products = Product.objects.filter(
-                        Q(user_vendor=request.user) | Q(user_vendor=other_participant)
-                    ).order_by("name")
-                except Exception as e:
-                    logger.warning(f"Error getting available products: {str(e)}")
-                    available_products = []
-                try:
-                    available_services = Service.objects.filter(
-                        Q(user_provider=request.user)
-                        | Q(user_provider=other_participant)
-                    ).order_by("name")
-                except Exception as e:
-                    logger.warning(f"Error getting available services: {str(e)}")
-                    available_services = []
-            else:
-                # Fallback: just get current user's products/services
-                try:
-                    available_products = Product.objects.filter(
-                        user_vendor=request.user
-                    ).order_by("name")
-                except Exception as e:
-                    logger.warning(f"Error getting available products: {str(e)}")
-                    available_products = []
-                try:
-                    available_services = Service.objects.filter(
-                        user_provider=request.user
-                    ).order_by("name")
-                except Exception as e:
-                    logger.warning(f"Error getting available services: {str(e)}")
-                    available_services = []
-        except Exception as e:
-            logger.warning(
-                f"Error getting products/services for conversation: {str(e)}"
+    # Mark the conversation as read up to its latest message (the pointer
+    # loaded with the conversation)
+    try:
+        if conversation.last_message_id:
+            ConversationParticipantState.mark_read(
+                request.user, conversation.id, conversation.last_message_id
             )
-            # Continue with empty lists - not critical
-
-        # Get all products and services mentioned in messages (for "Discussed" section)
-        mentioned_products = []
-        mentioned_services = []
-        try:
-            mentioned_products_raw = conversation.messages.filter(
-                product__isnull=False
-            ).values_list("product", "product__name").distinct()
-            mentioned_services_raw = conversation.messages.filter(
-                service__isnull=False
-            ).values_list("service", "service__name").distinct()
-
-            # Use dict to ensure uniqueness by ID
-            products_dict = {pid: pname for pid, pname in mentioned_products_raw}
-            services_dict = {sid: sname for sid, sname in mentioned_services_raw}
-
-            # Convert to lists of dicts for easier template access
-            mentioned_products = [
-                {"id": pid, "name": pname} for pid, pname in products_dict.items()
-            ]
-            mentioned_services = [
-                {"id": sid, "name": sname} for sid, sname in services_dict.items()
-            ]
-        except Exception as e:
-            logger.warning(f"Error getting mentioned products/services: {str(e)}")
-            # Continue with empty lists - not critical
+    except Exception as e:
+        logger.warning(f"Error marking messages as read: {str(e)}")
+        # Continue anyway - this is not critical
 
-        context = {
-            "conversation": conversation,
-            "messages": messages_list,
-            "other_participant": other_participant,
-            "other_products": available_products,
-            "other_services": available_services,
-            "mentioned_products": mentioned_products,
-            "mentioned_services": mentioned_services,
-        }
+    try:
+        context = build_conversation_page(request.user, conversation)
         return render(request, "conversation.html", context)
     except Exception as e:
         logger.error(
-            f"Error loading conversation {conversation_id}: {str(e)}", exc_info=True
+            f"Error loading conversation {conversation.id}: {str(e)}", exc_info=True
         )
-        logger.error(f"Conversation exists: {Conversation.objects.filter(id=conversation_id).exists()}")
-        logger.error(f"User {request.user.id} is participant: {Conversation.objects.filter(id=conversation_id, participants=request.user).exists()}")
         # Don't show error message that persists - just redirect silently
         return redirect("store_app:messages")
 
@@ -957,77 +720,383 @@ def get_new_messages(request, conversation_id):
         Conversation, id=conversation_id, participants=request.user
     )
 
-    # Get the last message ID from the request (if provided)
-    last_message_id = request.GET.get("last_message_id", None)
+    # Messages after last_message_id (all of them without one); they are marked read
+    last_message_id = _parse_message_id(request.GET.get("last_message_id"))
+    messages_data = receive_new_messages(request.user, conversation.id, last_message_id)
+    touch_presence(request.user.id)
 
-    # Query for new messages
-    if last_message_id:
-        try:
-            last_message_id = int(last_message_id)
-            new_messages = conversation.messages.filter(id__gt=last_message_id).exclude(
-                sender=request.user
+    return JsonResponse({"success": True, "messages": messages_data})
+
+
+@login_required
+def get_older_messages(request, conversation_id):
+    """API endpoint to fetch the page of messages before a history cursor"""
+    conversation = get_object_or_404(
+        Conversation, id=conversation_id, participants=request.user
+    )
+
+    before = parse_message_cursor(request.GET.get("before"))
+    if before is None:
+        return JsonResponse({"success": False, "error": "Invalid cursor."}, status=400)
+
+    page, older_cursor = get_message_page(conversation.id, before=before)
+
+    messages_data = serialize_messages(page, current_user=request.user)
+
+    return JsonResponse(
+        {"success": True, "messages": messages_data, "older_cursor": older_cursor}
+    )
+
+
+@login_required
+@require_POST
+@ratelimit("send_message")
+def send_conversation_message(request, conversation_id):
+    """
+    API endpoint to send a message with a JSON body:
+
+        {"content": "...", "client_key": "...", "product_id": 1, "service_id": 2}
+
+    `client_key` (or an Idempotency-Key header) is chosen by the client and
+    reused when it retries; a replayed key returns the message stored the
+    first time (200) instead of creating another one (201).
+    """
+    conversation = get_object_or_404(
+        Conversation, id=conversation_id, participants=request.user
+    )
+
+    try:
+        data = json.loads(request.body)
+    except ValueError:
+        data = None
+    if not isinstance(data, dict):
+        return JsonResponse({"success": False, "error": "Invalid JSON body."}, status=400)
+
+    content = str(data.get("content") or "").strip()
+    if not content:
+        return JsonResponse({"success": False, "error": "Message cannot be empty."}, status=400)
+
+    client_key = str(data.get("client_key") or request.headers.get("Idempotency-Key") or "").strip()
+    if len(client_key) > Message._meta.get_field("client_key").max_length:
+        return JsonResponse({"success": False, "error": "client_key is too long."}, status=400)
+
+    product_id = _parse_message_id(data.get("product_id"))
+    if product_id is not None and not Product.objects.filter(id=product_id).exists():
+        return JsonResponse({"success": False, "error": "Product not found."}, status=400)
+    service_id = _parse_message_id(data.get("service_id"))
+    if service_id is not None and not Service.objects.filter(id=service_id).exists():
+        return JsonResponse({"success": False, "error": "Service not found."}, status=400)
+
+    message, created = send_message(
+        conversation.id,
+        request.user,
+        content,
+        product_id=product_id,
+        service_id=service_id,
+        client_key=client_key or None,
+    )
+    if created:
+        logger.info(f"Message {message.id} created successfully in conversation {conversation.id}")
+
+    message_data = serialize_messages([message], current_user=request.user)[0]
+    return JsonResponse(
+        {"success": True, "created": created, "message": message_data},
+        status=201 if created else 200,
+    )
+
+
+@login_required
+def search_messages(request):
+    """API endpoint to search the messages of the user's conversations"""
+    query = request.GET.get("q", "").strip()
+    if not query:
+        return JsonResponse({"success": False, "error": "Search query is required."}, status=400)
+
+    after = None
+    if request.GET.get("cursor"):
+        after = parse_search_cursor(request.GET["cursor"])
+        if after is None:
+            return JsonResponse({"success": False, "error": "Invalid cursor."}, status=400)
+
+    hits, next_cursor = search_user_messages(request.user, query, after=after)
+
+    results = []
+    for message_data, message in zip(serialize_messages(hits), hits):
+        message_data["conversation_id"] = message.conversation_id
+        message_data["rank"] = float(message.rank)
+        results.append(message_data)
+
+    return JsonResponse({"success": True, "results": results, "next_cursor": next_cursor})
+
+
+# Seconds between keep-alive comments on an idle stream. Each keep-alive also
+# re-checks the database, so events a per-process pub/sub backend could not
+# deliver (e.g. published by another worker) still arrive within this window.
+STREAM_KEEPALIVE_SECONDS = 15
+# Streams are closed after this long; EventSource reconnects by itself and
+# resumes from Last-Event-ID, which bounds how long a connection is held.
+STREAM_MAX_SECONDS = 300
+
+
+def _parse_message_id(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _mark_stream_messages_read(user, conversation_id, message_ids):
+    ConversationParticipantState.mark_read(user, conversation_id, max(message_ids))
+
+
+def _sse_event(message_data):
+    return f"id: {message_data['id']}\nevent: message\ndata: {json.dumps(message_data)}\n\n"
+
+
+def _stream_presence(user, conversation_id, other_user_id):
+    """Heartbeat for the streaming user; returns the other participant's presence"""
+    touch_presence(user.id)
+    return get_conversation_presence(conversation_id, other_user_id)
+
+
+async def _conversation_events(user, conversation_id, last_message_id, other_user_id=None):
+    subscription = pubsub.subscribe(conversation_channel(conversation_id))
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + STREAM_MAX_SECONDS
+    presence = None
+    try:
+        # Tell EventSource how quickly to reconnect after we close the stream
+        yield "retry: 3000\n\n"
+        if last_message_id is None:
+            last_message_id = await sync_to_async(get_latest_message_id)(conversation_id)
+
+        # Catch up on anything sent before we subscribed
+        payloads = await sync_to_async(get_messages_after)(conversation_id, last_message_id)
+        while True:
+            fresh = sorted(
+                (p for p in payloads if p["id"] > last_message_id), key=lambda p: p["id"]
             )
-        except ValueError:
-            new_messages = conversation.messages.exclude(sender=request.user)
+            # Messages the user receives through the stream count as read,
+            # just like the ones returned by get_new_messages
+            received_ids = [p["id"] for p in fresh if p["sender"] != user.username]
+            if received_ids:
+                await sync_to_async(_mark_stream_messages_read)(user, conversation_id, received_ids)
+            for message_data in fresh:
+                yield _sse_event(message_data)
+                last_message_id = message_data["id"]
+
+            if loop.time() >= deadline:
+                break
+            if other_user_id is not None:
+                # The stream is the user's heartbeat; the other side's
+                # presence is re-sent whenever it changes
+                latest_presence = await sync_to_async(_stream_presence)(user, conversation_id, other_user_id)
+                if latest_presence != presence:
+                    presence = latest_presence
+                    yield f"event: presence\ndata: {json.dumps(presence)}\n\n"
+            payloads = await subscription.get(STREAM_KEEPALIVE_SECONDS)
+            if not payloads:
+                yield ": keepalive\n\n"
+                payloads = await sync_to_async(get_messages_after)(
+                    conversation_id, last_message_id
+                )
+    finally:
+        subscription.close()
+
+
+async def conversation_stream(request, conversation_id):
+    """
+    Server-Sent Events stream of new messages in a conversation.
+
+    Only served under ASGI; WSGI workers answer 204 so the client falls back
+    to polling get_new_messages instead of pinning a worker thread.
+    """
+    user = await request.auser()
+    if not user.is_authenticated:
+        return HttpResponse(status=401)
+    if not isinstance(request, ASGIRequest):
+        return HttpResponse(status=204)
+
+    pair = await (
+        Conversation.objects.filter(id=conversation_id, participants=user)
+        .values_list("user_low_id", "user_high_id")
+        .afirst()
+    )
+    if pair is None:
+        raise Http404("Conversation not found")
+    other_user_id = pair[1] if pair[0] == user.id else pair[0]
+
+    last_message_id = _parse_message_id(
+        request.headers.get("Last-Event-ID") or request.GET.get("last_message_id")
+    )
+    response = StreamingHttpResponse(
+        _conversation_events(user, conversation_id, last_message_id, other_user_id),
+        content_type="text/event-stream",
+    )
+    response["Cache-Control"] = "no-cache"
+    # Keep nginx from buffering the stream
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+@login_required
+@require_GET
+def export_conversation(request, conversation_id):
+    """
+    Download a conversation's transcript as JSON Lines (default) or CSV
+    (`?format=csv`). Participants and staff moderators may export it.
+
+    The transcript is streamed straight from a database cursor, so even
+    threads with tens of thousands of messages use constant memory. Under
+    ASGI the chunks are fetched asynchronously (see astream_transcript()).
+    """
+    conversations = Conversation.objects.filter(id=conversation_id)
+    if not request.user.is_staff:
+        conversations = conversations.filter(participants=request.user)
+    if not conversations.exists():
+        raise Http404("Conversation not found")
+
+    export_format = request.GET.get("format", "jsonl")
+    if export_format not in EXPORT_FORMATS:
+        return JsonResponse({"success": False, "error": "Unsupported format."}, status=400)
+
+    if isinstance(request, ASGIRequest):
+        lines = astream_transcript([conversation_id], export_format)
     else:
-        # If no last_message_id provided, get all messages (for initial load)
-        new_messages = conversation.messages.exclude(sender=request.user)
-
-    # Mark new messages as read
-    new_messages.update(is_read=True, read_at=timezone.now())
-
-    # Serialize messages
-    messages_data = []
-    for message in new_messages:
-        message_data = {
-            "id": message.id,
-            "sender": message.sender.username,
-            "sender_name": message.sender.get_full_name() or message.sender.username,
-            "content": message.content,
-            "timestamp": message.created_at.strftime("%b %d, %Y %I:%M %p"),
-        }
-        # Add profile picture info
-        try:
-            if hasattr(message.sender, "profile") and message.sender.profile.profile_picture:
-                message_data["sender_profile_picture"] = str(message.sender.profile.profile_picture)
-            if hasattr(request.user, "profile") and request.user.profile.profile_picture:
-                message_data["current_user_profile_picture"] = str(request.user.profile.profile_picture)
-        except Exception as e:
-            logger.warning(f"Error accessing profile picture in get_new_messages: {str(e)}")
-            pass
-        # Add product/service info if present (handle case where fields might not exist)
-        try:
-            if hasattr(message, "product") and message.product:
-                message_data["product"] = {
-                    "id": message.product.id,
-                    "name": message.product.name,
-                }
-            if hasattr(message, "service") and message.service:
-                message_data["service"] = {
-                    "id": message.service.id,
-                    "name": message.service.name,
-                }
-        except Exception as e:
-            # Fields don't exist yet, skip adding product/service info
-            logger.warning(
-                f"Error accessing product/service fields on message in get_new_messages: {str(e)}"
-            )
-            pass
-        messages_data.append(message_data)
+        lines = stream_transcript([conversation_id], export_format)
+    response = StreamingHttpResponse(
+        lines,
+        content_type=f"{EXPORT_FORMATS[export_format]}; charset=utf-8",
+    )
+    response["Content-Disposition"] = (
+        f'attachment; filename="conversation-{conversation_id}.{export_format}"'
+    )
+    response["Cache-Control"] = "private, no-store"
+    logger.info(f"User {request.user.id} exported conversation {conversation_id} as {export_format}")
+    return response
 
-    return JsonResponse({"success": True, "messages": messages_data})
+
+# Attachment files never change once stored (new uploads get new ids), so
+# browsers may keep them for a year without revalidating
+ATTACHMENT_CACHE_CONTROL = "private, max-age=31536000, immutable"
+
+
+@login_required
+@require_POST
+@ratelimit("send_message")
+@csrf_exempt
+def upload_message_attachment(request, conversation_id):
+    """
+    API endpoint to send an image or PDF as a multipart upload: `file`,
+    plus optional `content` (caption) and `client_key` fields.
+
+    The body is streamed to a temporary file rather than read into memory,
+    and refused with 413 once the file passes MESSAGE_ATTACHMENT_MAX_SIZE.
+    The CSRF check runs in _upload_message_attachment(), after the upload
+    handler is in place (checking it here would read the body first).
+    """
+    handler = AttachmentUploadHandler(request)
+    try:
+        content_length = int(request.META.get("CONTENT_LENGTH") or 0)
+    except ValueError:
+        content_length = 0
+    if content_length > handler.max_size + ATTACHMENT_REQUEST_OVERHEAD:
+        return _attachment_too_large(handler)
+    request.upload_handlers = [handler]
+    return _upload_message_attachment(request, conversation_id, handler)
+
+
+def _attachment_too_large(handler):
+    return JsonResponse(
+        {
+            "success": False,
+            "error": f"Attachments can be at most {handler.max_size // (1024 * 1024)} MB.",
+        },
+        status=413,
+    )
+
+
+@csrf_protect
+def _upload_message_attachment(request, conversation_id, handler):
+    conversation = get_object_or_404(
+        Conversation, id=conversation_id, participants=request.user
+    )
+
+    upload = request.FILES.get("file")
+    if handler.too_large:
+        return _attachment_too_large(handler)
+    if upload is None:
+        return JsonResponse({"success": False, "error": "Choose a file to attach."}, status=400)
+
+    client_key = request.POST.get("client_key", "").strip()
+    if len(client_key) > Message._meta.get_field("client_key").max_length:
+        return JsonResponse({"success": False, "error": "client_key is too long."}, status=400)
+
+    try:
+        message, created = send_attachment(
+            conversation.id,
+            request.user,
+            upload,
+            content=request.POST.get("content", "").strip(),
+            client_key=client_key or None,
+        )
+    except ValidationError as e:
+        return JsonResponse({"success": False, "error": e.messages[0]}, status=400)
+    if created:
+        logger.info(f"Attachment message {message.id} created in conversation {conversation.id}")
+
+    message_data = serialize_messages([message], current_user=request.user)[0]
+    return JsonResponse(
+        {"success": True, "created": created, "message": message_data},
+        status=201 if created else 200,
+    )
+
+
+def _serve_attachment_file(request, attachment_id, thumbnail):
+    attachment = get_object_or_404(
+        MessageAttachment.objects.filter(conversation__participants=request.user),
+        id=attachment_id,
+    )
+    stored = attachment.thumbnail if thumbnail else attachment.file
+    if not stored:
+        raise Http404("Attachment not found")
+
+    # The stored name is unique to this version of the file
+    etag = f'"{stored.name}"'
+    if request.headers.get("If-None-Match") == etag:
+        response = HttpResponseNotModified()
+    else:
+        response = FileResponse(
+            stored.open("rb"),
+            content_type="image/webp" if thumbnail else attachment.content_type,
+            as_attachment=not thumbnail and attachment.kind != MessageAttachment.KIND_IMAGE,
+            filename=attachment.original_name,
+        )
+    response["ETag"] = etag
+    response["Cache-Control"] = ATTACHMENT_CACHE_CONTROL
+    return response
+
+
+@login_required
+@require_GET
+def message_attachment(request, attachment_id):
+    """Download a message attachment (participants only)"""
+    return _serve_attachment_file(request, attachment_id, thumbnail=False)
+
+
+@login_required
+@require_GET
+def message_attachment_thumbnail(request, attachment_id):
+    """The thumbnail of an image attachment, once the worker has made it"""
+    return _serve_attachment_file(request, attachment_id, thumbnail=True)
 
 
 @login_required
 def get_unread_messages_count(request):
     """API endpoint to get the total unread messages count for the logged-in user"""
     try:
-        user_conversations = Conversation.objects.filter(participants=request.user)
-        unread_count = (
-            Message.objects.filter(conversation__in=user_conversations, is_read=False)
-            .exclude(sender=request.user)
-            .count()
-        )
+        unread_count = get_cached_unread_count(request.user)
+        touch_presence(request.user.id)
 
         return JsonResponse({"success": True, "unread_count": unread_count})
     except Exception as e:
@@ -1042,132 +1111,101 @@ def get_unread_messages_count(request):
 
 
 @login_required
-def get_conversations_update(request):
-    """API endpoint to fetch updated conversation data for the messages list"""
-    try:
-        # Don't use prefetch_related if it might cause issues with missing fields
-        conversations = Conversation.objects.filter(participants=request.user)
+def sync_messages(request):
+    """
+    API endpoint combining the unread badge, inbox and open-conversation polls.
+
+    Query parameters (all optional):
+        inbox            inbox cursor of the previous sync; present but empty
+                         asks for the full conversation list
+        conversation     id of the open conversation
+        last_message_id  latest message the client shows in it
+        unread           unread count the client shows
+        idle             `idle` returned by the previous sync
+        active           1 if the user interacted since the previous sync
+        typing           1 if the user is typing in the open conversation
+
+    The response carries `unread_count`, the requested `inbox` and
+    `conversation` deltas (with who is online and typing), and
+    `next_poll_ms`: when to sync again. The request is also the user's
+    presence heartbeat.
+    """
+    conversation_id = _parse_message_id(request.GET.get("conversation"))
+    if request.GET.get("conversation") and conversation_id is None:
+        return JsonResponse({"success": False, "error": "Invalid conversation."}, status=400)
+
+    payload = build_sync(
+        request.user,
+        inbox_since=request.GET.get("inbox"),
+        conversation_id=conversation_id,
+        last_message_id=_parse_message_id(request.GET.get("last_message_id")) or 0,
+        unread_count=_parse_message_id(request.GET.get("unread")),
+        idle=max(_parse_message_id(request.GET.get("idle")) or 0, 0),
+        active=request.GET.get("active") == "1",
+        typing=request.GET.get("typing") == "1",
+    )
+    if payload is None:
+        raise Http404("Conversation not found")
 
-        conversations_data = []
-        for conv in conversations:
-            try:
-                other_participant = conv.get_other_participant(request.user)
-                # Skip conversations where other_participant is None
-                if other_participant is None:
-                    logger.warning(
-                        f"Conversation {conv.id} has no other participant for user {request.user.id}"
-                    )
-                    continue
+    response = JsonResponse(payload)
+    response["Cache-Control"] = "private, no-cache"
+    return response
 
-                latest_message = conv.get_latest_message()
-                unread_count = (
-                    conv.messages.filter(is_read=False)
-                    .exclude(sender=request.user)
-                    .count()
-                )
 
-                latest_message_timesince = None
-                conversation_timesince = timesince(conv.created_at, timezone.now())
-                if latest_message:
-                    latest_message_timesince = timesince(
-                        latest_message.created_at, timezone.now()
-                    )
+@login_required
+def get_conversations_update(request):
+    """
+    API endpoint to fetch updated conversation data for the messages list.
 
-                # Get unique products and services mentioned in messages
-                # Use a dict to ensure uniqueness by ID (keeps last name if duplicates)
-                # Wrap in try-except in case fields don't exist yet (migration not run)
+    Supports delta sync: pass the `cursor` of a previous response as
+    `?since=` (and/or as an If-None-Match ETag) to receive only the
+    conversations that changed since then, or an empty 304 when nothing did.
+    """
+    try:
+        touch_presence(request.user.id)
+        # Idle pollers are answered from the cached inbox without any SQL
+        inbox = get_inbox_snapshot(request.user)
+        cursor = inbox["cursor"]
+        etag = f'"{cursor}"'
+        if request.headers.get("If-None-Match") == etag:
+            response = HttpResponse(status=304)
+            response["ETag"] = etag
+            return response
+
+        since = parse_inbox_cursor(
+            request.GET.get("since") or request.headers.get("If-None-Match")
+        )
+        now = timezone.now()
+        conversations_data = []
+        if since:
+            entries = build_inbox(
+                request.user, get_changed_inbox_queryset(request.user, since)
+            )
+            for entry in entries:
                 try:
-                    mentioned_products_raw = conv.messages.filter(
-                        product__isnull=False
-                    ).values_list("product", "product__name")
-                    mentioned_services_raw = conv.messages.filter(
-                        service__isnull=False
-                    ).values_list("service", "service__name")
-
-                    # Use dict to ensure uniqueness by ID
-                    products_dict = {
-                        pid: pname for pid, pname in mentioned_products_raw
-                    }
-                    services_dict = {
-                        sid: sname for sid, sname in mentioned_services_raw
-                    }
-
-                    # Convert to lists of dicts
-                    products_list = [
-                        {"id": pid, "name": pname}
-                        for pid, pname in products_dict.items()
-                    ]
-                    services_list = [
-                        {"id": sid, "name": sname}
-                        for sid, sname in services_dict.items()
-                    ]
+                    conversations_data.append(serialize_inbox_entry(entry, now))
                 except Exception as e:
-                    # If fields don't exist yet (migration not run), return empty lists
-                    logger.warning(
-                        f"Error getting mentioned products/services for conversation {conv.id} in get_conversations_update: {str(e)}"
+                    logger.error(
+                        f"Error processing conversation {entry['conversation'].id} in get_conversations_update: {str(e)}",
+                        exc_info=True,
                     )
-                    products_list = []
-                    services_list = []
-
-                # Get profile picture for other participant
-                other_participant_profile_picture = None
-                try:
-                    if hasattr(other_participant, "profile") and other_participant.profile.profile_picture:
-                        other_participant_profile_picture = str(other_participant.profile.profile_picture)
-                except Exception as e:
-                    logger.warning(f"Error accessing profile picture for user {other_participant.id}: {str(e)}")
-                    pass
-
-                conversations_data.append(
-                    {
-                        "id": conv.id,
-                        "other_participant_name": (
-                            other_participant.get_full_name()
-                            if other_participant
-                            else "Unknown"
-                        ),
-                        "other_participant_username": (
-                            other_participant.username
-                            if other_participant
-                            else "unknown"
-                        ),
-                        "other_participant_profile_picture": other_participant_profile_picture,
-                        "latest_message": (
-                            {
-                                "content": (
-                                    latest_message.content if latest_message else None
-                                ),
-                                "timestamp": (
-                                    latest_message.created_at.strftime(
-                                        "%b %d, %Y %I:%M %p"
-                                    )
-                                    if latest_message
-                                    else None
-                                ),
-                                "timesince": latest_message_timesince,
-                            }
-                            if latest_message
-                            else None
-                        ),
-                        "conversation_timesince": conversation_timesince,  # For conversations with no messages
-                        "unread_count": unread_count,
-                        "updated_at": conv.updated_at.isoformat(),
-                        "has_product": conv.product is not None,
-                        "has_service": conv.service is not None,
-                        "product_name": conv.product.name if conv.product else None,
-                        "service_name": conv.service.name if conv.service else None,
-                        "mentioned_products": products_list,
-                        "mentioned_services": services_list,
-                    }
-                )
-            except Exception as e:
-                logger.error(
-                    f"Error processing conversation {conv.id} in get_conversations_update: {str(e)}",
-                    exc_info=True,
-                )
-                continue
+                    continue
+        else:
+            conversations_data = [
+                add_inbox_timesince(entry_data, now) for entry_data in inbox["conversations"]
+            ]
 
-        return JsonResponse({"success": True, "conversations": conversations_data})
+        response = JsonResponse(
+            {
+                "success": True,
+                "conversations": conversations_data,
+                "cursor": cursor,
+                "full": since is None,
+            }
+        )
+        response["ETag"] = etag
+        response["Cache-Control"] = "private, no-cache"
+        return response
     except Exception as e:
         logger.error(f"Error in get_conversations_update: {str(e)}", exc_info=True)
         return JsonResponse(
@@ -1188,10 +1226,13 @@ def start_conversation(request, user_id):
         messages.error(request, "You cannot start a conversation with yourself.", extra_tags="danger")
         return redirect("store_app:home")
 
-    # Get or create conversation
-    conversation, created = Conversation.get_or_create_conversation(
-        request.user, other_user
-    )
+    # Get or create conversation; only creating one is rate limited
+    try:
+        conversation, created = Conversation.get_or_create_conversation(
+            request.user, other_user, before_create=lambda: require_token("start_conversation", request)
+        )
+    except RateLimited as e:
+        return rate_limited_response(request, e.retry_after)
 
     # Verify conversation exists in database
     if not conversation.id:
@@ -1218,57 +1259,27 @@ def start_conversation(request, user_id):
 
 @login_required
 def start_conversation_from_listing(request, listing_type, listing_id):
-    """Start a conversation from a product or service listing"""
-    try:
-        if listing_type == "product":
-            listing = get_object_or_404(Product, id=listing_id)
-            seller = listing.user_vendor
-        elif listing_type == "service":
-            listing = get_object_or_404(Service, id=listing_id)
-            seller = listing.user_provider
-        else:
-            messages.error(request, "Invalid listing type.", extra_tags="danger")
-            return redirect("store_app:home")
-
-        if not seller:
-            messages.error(request, "This listing has no seller.", extra_tags="danger")
-            return redirect("store_app:home")
-
-        if seller == request.user:
-            messages.error(
-                request, "You cannot message yourself about your own listing.", extra_tags="danger"
-            )
-            return redirect("store_app:home")
-
-        # Get or create conversation
-        conversation, created = Conversation.get_or_create_conversation(
-            request.user, seller
-        )
-
-        # Ensure conversation is saved
-        if not conversation.id:
-            conversation.save()
-
-        # Link conversation to the listing
-        if listing_type == "product":
-            conversation.product = listing
-        else:
-            conversation.service = listing
-        conversation.save()
+    """
+    Start a conversation from a product or service listing.
 
-        # Verify conversation was saved and refresh to ensure all relationships are loaded
-        conversation.refresh_from_db()
-        # Force reload participants to ensure they're available
-        list(conversation.participants.all())  # This forces the query to execute
-        
-        logger.info(
-            f"Conversation {conversation.id} {'created' if created else 'retrieved'} for users {request.user.id} and {seller.id}"
+    The conversation page is rendered in this same response rather than
+    redirected to, and from the state the bootstrap already loaded; the
+    page then shows the conversation's own URL. Only requests creating a
+    conversation are rate limited: this is also how a listing's existing
+    chat is opened.
+    """
+    try:
+        conversation, created = start_listing_conversation(
+            request.user,
+            listing_type,
+            listing_id,
+            before_create=lambda: require_token("start_conversation", request),
         )
-        logger.info(f"Conversation participants: {[p.id for p in conversation.participants.all()]}")
-
-        # Don't show messages - just redirect directly to the conversation
-        # This makes the Message Seller button open the chat directly
-        return redirect("store_app:conversation", conversation_id=conversation.id)
+    except RateLimited as e:
+        return rate_limited_response(request, e.retry_after)
+    except ValidationError as e:
+        messages.error(request, e.messages[0], extra_tags="danger")
+        return redirect("store_app:home")
     except Exception as e:
         logger.error(
             f"Error in start_conversation_from_listing: {str(e)}", exc_info=True
@@ -1279,6 +1290,12 @@ def start_conversation_from_listing(request, listing_type, listing_id):
         )
         return redirect("store_app:home")
 
+    logger.info(
+        f"Conversation {conversation.id} {'created' if created else 'retrieved'} for users "
+        f"{request.user.id} and {conversation.other_participant.id}"
+    )
+    return _render_conversation_page(request, conversation)
+
 
 @login_required
 def profile(request):
@@ -1288,11 +1305,8 @@ def profile(request):
     products = Product.objects.filter(user_vendor=user).order_by("-id")
     services = Service.objects.filter(user_provider=user).order_by("-id")
 
-    products_page_number = request.GET.get("products_page")
-    services_page_number = request.GET.get("services_page")
-
-    user_products_page_obj = Paginator(products, 12).get_page(products_page_number)
-    user_services_page_obj = Paginator(services, 12).get_page(services_page_number)
+    user_products_page_obj = KeysetPaginator(products).get_page(request.GET.get("products_cursor"))
+    user_services_page_obj = KeysetPaginator(services).get_page(request.GET.get("services_cursor"))
 
     if request.method == "POST":
         """
@@ -1697,8 +1711,7 @@ def all_products(request):
         selected_category = get_object_or_404(ProductCategory, slug=category_slug)
         products = products.filter(category=selected_category)
 
-    page_number = request.GET.get("page")
-    products_page_obj = Paginator(products, 12).get_page(page_number)
+    products_page_obj = KeysetPaginator(products).get_page(request.GET.get("cursor"))
     context = {
         "products_page_obj": products_page_obj,
         "user": request.user,
@@ -1720,8 +1733,7 @@ def all_services(request):
         selected_category = get_object_or_404(ServiceCategory, slug=category_slug)
         services = services.filter(category=selected_category)
 
-    page_number = request.GET.get("page")
-    services_page_obj = Paginator(services, 12).get_page(page_number)
+    services_page_obj = KeysetPaginator(services).get_page(request.GET.get("cursor"))
     context = {
         "services_page_obj": services_page_obj,
         "user": request.user,
@@ -1764,6 +1776,7 @@ def custom_page_not_found(request, exception):
 
 @require_POST
 @csrf_exempt
+@ratelimit("submit_review")
 def submit_review_api(request):
     """
     Submit a review for a seller
@@ -0,0 +1,351 @@
+"""
+WebSocket endpoint for conversations, served by the ASGI app next to Django.
+
+    ws[s]://<host>/ws/conversation/<id>/[?last_message_id=<id>]
+
+Every frame is a JSON object with a "type". Client to server:
+
+    {"type": "send", "content": "...", "client_id": "...", "product_id": 1, "service_id": 2}
+    {"type": "typing"}
+    {"type": "read", "message_id": 42}
+
+Server to client:
+
+    {"type": "message", "message": {...}}              a new message (including our own)
+    {"type": "ack", "client_id": "...", "message": {...}}   our "send" was stored
+    {"type": "typing", "user": "alice"}
+    {"type": "read", "user": "alice", "message_id": 42}
+    {"type": "presence", "online": true, "last_seen": "..."}   the other participant's
+    {"type": "error", "error": "..."}                  "retry_after" when a send is rate limited
+
+A send's client_id is also its idempotency key (see send_message()), so a
+client may safely repeat it, over the socket or the HTTP send endpoint.
+
+Connections are authenticated with the regular session cookie and must come
+from one of our own origins. Fan-out between connections goes through
+store_app.pubsub, so the channel layer is whatever MESSAGE_PUBSUB selects:
+InMemoryBackend within one process, FileBackend across the workers of a host.
+Like the SSE stream, an idle socket re-checks the database every
+STREAM_KEEPALIVE_SECONDS, so messages a per-process backend could not
+deliver still arrive.
+
+Database work runs in sync threads through database_sync_to_async(). Each
+connection has a ThreadSensitiveContext of its own, so its queries are
+serialized on its own thread, and a slow query holds up that socket only
+instead of every socket of the process.
+"""
+
+import asyncio
+import json
+import logging
+import re
+from importlib import import_module
+from types import SimpleNamespace
+from urllib.parse import parse_qs, urlsplit
+
+from asgiref.sync import ThreadSensitiveContext, sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user
+from django.db import close_old_connections
+from django.http.cookie import parse_cookie
+
+from . import pubsub
+from .ratelimit import resolve_client_ip, take_token
+from .utils.presence_utils import get_conversation_presence, mark_typing, touch_presence
+from .models import Conversation, ConversationParticipantState, Message
+from .utils.message_utils import (
+    conversation_channel,
+    conversation_signal_channel,
+    get_latest_message_id,
+    get_messages_after,
+    send_message,
+    serialize_messages,
+)
+
+logger = logging.getLogger(__name__)
+
+WEBSOCKET_PATH = re.compile(r"^/ws/conversation/(?P<conversation_id>\d+)/$")
+
+# Seconds an idle socket waits on pub/sub before re-checking the database
+STREAM_KEEPALIVE_SECONDS = 15
+
+# Application close codes, sent instead of accepting the handshake
+CLOSE_UNAUTHORIZED = 4401
+CLOSE_FORBIDDEN = 4403
+CLOSE_NOT_FOUND = 4404
+
+
+def database_sync_to_async(func):
+    """
+    sync_to_async() for code that uses the database: stale or broken
+    connections are dropped before and after, as Django does around each
+    request, so CONN_MAX_AGE applies to long-lived sockets too
+    """
+
+    def run(*args, **kwargs):
+        close_old_connections()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            close_old_connections()
+
+    return sync_to_async(run)
+
+
+def _parse_id(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _headers(scope):
+    return {name.decode("latin-1"): value.decode("latin-1") for name, value in scope["headers"]}
+
+
+def is_allowed_origin(origin, host):
+    """Browsers always send Origin on a WebSocket handshake; it must be one of ours"""
+    if not origin:
+        # Not a browser, so there is no cross-site request to forge
+        return True
+    return origin in settings.CSRF_TRUSTED_ORIGINS or urlsplit(origin).netloc == host
+
+
+def get_session_user(cookie_header):
+    """The user owning the session cookie in `cookie_header` (AnonymousUser if none)"""
+    session_key = parse_cookie(cookie_header).get(settings.SESSION_COOKIE_NAME)
+    engine = import_module(settings.SESSION_ENGINE)
+    return get_user(SimpleNamespace(session=engine.SessionStore(session_key)))
+
+
+class ConversationSocket:
+    """One accepted WebSocket connection of `user` to a conversation"""
+
+    def __init__(self, send, user, conversation_id, last_message_id=None, client_ip=None, other_user_id=None):
+        self._send = send
+        self._send_lock = asyncio.Lock()
+        self.user = user
+        self.client_ip = client_ip
+        self.other_user_id = other_user_id
+        self.conversation_id = conversation_id
+        self.last_message_id = last_message_id
+        self.handlers = {
+            "send": self.handle_send,
+            "typing": self.handle_typing,
+            "read": self.handle_read,
+        }
+
+    async def send_json(self, payload):
+        # Frames come from several tasks; keep each one whole and in order
+        async with self._send_lock:
+            await self._send({"type": "websocket.send", "text": json.dumps(payload)})
+
+    async def run(self, receive):
+        messages = pubsub.subscribe(conversation_channel(self.conversation_id))
+        signals = pubsub.subscribe(conversation_signal_channel(self.conversation_id))
+        tasks = []
+        try:
+            if self.last_message_id is None:
+                self.last_message_id = await database_sync_to_async(get_latest_message_id)(
+                    self.conversation_id
+                )
+            # Catch up on anything sent before we subscribed
+            await self.deliver_messages(
+                await database_sync_to_async(get_messages_after)(self.conversation_id, self.last_message_id)
+            )
+            tasks = [
+                asyncio.create_task(self.pump_messages(messages)),
+                asyncio.create_task(self.pump_signals(signals)),
+                asyncio.create_task(self.pump_presence()),
+            ]
+            while True:
+                event = await receive()
+                if event["type"] == "websocket.disconnect":
+                    break
+                if event["type"] == "websocket.receive":
+                    await self.handle_frame(event.get("text") or event.get("bytes"))
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            messages.close()
+            signals.close()
+
+    async def deliver_messages(self, payloads):
+        fresh = sorted((p for p in payloads if p["id"] > self.last_message_id), key=lambda p: p["id"])
+        for message_data in fresh:
+            await self.send_json({"type": "message", "message": message_data})
+            self.last_message_id = message_data["id"]
+
+    async def pump_messages(self, subscription):
+        while True:
+            payloads = await subscription.get(STREAM_KEEPALIVE_SECONDS)
+            if not payloads:
+                payloads = await database_sync_to_async(get_messages_after)(
+                    self.conversation_id, self.last_message_id
+                )
+            await self.deliver_messages(payloads)
+
+    async def pump_signals(self, subscription):
+        while True:
+            for event in await subscription.get(STREAM_KEEPALIVE_SECONDS):
+                # Our own typing notices and receipts are not echoed back
+                if event.get("user_id") != self.user.id:
+                    await self.send_json(event)
+
+    async def pump_presence(self):
+        # The open socket is the user's heartbeat; the other participant's
+        # presence is sent whenever it changes (the page renders where it
+        # starts from)
+        def heartbeat():
+            touch_presence(self.user.id)
+            if self.other_user_id is None:
+                return None
+            presence = get_conversation_presence(self.conversation_id, self.other_user_id)
+            # Typing notices arrive as signals; this is only online / last seen
+            presence.pop("typing")
+            return presence
+
+        presence = await database_sync_to_async(heartbeat)()
+        while True:
+            await asyncio.sleep(STREAM_KEEPALIVE_SECONDS)
+            latest = await database_sync_to_async(heartbeat)()
+            if latest is not None and latest != presence:
+                presence = latest
+                await self.send_json({"type": "presence", **presence})
+
+    async def handle_frame(self, raw):
+        try:
+            frame = json.loads(raw)
+        except (TypeError, ValueError):
+            frame = None
+        if not isinstance(frame, dict) or frame.get("type") not in self.handlers:
+            await self.send_json({"type": "error", "error": "Invalid frame."})
+            return
+        try:
+            await self.handlers[frame["type"]](frame)
+        except Exception as e:
+            logger.error(
+                f"Error handling {frame['type']} frame in conversation {self.conversation_id}: {str(e)}",
+                exc_info=True,
+            )
+            await self.send_json({"type": "error", "error": "Something went wrong."})
+
+    def _signal(self, kind, **fields):
+        pubsub.publish(
+            conversation_signal_channel(self.conversation_id),
+            {"type": kind, "user_id": self.user.id, "user": self.user.username, **fields},
+        )
+
+    async def handle_send(self, frame):
+        content = str(frame.get("content") or "").strip()
+        if not content:
+            await self.send_json(
+                {"type": "error", "client_id": frame.get("client_id"), "error": "Message cannot be empty."}
+            )
+            return
+        # Same flood control as the HTTP send endpoints
+        retry_after = await sync_to_async(take_token)(
+            "send_message", {"user": self.user.id, "ip": self.client_ip}
+        )
+        if retry_after:
+            await self.send_json(
+                {
+                    "type": "error",
+                    "client_id": frame.get("client_id"),
+                    "error": "Too many messages. Please slow down.",
+                    "retry_after": retry_after,
+                }
+            )
+            return
+
+        def create():
+            # The client id doubles as the idempotency key, so a send the
+            # client repeats (over the socket or the HTTP endpoint) is stored once
+            message, created = send_message(
+                self.conversation_id,
+                self.user,
+                content,
+                product_id=_parse_id(frame.get("product_id")),
+                service_id=_parse_id(frame.get("service_id")),
+                client_key=str(frame.get("client_id") or "")[:64] or None,
+            )
+            if created:
+                logger.info(
+                    f"Message {message.id} created over WebSocket in conversation {self.conversation_id}"
+                )
+            return serialize_messages([message], current_user=self.user)[0]
+
+        message_data = await database_sync_to_async(create)()
+        await self.send_json({"type": "ack", "client_id": frame.get("client_id"), "message": message_data})
+
+    async def handle_typing(self, frame):
+        # Through the cache too, so participants who poll see it
+        await sync_to_async(mark_typing)(self.user, self.conversation_id)
+
+    async def handle_read(self, frame):
+        message_id = _parse_id(frame.get("message_id"))
+
+        def mark_read():
+            if not Message.objects.filter(conversation_id=self.conversation_id, id=message_id).exists():
+                return None
+            return ConversationParticipantState.mark_read(self.user, self.conversation_id, message_id)
+
+        moved = await database_sync_to_async(mark_read)() if message_id is not None else None
+        if moved is None:
+            await self.send_json({"type": "error", "error": "Unknown message."})
+        elif moved:
+            self._signal("read", message_id=message_id)
+
+
+async def _close(send, code):
+    await send({"type": "websocket.close", "code": code})
+
+
+async def websocket_application(scope, receive, send):
+    """ASGI app for scope["type"] == "websocket" (see rum_marketplace_project.asgi)"""
+    # Sync work of this connection gets a thread of its own
+    async with ThreadSensitiveContext():
+        await _serve_websocket(scope, receive, send)
+
+
+async def _serve_websocket(scope, receive, send):
+    event = await receive()
+    if event["type"] != "websocket.connect":
+        return
+
+    match = WEBSOCKET_PATH.match(scope["path"])
+    if not match:
+        await _close(send, CLOSE_NOT_FOUND)
+        return
+    conversation_id = int(match["conversation_id"])
+
+    headers = _headers(scope)
+    if not is_allowed_origin(headers.get("origin"), headers.get("host")):
+        await _close(send, CLOSE_FORBIDDEN)
+        return
+
+    user = await database_sync_to_async(get_session_user)(headers.get("cookie", ""))
+    if not user.is_authenticated:
+        await _close(send, CLOSE_UNAUTHORIZED)
+        return
+
+    pair = await database_sync_to_async(
+        Conversation.objects.filter(id=conversation_id, participants=user)
+        .values_list("user_low_id", "user_high_id")
+        .first
+    )()
+    if pair is None:
+        await _close(send, CLOSE_NOT_FOUND)
+        return
+    other_user_id = pair[1] if pair[0] == user.id else pair[0]
+
+    query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+    last_message_id = _parse_id(query.get("last_message_id", [None])[0])
+
+    client_ip = resolve_client_ip(headers.get("x-forwarded-for"), (scope.get("client") or [None])[0])
+
+    await send({"type": "websocket.accept"})
+    await ConversationSocket(
+        send, user, conversation_id, last_message_id, client_ip, other_user_id
+    ).run(receive)